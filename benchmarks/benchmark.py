@@ -0,0 +1,273 @@
+"""
+Benchmark of all filters in kalmanfilters on synthetic ensembles.
+
+For every combination of state size (N_x), number of observations (N_y) and ensemble size (N_e) a random prior on a
+random global grid is generated, each filter is run and the wall time (best of --repeat runs) and the peak memory
+allocated during the call (tracemalloc, numpy allocations are traced) are recorded. Besides the filters the drivers
+(assimilate, sweep, time_loop) and the prior containers (PriorStore, LowRankPrior) are timed, all of them with every
+backend in --backends (default: numpy and numba if it is installed).
+The results are written to a json file, such that different revisions can be compared, e.g.
+
+    python benchmarks/benchmark.py --quick -o bench_before.json
+    python benchmarks/benchmark.py --quick -o bench_after.json --compare bench_before.json
+
+Run from the repository root.
+"""
+import argparse
+import datetime
+import importlib.util
+import itertools
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+
+from kalmanfilters.backend import BACKENDS, use_backend
+from kalmanfilters.cov_loc import localization_matrices
+from kalmanfilters.dispatch import assimilate
+from kalmanfilters.ensrf import EnSRF
+from kalmanfilters.ensrf_direct import ENSRF_direct
+from kalmanfilters.ensrf_direct_loc import ENSRF_direct_loc
+from kalmanfilters.ensrf_serial import EnSRF_serial
+from kalmanfilters.ensrf_serial_loc import EnSRF_serial_loc
+from kalmanfilters.estkf import ESTKF
+from kalmanfilters.etkf import ETKF
+from kalmanfilters.etkf_batch import ETKF_batch, ESTKF_batch
+from kalmanfilters.etkf_livings import ETKF_livings
+from kalmanfilters.incremental import IncrementalETKF
+from kalmanfilters.letkf import LETKF
+from kalmanfilters.low_rank import LowRankPrior
+from kalmanfilters.offline import OfflineDA
+from kalmanfilters.prior_store import write_prior_store
+from kalmanfilters.senkf import SEnKF
+from kalmanfilters.senkf_loc import SEnKF_loc
+from kalmanfilters.sweep import sweep
+from kalmanfilters.time_loop import time_loop
+
+#default sweep, includes large N_y (N_y > N_e) and large N_e (N_e > N_y) regimes
+SIZES={
+    'quick':{'Nx':[5000],'Ny':[50,500],'Ne':[20,100]},
+    'default':{'Nx':[10000,55296],'Ny':[50,300,2000],'Ne':[20,100,400]},
+}
+
+#localization radius [km]
+COV_LEN=2000.
+#number of timesteps for the batched filters, OfflineDA and time_loop, number of observation batches for IncrementalETKF
+T_BATCH=10
+#fraction of the ensemble variance kept by the LowRankPrior
+LOW_RANK_VARIANCE=0.99
+#skip dense localization matrices above this number of entries
+MAX_DENSE=2*10**8
+#skip the LETKF above this N_x * N_e^3 (one N_e x N_e eigendecomposition per grid point)
+MAX_LETKF=2*10**11
+
+
+def synthetic_data(Nx, Ny, Ne, seed=0):
+    """
+    Random prior with some spatial structure (smooth random fields plus noise) on random global grid points,
+    proxies are located at grid points.
+    """
+    rng=np.random.default_rng(seed)
+    #uniformly distributed points on the sphere
+    lat=np.degrees(np.arcsin(rng.uniform(-1,1,Nx)))
+    lon=rng.uniform(-180,180,Nx)
+    #low rank + noise ensemble (like a climate field)
+    k=min(Ne,20)
+    Xf=280+rng.standard_normal((Nx,k)) @ rng.standard_normal((k,Ne))+0.5*rng.standard_normal((Nx,Ne))
+    idx=rng.choice(Nx,Ny,replace=Ny>Nx)
+    R=rng.uniform(0.5,1.5,Ny)
+    HXf=Xf[idx]+np.sqrt(R)[:,None]*rng.standard_normal((Ny,Ne))
+    Y=np.mean(HXf,axis=1)+rng.standard_normal(Ny)
+    return dict(Xf=Xf,HXf=HXf,Y=Y,R=R,grid_lat=lat,grid_lon=lon,proxy_lat=lat[idx],proxy_lon=lon[idx])
+
+
+def cases(data, tmp):
+    """
+    (name, callable) for every filter, callables without arguments
+    tmp: directory for the files of PriorStore and time_loop
+    """
+    Xf,HXf,Y,R=data['Xf'],data['HXf'],data['Y'],data['R']
+    grid=(data['grid_lat'],data['grid_lon'],data['proxy_lat'],data['proxy_lon'])
+    Nx,Ne=np.shape(Xf)
+    Ny=np.shape(HXf)[0]
+    YT=np.tile(Y,(T_BATCH,1))
+    dense=Nx*Ny<=MAX_DENSE
+
+    out=[
+        ('ETKF',lambda: ETKF(Xf,HXf,Y,R)),
+        ('ETKF_livings',lambda: ETKF_livings(Xf,HXf,Y,R)),
+        ('ESTKF',lambda: ESTKF(Xf,HXf,Y,R)),
+        ('EnSRF',lambda: EnSRF(Xf,HXf,Y,R)),
+        ('ENSRF_direct',lambda: ENSRF_direct(Xf,HXf,Y,R)),
+        ('EnSRF_serial',lambda: EnSRF_serial(Xf,HXf,Y,R)),
+        ('SEnKF',lambda: SEnKF(Xf,HXf,Y,R)),
+        ('ETKF_batch_T%d'%T_BATCH,lambda: ETKF_batch(Xf,HXf,YT,R)),
+        ('ESTKF_batch_T%d'%T_BATCH,lambda: ESTKF_batch(Xf,HXf,YT,R)),
+        ('OfflineDA_T%d'%T_BATCH,lambda: offline(Xf,HXf,YT,R)),
+        ('IncrementalETKF_B%d'%T_BATCH,lambda: incremental(Xf,HXf,Y,R)),
+        ('covariance_loc_sparse',lambda: localization_matrices(*grid,COV_LEN,sparse=True)),
+        ('assimilate_auto',lambda: assimilate(Xf,HXf,Y,R)),
+        ('time_loop_T%d'%T_BATCH,lambda: time_loop(Xf,HXf,YT,R,os.path.join(tmp,'time_loop'),stats=('mean','var'),n_procs=1,
+                                                     resume=False)),
+        ('sweep',lambda: sweep(Xf,HXf,Y,R,data['proxy_lat'],data['proxy_lon'],cov_lens=[COV_LEN/2,COV_LEN,2*COV_LEN,None],
+                               inflations=[1.,1.2,1.5],grid_lat=data['grid_lat'],grid_lon=data['grid_lon'],sparse=True)),
+    ]
+    #the store is written once, the case reads it
+    store=write_prior_store(os.path.join(tmp,'prior_store'),Xf,HXf)
+    out.append(('ETKF_PriorStore',lambda: ETKF(store,None,Y,R)))
+    prior=LowRankPrior(Xf,variance=LOW_RANK_VARIANCE)
+    out+=[
+        ('LowRankPrior',lambda: LowRankPrior(Xf,variance=LOW_RANK_VARIANCE)),
+        ('ETKF_LowRankPrior',lambda: ETKF(prior,HXf,Y,R).mean()),
+    ]
+    if Nx*Ne**3<=MAX_LETKF:
+        out.append(('LETKF',lambda: LETKF(Xf,HXf,Y,R,*grid,COV_LEN)))
+
+    loc_sparse=localization_matrices(*grid,COV_LEN,sparse=True)
+    out+=[
+        ('ENSRF_direct_loc_sparse',lambda: ENSRF_direct_loc(Xf,HXf,Y,R,*loc_sparse)),
+        ('SEnKF_loc_sparse',lambda: SEnKF_loc(Xf,HXf,Y,R,*loc_sparse)),
+        ('EnSRF_serial_loc',lambda: EnSRF_serial_loc(Xf,HXf,Y,R,*loc_sparse)),
+        ('assimilate_auto_loc_sparse',lambda: assimilate(Xf,HXf,Y,R,PH_loc=loc_sparse[0],HPH_loc=loc_sparse[1])),
+    ]
+    if dense:
+        loc_dense=tuple(m.toarray() for m in loc_sparse)
+        out+=[
+            ('ENSRF_direct_loc',lambda: ENSRF_direct_loc(Xf,HXf,Y,R,*loc_dense)),
+            ('SEnKF_loc',lambda: SEnKF_loc(Xf,HXf,Y,R,*loc_dense)),
+        ]
+        if importlib.util.find_spec('haversine') is not None:
+            out.append(('covariance_loc',lambda: localization_matrices(*grid,COV_LEN)))
+    return out
+
+
+def offline(Xf, HXf, Y, R):
+    """
+    OfflineDA over the timesteps of Y (same observation network, the decomposition is cached after the first timestep)
+    """
+    da=OfflineDA(Xf,HXf)
+    for y in Y:
+        da.analysis(y,R)
+
+
+def incremental(Xf, HXf, Y, R):
+    """
+    IncrementalETKF with the observations added in T_BATCH batches
+    """
+    inc=IncrementalETKF(Xf)
+    for b in np.array_split(np.arange(len(Y)),T_BATCH):
+        inc.add(HXf[b],Y[b],R[b])
+    return inc.analysis()
+
+
+def measure(func, repeat):
+    """
+    Best wall time of repeat runs and peak memory [MB] allocated during one run.
+    """
+    times=[]
+    for i in range(repeat):
+        begin=time.perf_counter()
+        func()
+        times.append(time.perf_counter()-begin)
+
+    #separate run for memory, tracing slows down the allocations
+    tracemalloc.start()
+    func()
+    peak=tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(times), peak/1e6
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git','rev-parse','--short','HEAD'],cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError,subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, reference):
+    """
+    Print the ratio of times/peak memory to a previous benchmark file.
+    """
+    #files without a backend are from the numpy backend
+    ref={(r['filter'],r.get('backend','numpy'),r['Nx'],r['Ny'],r['Ne']):r for r in reference['results'] if 'time' in r}
+    print('\n{:<28}{:>8}{:>8}{:>6}{:>6}{:>12}{:>12}'.format('filter','backend','Nx','Ny','Ne','time ratio','mem ratio'))
+    for r in results:
+        key=(r['filter'],r['backend'],r['Nx'],r['Ny'],r['Ne'])
+        if 'time' in r and key in ref:
+            print('{:<28}{:>8}{:>8}{:>6}{:>6}{:>12.2f}{:>12.2f}'.format(*key,r['time']/ref[key]['time'],
+                                                                  r['peak_mb']/max(ref[key]['peak_mb'],1e-9)))
+
+
+def main():
+    parser=argparse.ArgumentParser(description=__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--quick',action='store_true',help='small sweep for a fast check')
+    parser.add_argument('--Nx',type=int,nargs='+',help='state sizes (overrides sweep)')
+    parser.add_argument('--Ny',type=int,nargs='+',help='numbers of observations (overrides sweep)')
+    parser.add_argument('--Ne',type=int,nargs='+',help='ensemble sizes (overrides sweep)')
+    parser.add_argument('--filters',nargs='+',help='only run these filters')
+    parser.add_argument('--backends',nargs='+',choices=BACKENDS,
+                        default=[b for b in BACKENDS if b=='numpy' or importlib.util.find_spec(b) is not None],
+                        help='backends of the hot loops (default: all installed)')
+    parser.add_argument('--repeat',type=int,default=3,help='number of timed runs (best is reported)')
+    parser.add_argument('-o','--output',default='bench_output.json',help='json file for the results')
+    parser.add_argument('--compare',help='json file of a previous run to compare with')
+    args=parser.parse_args()
+
+    sizes=dict(SIZES['quick' if args.quick else 'default'])
+    for dim in ('Nx','Ny','Ne'):
+        if getattr(args,dim):
+            sizes[dim]=getattr(args,dim)
+
+    results=[]
+    tmp=tempfile.mkdtemp(prefix='kalmanfilters_bench_')
+    try:
+        for Nx,Ny,Ne in itertools.product(sizes['Nx'],sizes['Ny'],sizes['Ne']):
+            data=synthetic_data(Nx,Ny,Ne)
+            for backend in args.backends:
+                with use_backend(backend):
+                    for name,func in cases(data,tmp):
+                        if args.filters and name not in args.filters:
+                            continue
+                        record={'filter':name,'backend':backend,'Nx':Nx,'Ny':Ny,'Ne':Ne}
+                        try:
+                            record['time'],record['peak_mb']=measure(func,args.repeat)
+                            print('{:<28} {:<6} Nx={:<7} Ny={:<5} Ne={:<4} {:9.4f} s {:10.1f} MB'.format(
+                                  name,backend,Nx,Ny,Ne,record['time'],record['peak_mb']))
+                        except Exception as err:
+                            record['error']=repr(err)
+                            print('{:<28} {:<6} Nx={:<7} Ny={:<5} Ne={:<4} failed: {!r}'.format(name,backend,Nx,Ny,Ne,err))
+                        results.append(record)
+    finally:
+        shutil.rmtree(tmp,ignore_errors=True)
+
+    output={
+        'revision':git_revision(),
+        'date':datetime.datetime.now().isoformat(timespec='seconds'),
+        'python':platform.python_version(),
+        'numpy':np.__version__,
+        'machine':platform.machine(),
+        'cpu_count':os.cpu_count(),
+        'results':results,
+    }
+    with open(args.output,'w') as f:
+        json.dump(output,f,indent=1)
+    print('results written to',args.output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results,json.load(f))
+
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,33 @@
+"""
+Ensemble Kalman Filters, see README.md. The filters are imported lazily on first access, e.g.
+    import kalmanfilters
+    Xa=kalmanfilters.assimilate(Xf,HXf,Y,R)
+    Xa=kalmanfilters.ETKF(Xf,HXf,Y,R)
+such that importing the package doesn't import scipy, haversine, xarray or numba.
+"""
+import importlib
+
+#public name: module
+EXPORTS={'assimilate':'dispatch', 'choose_method':'dispatch', 'estimate_costs':'dispatch',
+         'ETKF':'etkf', 'ESTKF':'estkf', 'ETKF_livings':'etkf_livings', 'EnSRF':'ensrf', 'ENSRF_direct':'ensrf_direct',
+         'EnSRF_serial':'ensrf_serial', 'ENSRF_direct_loc':'ensrf_direct_loc', 'EnSRF_serial_loc':'ensrf_serial_loc',
+         'SEnKF':'senkf', 'SEnKF_loc':'senkf_loc', 'LETKF':'letkf', 'ETKF_batch':'etkf_batch', 'ESTKF_batch':'etkf_batch',
+         'IncrementalETKF':'incremental', 'OfflineDA':'offline', 'apply_weights':'update',
+         'LowRankPrior':'low_rank', 'PriorStore':'prior_store', 'open_prior_store':'prior_store', 'write_prior_store':'prior_store',
+         'sweep':'sweep', 'time_loop':'time_loop', 'covariance_loc':'cov_loc', 'localization_matrices':'cov_loc', 'LocalizationCache':'loc_cache',
+         'DistanceCache':'dist_cache', 'ObsOperator':'obs_operator', 'assimilate_dataarray':'xarray_filters',
+         'Profile':'profiling', 'set_backend':'backend', 'get_backend':'backend', 'use_backend':'backend'}
+
+__all__=list(EXPORTS)
+
+def __getattr__(name):
+    if name not in EXPORTS:
+        raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+    value=getattr(importlib.import_module('.'+EXPORTS[name],__name__),name)
+    #later lookups don't go through __getattr__
+    globals()[name]=value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals())|set(__all__))
@@ -0,0 +1,50 @@
+from contextlib import contextmanager
+
+#backends for the hot loops (gaspari_cohn, mean subtraction + update with the weights, serial EnSRF updates)
+BACKENDS=('numpy','numba')
+
+#active backend
+current=['numpy']
+
+def set_backend(name):
+    """
+    Selects the backend of the hot loops at runtime:
+    - 'numpy': numpy expressions (default, no extra dependency)
+    - 'numba': fused, multithreaded kernels compiled with numba (numba_kernels.py), same results up to rounding.
+      The number of threads is set with numba.set_num_threads or NUMBA_NUM_THREADS.
+    """
+    if name not in BACKENDS:
+        raise ValueError('backend must be one of {}'.format(BACKENDS))
+    if name=='numba':
+        #fails early if numba is not installed
+        from . import numba_kernels
+    current[0]=name
+
+
+def get_backend():
+    return current[0]
+
+
+@contextmanager
+def use_backend(name):
+    """
+    Context manager that selects a backend temporarily, e.g.
+        with use_backend('numba'):
+            Xa=ETKF(Xf,HXf,Y,R)
+    """
+    previous=current[0]
+    set_backend(name)
+    try:
+        yield
+    finally:
+        current[0]=previous
+
+
+def kernel(name):
+    """
+    Kernel name of the active backend. None for the numpy backend, the modules then run their numpy code.
+    """
+    if current[0]=='numpy':
+        return None
+    from . import numba_kernels
+    return getattr(numba_kernels,name)
@@ -1,59 +1,185 @@
-def covariance_loc(model_data,proxy_lat,proxy_lon, cov_len):    
+import numpy as np
+from .backend import kernel
+from .profiling import stage
+
+#mean earth radius in km (same value as in the haversine package)
+EARTH_RADIUS=6371.0088
+
+def covariance_loc(model_data,proxy_lat,proxy_lon, cov_len, sparse=False, cache_dir=None):
     """
     Function that returns the matrices needed for the Covariance Localization in the direct EnSRF solver by Hadamard (element-wise) product.
     These are the terms called W_loc and Y_loc here: https://www.nature.com/articles/s41586-020-2617-x#Sec7 (Data Assimilation section).
     The idea is to compute these matrices once in the beginning for all available proxy locations, and later in the DA loop one only selects
     the relevant columns of W_loc / rows and columns of Y_loc for the localized simultaneous Kalman Filter Solver.
-    
+
     Input:
-       - model_data from which the grid point locations are extracted. Here I use the stack function, which I also use when constructing the
+       - model_data from which the grid point locations are extracted. The grid points are ordered as by the stack function (stack(z=('lat','lon'))), which I also use when constructing the
        prior vector. In brings all gridpoints in a vector form (xarray-DataArray such that stack can be applied, N_x grid points)
        - proxy_lat, proxy_lon are the latitudes and longitudes of the proxy locations (np.arrays, length = N_y). Make sure they have the same ordering as
        the entries of your Observations-from-Model (HXf) in the Kalman Filter.
        - cov_len: Radius for Gaspari Cohn function [float, in km ]
-       
+       - sparse: If True, only the grid point - proxy pairs closer than 2*cov_len (where Gaspari Cohn is nonzero) are computed
+       and the matrices are returned as scipy.sparse CSR matrices. Use this for large grids/many proxies, where the dense
+       matrices don't fit into memory.
+       - cache_dir: directory of a persistent DistanceCache (dist_cache.py). The distances and localization matrices are then computed
+       once for a grid/proxy database, and later calls (also in other jobs and for other cov_len) load them as memory mapped arrays.
+
     Ouput:
         - PH_loc: Matrix for localization of PH^T (N_x * N_y)
         - HPH_loc: Matrix for localization of HPH^T (N_y * N_y)
     """
+    #bring coordinates of model (field) into vector form (same ordering as the stacked prior, stack(z=('lat','lon'))),
+    #only the coordinates are needed, the data itself is not stacked
+    grid_lat,grid_lon=np.meshgrid(model_data['lat'].values,model_data['lon'].values,indexing='ij')
+    grid_lat=grid_lat.reshape(-1)
+    grid_lon=grid_lon.reshape(-1)
+
+    return localization_matrices(grid_lat,grid_lon,proxy_lat,proxy_lon,cov_len,sparse=sparse,cache_dir=cache_dir)
+
+
+def localization_matrices(grid_lat,grid_lon,proxy_lat,proxy_lon,cov_len,sparse=False,cache_dir=None):
+    """
+    Same as covariance_loc, but directly takes the latitudes and longitudes of the (stacked) grid points as arrays (length N_x).
+    """
+    if cache_dir is not None:
+        from .dist_cache import DistanceCache
+        return DistanceCache(cache_dir).localization_matrices(grid_lat,grid_lon,proxy_lat,proxy_lon,cov_len,sparse=sparse)
+
+    if sparse:
+        return sparse_localization_matrices(grid_lat,grid_lon,proxy_lat,proxy_lon,cov_len)
+
+    dists_mp,dists_pp=distance_matrices(grid_lat,grid_lon,proxy_lat,proxy_lon)
+    Nx,Ny=dists_mp.shape
+
+    with stage('gaspari cohn',flops=30*(Nx+Ny)*Ny,nbytes=8*2*(Nx+Ny)*Ny):
+        #flatten distances, apply to Gaspari Cohn and reshape
+        PH_loc=gaspari_cohn(dists_mp.reshape(-1),cov_len).reshape(dists_mp.shape)
+        HPH_loc=gaspari_cohn(dists_pp.reshape(-1),cov_len).reshape(dists_pp.shape)
+
+    return PH_loc, HPH_loc
+
+
+def distance_matrices(grid_lat,grid_lon,proxy_lat,proxy_lon):
+    """
+    Great circle distances [km] between all grid points and proxies (N_x * N_y) and between all proxies (N_y * N_y)
+    """
     from haversine import haversine_vector, Unit
-    
-    #bring coordinates of model (field) and proxy (individual locations) into the right form
-    #the method we use are different due to this different structures (field and individual locations)
-    loc=np.array([[lat,lon] for lat,lon in zip(proxy_lat,proxy_lon)])
-    stacked=model_data.stack(z=('lat','lon')).transpose('z','time')
-    coords=[list(z) for z in stacked.z.values]
-    
-    #model-proxy distances
-    dists_mp=haversine_vector(loc,coords, Unit.KILOMETERS,comb=True)
-    dists_mp_shape=dists_mp.shape
-    
-    #proxy-proxy distances
-    dists_pp=haversine_vector(loc,loc, Unit.KILOMETERS,comb=True)
-    dists_pp_shape=dists_pp.shape
-    
-    def gaspari_cohn(dists,cov_len):
-        """
-        Gaspari Cohn decorrelation function https://rmets.onlinelibrary.wiley.com/doi/epdf/10.1002/qj.49712555417 page 26
-        dists: need to be a 1-D array with all the distances (Reshapeto your needs afterwards)
-        cov_len: radius given in km
-
-        """
-        dists = np.abs(dists)
-        array = np.zeros_like(dists)
-        r = dists/cov_len
-        #first the short distances
-        i=np.where(r<=1.)[0]
-        array[i]=-0.25*(r[i])**5+0.5*r[i]**4+0.625*r[i]**3-5./3.*r[i]**2+1.
-        #then the long ones
-        i=np.where((r>1) & (r<=2))[0]
-        array[i]=1./12.*r[i]**5-0.5*r[i]**4+0.625*r[i]**3+5./3.*r[i]**2.-5.*r[i]+4.-2./(3.*r[i])
-
-        array[array < 0.0] = 0.0
-        return array
-    
-    #flatten distances, apply to Gaspari Cohn and reshape
-    PH_loc=gaspari_cohn(dists_mp.reshape(-1),cov_len).reshape(dists_mp_shape)
-    HPH_loc=gaspari_cohn(dists_pp.reshape(-1),cov_len).reshape(dists_pp_shape)
-    
+
+    #bring coordinates of model and proxies into the (N x 2) form needed by haversine
+    loc=np.column_stack([proxy_lat,proxy_lon])
+    coords=np.column_stack([grid_lat,grid_lon])
+
+    Nx,Ny=len(coords),len(loc)
+    with stage('distances',flops=20*(Nx+Ny)*Ny,nbytes=8*(Nx+Ny)*Ny):
+        #model-proxy distances
+        dists_mp=haversine_vector(loc,coords, Unit.KILOMETERS,comb=True)
+
+        #proxy-proxy distances
+        dists_pp=haversine_vector(loc,loc, Unit.KILOMETERS,comb=True)
+
+    return dists_mp, dists_pp
+
+
+def sparse_localization_matrices(grid_lat,grid_lon,proxy_lat,proxy_lon,cov_len):
+    """
+    Sparse version of the localization matrices. Gaspari Cohn is exactly zero beyond 2*cov_len, so only the pairs
+    within that radius are searched with a spatial index and stored.
+    Output: PH_loc (N_x * N_y), HPH_loc (N_y * N_y) as scipy.sparse.csr_matrix
+    """
+    Nx=len(grid_lat)
+    Ny=len(proxy_lat)
+
+    with stage('neighbour search',nbytes=8*3*(Nx+Ny)):
+        pairs_mp=neighbours(grid_lat,grid_lon,proxy_lat,proxy_lon,2*cov_len)
+        pairs_pp=neighbours(proxy_lat,proxy_lon,proxy_lat,proxy_lon,2*cov_len)
+
+    return sparse_gaspari_cohn(pairs_mp,pairs_pp,Nx,Ny,cov_len)
+
+
+def sparse_gaspari_cohn(pairs_mp,pairs_pp,Nx,Ny,cov_len):
+    """
+    Sparse localization matrices from the (rows, cols, dists) of the grid point - proxy and proxy - proxy pairs found by neighbours.
+    Pairs farther apart than 2*cov_len (e.g. searched with a larger radius) are dropped.
+    Output: PH_loc (N_x * N_y), HPH_loc (N_y * N_y) as scipy.sparse.csr_matrix
+    """
+    import scipy.sparse
+
+    rows,cols,dists=pairs_mp
+    rows_pp,cols_pp,dists_pp=pairs_pp
+    with stage('gaspari cohn',flops=30*(len(dists)+len(dists_pp)),nbytes=20*(len(dists)+len(dists_pp))):
+        PH_loc=scipy.sparse.csr_matrix((gaspari_cohn(dists,cov_len),(rows,cols)),shape=(Nx,Ny))
+        #pairs at or beyond 2*cov_len have weight zero
+        PH_loc.eliminate_zeros()
+
+        HPH_loc=scipy.sparse.csr_matrix((gaspari_cohn(dists_pp,cov_len),(rows_pp,cols_pp)),shape=(Ny,Ny))
+        HPH_loc.eliminate_zeros()
+
     return PH_loc, HPH_loc
+
+
+def neighbours(lat1,lon1,lat2,lon2,radius):
+    """
+    Find all pairs of points from the two sets of locations that are closer than radius [km].
+    The points are put on the unit sphere, where the straight-line (chord) distance is monotonic in the great circle distance,
+    such that a kd-tree can be used for the search.
+
+    Output:
+        - rows: indices into the first set of points
+        - cols: indices into the second set of points
+        - dists: great circle distances of the pairs [km]
+    """
+    from scipy.spatial import cKDTree
+
+    xyz1=unit_sphere(lat1,lon1)
+    xyz2=unit_sphere(lat2,lon2)
+
+    #chord length corresponding to the radius (angle can't be larger than pi)
+    angle=min(radius/EARTH_RADIUS,np.pi)
+    chord=2*np.sin(angle/2)
+
+    #query the tree of the first set with the (usually fewer) points of the second set
+    tree=cKDTree(xyz1)
+    found=tree.query_ball_point(xyz2,chord)
+    counts=np.array([len(f) for f in found],dtype=np.intp)
+    rows=np.concatenate([np.asarray(f,dtype=np.intp) for f in found]) if len(found) else np.zeros(0,dtype=np.intp)
+    cols=np.repeat(np.arange(len(found)),counts)
+
+    #convert chord to great circle distance
+    c=np.linalg.norm(xyz1[rows]-xyz2[cols],axis=1)
+    dists=2*EARTH_RADIUS*np.arcsin(np.clip(c/2,0,1))
+
+    return rows, cols, dists
+
+
+def unit_sphere(lat,lon):
+    """
+    Cartesian coordinates (N x 3) of latitudes/longitudes (given in degrees) on the unit sphere
+    """
+    lat=np.radians(np.asarray(lat,dtype=float))
+    lon=np.radians(np.asarray(lon,dtype=float))
+    return np.column_stack([np.cos(lat)*np.cos(lon),np.cos(lat)*np.sin(lon),np.sin(lat)])
+
+
+def gaspari_cohn(dists,cov_len):
+    """
+    Gaspari Cohn decorrelation function https://rmets.onlinelibrary.wiley.com/doi/epdf/10.1002/qj.49712555417 page 26
+    dists: need to be a 1-D array with all the distances (Reshapeto your needs afterwards)
+    cov_len: radius given in km
+
+    """
+    kern=kernel('gaspari_cohn')
+    if kern is not None:
+        return kern(dists,cov_len)
+
+    dists = np.abs(dists)
+    array = np.zeros_like(dists)
+    r = dists/cov_len
+    #first the short distances
+    i=np.where(r<=1.)[0]
+    array[i]=-0.25*(r[i])**5+0.5*r[i]**4+0.625*r[i]**3-5./3.*r[i]**2+1.
+    #then the long ones
+    i=np.where((r>1) & (r<=2))[0]
+    array[i]=1./12.*r[i]**5-0.5*r[i]**4+0.625*r[i]**3+5./3.*r[i]**2.-5.*r[i]+4.-2./(3.*r[i])
+
+    array[array < 0.0] = 0.0
+    return array
@@ -0,0 +1,146 @@
+import importlib
+
+import numpy as np
+
+from .profiling import stage
+
+#module of every filter
+FILTERS={'ETKF':'etkf', 'ESTKF':'estkf', 'ETKF_livings':'etkf_livings', 'EnSRF':'ensrf', 'ENSRF_direct':'ensrf_direct',
+         'EnSRF_serial':'ensrf_serial', 'ENSRF_direct_loc':'ensrf_direct_loc', 'EnSRF_serial_loc':'ensrf_serial_loc',
+         'SEnKF':'senkf', 'SEnKF_loc':'senkf_loc', 'LETKF':'letkf'}
+
+#filters that take the localization matrices PH_loc, HPH_loc
+LOCALIZED=('ENSRF_direct_loc', 'EnSRF_serial_loc', 'SEnKF_loc')
+
+#the serial EnSRF works with matrix-vector products in a python loop, which reach a small fraction of the speed of the
+#matrix-matrix products of the other filters
+LEVEL2_FACTOR=20
+
+#the sampled product of the sparse kernel (loc_product.py, gathered rows + einsum) and the sparse matrix products of the state
+#update reach a fraction of the speed of dense BLAS products, counted as this many dense flops per flop (measured for
+#N_x=55000, N_y=1000, N_e=100: ~1 GFLOP/s gathered, ~5 GFLOP/s sparse products, ~25 GFLOP/s dense)
+SPARSE_PRODUCT_FACTOR=20
+SPARSE_UPDATE_FACTOR=6
+
+#cost of converting one entry of a dense N_x x N_y localization matrix to csr (count_nonzero + scipy.sparse.csr_matrix,
+#~13 ns per entry), in dense flops
+CONVERSION_FLOPS=300
+
+#density of the localization matrices above which the sparse kernel is never cheaper (4 N_e dense flops per entry against
+#(2 SPARSE_PRODUCT_FACTOR + 2 SPARSE_UPDATE_FACTOR) N_e per nonzero entry), denser matrices are not counted
+SPARSE_DENSITY=0.075
+
+def estimate_costs(Nx, Ny, Ne):
+    """
+    Approximate number of floating point operations of the deterministic filters without localization (same counts as their
+    profiling stages). They give the same posterior mean and covariance, the ensemble space filters (ETKF, ESTKF, ETKF_livings)
+    decompose N_e x N_e matrices, the observation space filters (EnSRF, ENSRF_direct) N_y x N_y matrices, the serial EnSRF
+    loops over the observations (counted with LEVEL2_FACTOR). All of them finish with the same update of the prior (2 N_x N_e^2).
+    Output:
+    - dict method: flops
+    """
+    update=2*Nx*Ne*Ne
+    return {'ETKF':2*Ny*Ne*Ne+13*Ne**3+update,
+            'ESTKF':4*Ny*Ne*Ne+15*Ne**3+update,
+            'ETKF_livings':6*Ny*Ne*Ne+13*Ne**3+update,
+            'EnSRF':4*Ny*Ny*Ne+9*Ny**3+6*Ny*Ne*Ne+13*Ne**3+update,
+            'ENSRF_direct':10*Ny*Ny*Ne+12*Ny**3+4*Ny*Ne*Ne+update,
+            'EnSRF_serial':LEVEL2_FACTOR*(4*Ny*Ny*Ne+4*Ny*Ne*Ne)+update}
+
+
+def estimate_costs_loc(Nx, Ny, Ne, nnz_PH, nnz_HPH, convert=False):
+    """
+    Approximate cost of ENSRF_direct_loc with dense and with sparse localization matrices, in dense (BLAS) flops.
+    The dense products with the N_x x N_y matrices (localized PH^T and the state update) cost 2 N_x N_y N_e each, the sparse
+    kernel only evaluates them at the nonzero entries but at a lower speed per flop (SPARSE_PRODUCT_FACTOR, SPARSE_UPDATE_FACTOR).
+    With convert=True the sparse cost includes the conversion of the dense matrices (CONVERSION_FLOPS per entry).
+    Output:
+    - dict representation ('dense', 'sparse'): flops
+    """
+    solve=12*Ny**3+4*Ny*Ny*Ne
+    sparse=2*nnz_PH*Ne*SPARSE_PRODUCT_FACTOR+2*nnz_PH*(Ne+1)*SPARSE_UPDATE_FACTOR+2*nnz_HPH*Ne+solve
+    if convert:
+        sparse+=CONVERSION_FLOPS*(Nx*Ny+Ny*Ny)
+    return {'dense':2*Nx*Ny*Ne+2*Nx*Ny*(Ne+1)+2*Ny*Ny*Ne+solve,
+            'sparse':sparse}
+
+
+def choose_method(Nx, Ny, Ne):
+    """
+    Cheapest deterministic filter without localization for the given dimensions (see estimate_costs).
+    Few observations (N_y << N_e) favour ENSRF_direct, many observations (N_e << N_y) the ETKF.
+    """
+    costs=estimate_costs(Nx, Ny, Ne)
+    return min(costs, key=costs.get)
+
+
+def assimilate(Xf, HXf, Y, R, method='auto', PH_loc=None, HPH_loc=None, **kwargs):
+    """
+    Common entry point of all filters. With method='auto' the cheapest of the equivalent deterministic filters (same posterior
+    mean and covariance) is chosen from N_x, N_y, N_e and the localization:
+    - without localization: the filter with the lowest estimate_costs, i.e. ENSRF_direct for few observations and the ETKF for
+      many observations
+    - with localization (PH_loc and HPH_loc): ENSRF_direct_loc, dense localization matrices with few nonzero entries (density
+      below SPARSE_DENSITY, e.g. a short cov_len) are converted to sparse matrices when this is cheaper (estimate_costs_loc)
+    Stochastic filters, the serial localized EnSRF and the LETKF give different analyses and are only used when asked for by name.
+
+    The filter modules (and scipy) are only imported when a filter is called.
+
+    Usage:
+        Xa=assimilate(Xf,HXf,Y,R)
+        Xa=assimilate(Xf,HXf,Y,R,PH_loc=PH_loc,HPH_loc=HPH_loc)
+        Xa=assimilate(Xf,HXf,Y,R,method='SEnKF_loc',PH_loc=PH_loc,HPH_loc=HPH_loc,solver='cg')
+
+    Input:
+    - Xf:  the prior ensemble (N_x x N_e)
+    - HX^f: Model value projected into observation space/at proxy locations (N_y x N_e), or an ObsOperator (obs_operator.py)
+    - Y: Observation vector (N_y)
+    - R: Measurement Error (N_y), diagonal of the error covariance matrix
+    - method: 'auto' or the name of a filter (one of FILTERS)
+    - PH_loc, HPH_loc: localization matrices (N_x x N_y, N_y x N_y), dense or scipy.sparse (see cov_loc.py)
+    - kwargs: passed to the filter (e.g. chunk_size, out, dtype, stats for the transform filters)
+
+    Output:
+    - Analysis ensemble (N_x, N_e), or the statistics of the transform filters with stats
+    """
+    localized=PH_loc is not None or HPH_loc is not None
+    if localized and (PH_loc is None or HPH_loc is None):
+        raise ValueError('localization needs PH_loc and HPH_loc')
+
+    if method=='auto':
+        Nx,Ne=np.shape(Xf)
+        Ny=np.shape(Y)[0]
+        if localized:
+            method='ENSRF_direct_loc'
+            with stage('dispatch',flops=Nx*Ny):
+                PH_loc, HPH_loc = sparsify(PH_loc, HPH_loc, Nx, Ny, Ne)
+        else:
+            method=choose_method(Nx, Ny, Ne)
+
+    if method not in FILTERS:
+        raise ValueError('method must be auto or one of {}'.format(list(FILTERS)))
+    if localized!=(method in LOCALIZED):
+        raise ValueError('PH_loc and HPH_loc are needed by (and only by) {}'.format(LOCALIZED))
+
+    filt=getattr(importlib.import_module('.'+FILTERS[method],__package__),method)
+    if localized:
+        return filt(Xf, HXf, Y, R, PH_loc, HPH_loc, **kwargs)
+    return filt(Xf, HXf, Y, R, **kwargs)
+
+
+def sparsify(PH_loc, HPH_loc, Nx, Ny, Ne):
+    """
+    Converts dense localization matrices to scipy.sparse when the sparse kernel of ENSRF_direct_loc is cheaper.
+    """
+    if not isinstance(PH_loc,np.ndarray):
+        #already sparse
+        return PH_loc, HPH_loc
+    nnz_PH=np.count_nonzero(PH_loc)
+    if nnz_PH>SPARSE_DENSITY*Nx*Ny:
+        return PH_loc, HPH_loc
+    costs=estimate_costs_loc(Nx, Ny, Ne, nnz_PH, np.count_nonzero(HPH_loc), convert=True)
+    if costs['sparse']>=costs['dense']:
+        return PH_loc, HPH_loc
+
+    import scipy.sparse
+    return scipy.sparse.csr_matrix(PH_loc), scipy.sparse.csr_matrix(HPH_loc)
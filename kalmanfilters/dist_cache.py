@@ -0,0 +1,171 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from .cov_loc import distance_matrices, neighbours, sparse_gaspari_cohn, gaspari_cohn
+from .profiling import stage
+
+class DistanceCache:
+    """
+    Persistent on-disk cache for the distance and localization matrices of covariance_loc.
+    The grid and the proxy database usually don't change between runs, but every job would recompute all model-proxy and
+    proxy-proxy distances. Here the entries are content-addressed: the key is a hash of the grid and proxy coordinates, so
+    the same cache directory can be shared by all jobs and a changed grid/proxy database simply gets a new entry.
+    All matrices are stored as .npy files and loaded as read-only memory mapped arrays.
+
+    Layout of one entry (cache_dir/<hash of coordinates>/):
+    - dists_mp.npy, dists_pp.npy: dense distances [km], independent of cov_len
+    - PH_loc_<cov_len>.npy, HPH_loc_<cov_len>.npy: dense Gaspari Cohn matrices
+    - pairs_<radius>/: grid point - proxy and proxy - proxy pairs within radius [km] (rows, cols, dists), for the sparse matrices
+    - sparse_<cov_len>/: CSR arrays (data, indices, indptr) of the sparse Gaspari Cohn matrices
+
+    When only cov_len changes, the stored distances are reused: dense distances for any cov_len, stored pairs for any
+    cov_len with 2*cov_len not larger than the search radius. Only the Gaspari Cohn function is evaluated again.
+
+    Usage:
+        PH_loc,HPH_loc=covariance_loc(model_data,proxy_lat,proxy_lon,cov_len,cache_dir='loc_cache')
+    or
+        cache=DistanceCache('loc_cache')
+        PH_loc,HPH_loc=cache.localization_matrices(grid_lat,grid_lon,proxy_lat,proxy_lon,cov_len,sparse=True)
+
+    Input:
+    - cache_dir: directory of the cache (created if it doesn't exist)
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir=cache_dir
+        self.hits=0
+        self.misses=0
+
+    def localization_matrices(self, grid_lat, grid_lon, proxy_lat, proxy_lon, cov_len, sparse=False):
+        """
+        Same as localization_matrices in cov_loc.py, loaded from/stored in the cache.
+        Output: PH_loc (N_x * N_y), HPH_loc (N_y * N_y), dense as memory mapped arrays or as scipy.sparse.csr_matrix
+        """
+        entry=self.entry(grid_lat,grid_lon,proxy_lat,proxy_lon)
+        if sparse:
+            return self.sparse_matrices(entry,grid_lat,grid_lon,proxy_lat,proxy_lon,cov_len)
+
+        names=[os.path.join(entry,'{}_{}.npy'.format(m,name(cov_len))) for m in ('PH_loc','HPH_loc')]
+        if all(os.path.exists(n) for n in names):
+            self.hits+=1
+            with stage('cache load'):
+                return tuple(np.load(n,mmap_mode='r') for n in names)
+
+        self.misses+=1
+        dists_mp,dists_pp=self.distances(grid_lat,grid_lon,proxy_lat,proxy_lon)
+        Nx,Ny=dists_mp.shape
+        with stage('gaspari cohn',flops=30*(Nx+Ny)*Ny,nbytes=8*2*(Nx+Ny)*Ny):
+            for n,d in zip(names,(dists_mp,dists_pp)):
+                save(n,gaspari_cohn(np.asarray(d).reshape(-1),cov_len).reshape(d.shape))
+        return tuple(np.load(n,mmap_mode='r') for n in names)
+
+    def distances(self, grid_lat, grid_lon, proxy_lat, proxy_lon):
+        """
+        Dense great circle distances [km] (see distance_matrices in cov_loc.py), loaded from/stored in the cache.
+        Output: dists_mp (N_x * N_y), dists_pp (N_y * N_y) as memory mapped arrays
+        """
+        entry=self.entry(grid_lat,grid_lon,proxy_lat,proxy_lon)
+        names=[os.path.join(entry,'dists_{}.npy'.format(m)) for m in ('mp','pp')]
+        if not all(os.path.exists(n) for n in names):
+            for n,d in zip(names,distance_matrices(grid_lat,grid_lon,proxy_lat,proxy_lon)):
+                save(n,d)
+        with stage('cache load'):
+            return tuple(np.load(n,mmap_mode='r') for n in names)
+
+    def sparse_matrices(self, entry, grid_lat, grid_lon, proxy_lat, proxy_lon, cov_len):
+        import scipy.sparse
+
+        Nx,Ny=len(grid_lat),len(proxy_lat)
+        folder=os.path.join(entry,'sparse_{}'.format(name(cov_len)))
+        if os.path.exists(os.path.join(folder,'done')):
+            self.hits+=1
+            with stage('cache load'):
+                out=[]
+                for m,shape in (('PH_loc',(Nx,Ny)),('HPH_loc',(Ny,Ny))):
+                    data,indices,indptr=(np.load(os.path.join(folder,'{}_{}.npy'.format(m,p)),mmap_mode='r') for p in ('data','indices','indptr'))
+                    out.append(scipy.sparse.csr_matrix((data,indices,indptr),shape=shape))
+            return tuple(out)
+
+        self.misses+=1
+        pairs_mp,pairs_pp=self.pairs(entry,grid_lat,grid_lon,proxy_lat,proxy_lon,2*cov_len)
+        PH_loc,HPH_loc=sparse_gaspari_cohn(pairs_mp,pairs_pp,Nx,Ny,cov_len)
+
+        os.makedirs(folder,exist_ok=True)
+        for m,mat in (('PH_loc',PH_loc),('HPH_loc',HPH_loc)):
+            for p in ('data','indices','indptr'):
+                save(os.path.join(folder,'{}_{}.npy'.format(m,p)),getattr(mat,p))
+        #marks a complete entry
+        open(os.path.join(folder,'done'),'w').close()
+        return PH_loc, HPH_loc
+
+    def pairs(self, entry, grid_lat, grid_lon, proxy_lat, proxy_lon, radius):
+        """
+        Grid point - proxy and proxy - proxy pairs within radius [km] (see neighbours in cov_loc.py).
+        Pairs stored for a larger radius are reused, otherwise the pairs are searched and stored.
+        Output: (rows, cols, dists) for both sets of pairs
+        """
+        parts=[m+'_'+p for m in ('mp','pp') for p in ('rows','cols','dists')]
+        for r in sorted(self.radii(entry)):
+            if r>=radius:
+                folder=os.path.join(entry,'pairs_{}'.format(name(r)))
+                with stage('cache load'):
+                    loaded=[np.load(os.path.join(folder,p+'.npy'),mmap_mode='r') for p in parts]
+                return tuple(loaded[:3]), tuple(loaded[3:])
+
+        with stage('neighbour search',nbytes=8*3*(len(grid_lat)+len(proxy_lat))):
+            pairs_mp=neighbours(grid_lat,grid_lon,proxy_lat,proxy_lon,radius)
+            pairs_pp=neighbours(proxy_lat,proxy_lon,proxy_lat,proxy_lon,radius)
+
+        folder=os.path.join(entry,'pairs_{}'.format(name(radius)))
+        os.makedirs(folder,exist_ok=True)
+        for p,a in zip(parts,pairs_mp+pairs_pp):
+            save(os.path.join(folder,p+'.npy'),a)
+        open(os.path.join(folder,'done'),'w').close()
+        return pairs_mp, pairs_pp
+
+    def radii(self, entry):
+        """
+        Search radii of the complete stored pairs of an entry
+        """
+        out=[]
+        for f in os.listdir(entry):
+            if f.startswith('pairs_') and os.path.exists(os.path.join(entry,f,'done')):
+                out.append(float(f[len('pairs_'):]))
+        return out
+
+    def entry(self, grid_lat, grid_lon, proxy_lat, proxy_lon):
+        """
+        Directory of the cache entry for these coordinates (created if it doesn't exist)
+        """
+        coords=[np.ascontiguousarray(c,dtype=np.float64) for c in (grid_lat,grid_lon,proxy_lat,proxy_lon)]
+        h=hashlib.sha256()
+        for c in coords:
+            h.update(str(c.shape).encode())
+            h.update(c.tobytes())
+        entry=os.path.join(self.cache_dir,h.hexdigest()[:32])
+        if not os.path.exists(entry):
+            os.makedirs(entry,exist_ok=True)
+            with open(os.path.join(entry,'meta.json'),'w') as f:
+                json.dump({'N_x':len(coords[0]),'N_y':len(coords[2])},f)
+        return entry
+
+    def __repr__(self):
+        return 'DistanceCache(cache_dir={!r}, hits={}, misses={})'.format(self.cache_dir,self.hits,self.misses)
+
+
+def name(value):
+    """
+    File name part for cov_len/radius values
+    """
+    return repr(float(value))
+
+
+def save(path, array):
+    """
+    Writes the array to a temporary file first, such that other jobs never see incomplete files
+    """
+    tmp='{}.{}.tmp.npy'.format(path[:-len('.npy')],os.getpid())
+    np.save(tmp,np.asarray(array))
+    os.replace(tmp,path)
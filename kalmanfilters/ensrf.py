@@ -1,6 +1,9 @@
 import numpy as np
+from .update import apply_weights
+from .obs_operator import observations
+from .profiling import stage
 
-def EnSRF(Xf, HXf, Y, R):
+def EnSRF(Xf, HXf, Y, R, chunk_size=None, out=None, dtype=None, stats=None, overwrite_prior=False):
     """
     Implementation adapted from pseudocode description in
     "State-of-the-art stochastic data assimialation methods" by Vetra-Carvalho et al. (2018),
@@ -10,55 +13,74 @@ def EnSRF(Xf, HXf, Y, R):
     
     Input:
     - Xf:  the prior ensemble (N_x x N_y) 
-    - R: Measurement Error (Variance of pseudoproxy timerseries) (N_y x 1) -> converted to Ny x Ny matrix
-    - HX^f: Model value projected into observation space/at proxy locations (N_y x N_e)
+    - R: Measurement Error (Variance of pseudoproxy timerseries) (N_y x 1), diagonal of the error covariance matrix
+    - HX^f: Model value projected into observation space/at proxy locations (N_y x N_e), or an ObsOperator (obs_operator.py)
     - Y: Observation vector (N_y x 1)
+    - chunk_size, out: for priors that don't fit into memory (memory mapped Xf), see apply_weights in update.py
+    - dtype: precision of the prior and the final matrix multiplication (e.g. np.float32), see apply_weights in update.py
+    - stats: e.g. ('mean','var',0.05,0.95), return only these statistics of the analysis, computed blockwise, see apply_weights in update.py
+    - overwrite_prior: write the analysis block by block into Xf instead of a new array, see apply_weights in update.py
 
     Output:
-    - Analysis ensemble (N_x, N_e)
+    - Analysis ensemble (N_x, N_e), with stats a dict {statistic: array (N_x)}
+    """
+    HXf=observations(HXf, Xf)
+    wm, Wp = EnSRF_weights(HXf, Y, R)
+    W=Wp+wm[:,None]
+    if dtype is not None or stats is not None or out is not None or overwrite_prior:
+        #imaginary parts from the square root are negligible (see EnSRF_weights)
+        W=W.real
+    Xa=apply_weights(Xf, W, chunk_size=chunk_size, out=out, dtype=dtype, stats=stats, overwrite_prior=overwrite_prior)
+
+    return Xa
+
+
+def EnSRF_weights(HXf, Y, R):
+    """
+    Ensemble space part of the EnSRF, only needs the observations from the model.
+    Output:
+    - wm: mean weights (N_e)
+    - Wp: perturbation weights (N_e x N_e)
     """
-    #Obs error matrix
-    Rmat=np.diag(R)
-    #Mean of prior ensemble for each gridbox   
-    mX = np.mean(Xf, axis=1)
-    #Perturbations from ensemble mean
-    Xfp=Xf-mX[:,None]
-    #Mean and perturbations for model values in observation space
-    mY = np.mean(HXf, axis=1)
-    HXp = HXf-mY[:,None]
-
-    #Gram matrix of perturbations
-    I1=HXp @ HXp.T
     Ny=np.shape(Y)[0]
-    Ne=np.shape(Xf)[1]
+    Ne=np.shape(HXf)[1]
 
-    I2=I1+(Ne-1)*Rmat
-    #compute eigenvalues and eigenvectors (use that matrix is symmetric and real)
-    eigs, ev = np.linalg.eigh(I2) 
+    with stage('observation space matrix',flops=2*Ny*Ny*Ne,nbytes=8*(Ny*Ny+Ny*Ne)):
+        #Mean and perturbations for model values in observation space
+        mY = np.mean(HXf, axis=1)
+        HXp = HXf-mY[:,None]
 
-    #Error in Pseudocode: Square Root + multiplication order (important!)
-    G1=ev @ np.diag(np.sqrt(1/eigs)) 
-    G2=HXp.T @ G1
+        #Gram matrix of perturbations
+        I2=HXp @ HXp.T
 
-    U,s,Vh=np.linalg.svd(G2)
-    #Compute  sqrt of matrix, Problem of imaginary values?? (singular values are small)
-    rad=(np.ones(Ne)-np.square(s)).astype(complex)
-    rad=np.sqrt(rad)
-    A=np.diag(rad)
+        #Obs error matrix is diagonal, only add it to the diagonal
+        I2[np.diag_indices(Ny)]+=(Ne-1)*R
 
-    W1p=U @ A
-    W2p=W1p@U.T
+    with stage('eigendecomposition',flops=9*Ny**3,nbytes=8*(Ny*Ny+Ny)):
+        #compute eigenvalues and eigenvectors (use that matrix is symmetric and real)
+        eigs, ev = np.linalg.eigh(I2) 
 
-    d=Y-mY
+    with stage('svd',flops=2*Ny*Ny+2*Ny*Ny*Ne+6*Ny*Ne*Ne+9*Ne**3,nbytes=8*(Ny*Ny+2*Ny*Ne+Ne*Ne)):
+        #Error in Pseudocode: Square Root + multiplication order (important!)
+        G1=ev * np.sqrt(1/eigs)
+        G2=HXp.T @ G1
 
-    w1=ev.T @ d
-    w2=np.diag(1/eigs).T @ w1
-    w3=ev @ w2
-    w4=HXp.T @ w3
-    W=W2p+w4[:,None]
-    Xa=mX[:,None]+Xfp @ W
+        #thin svd, the N_y x N_y right singular vectors are not needed
+        U,s,Vh=np.linalg.svd(G2,full_matrices=False)
 
-    return Xa
+    with stage('weights',flops=4*Ne**3+4*Ny*Ny+2*Ny*Ne,nbytes=16*3*Ne*Ne):
+        #Compute  sqrt of matrix, Problem of imaginary values?? (singular values are small)
+        rad=(np.ones(len(s))-np.square(s)).astype(complex)
+        rad=np.sqrt(rad)
+
+        #directions without singular value (N_y<N_e) are not changed
+        W2p=np.identity(Ne)+(U*(rad-1)) @ U.T
 
+        d=Y-mY
 
+        w1=ev.T @ d
+        w2=w1/eigs
+        w3=ev @ w2
+        w4=HXp.T @ w3
 
+    return w4, W2p
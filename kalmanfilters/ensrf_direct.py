@@ -1,68 +1,102 @@
 import numpy as np
-import scipy
+from .update import apply_weights
+from .obs_operator import observations
+from .profiling import stage
 
-def ENSRF_direct(Xf, HXf, Y, R):
+def ENSRF_direct(Xf, HXf, Y, R, chunk_size=None, out=None, dtype=None, stats=None, overwrite_prior=False):
     """
     direct calculation of Ensemble Square Root Filter from Whitaker and Hamill
     As for instance done in Steiger 2018: "A reconstruction of global hydroclimate and dynamical variables over the Common Era".
     
     In comparison to the code for that paper [1], the matrix multiplications are performed  consequently from left to right and 
     the kalman gain is not explicitely computed, because this would be inefficient when we are just interested in the posterior ensemble.
-    One could also avoid computing the matrix inverses and solve linear systems instead (one could even use Cholesky decomposition
-    because the covariance matrices are positive definite), but as the number of observations is small the speed up is insignificant.
-    When using many observations (>1000) one should consider doing it. Here, the main computation effort comes from the matrix square root
-    (potentially numerically unstable) and unavoidable matrix - matrix multiplications.
+    The matrix inverses and the matrix square root are not computed explicitely: HPHT+R is symmetric positive definite, so its inverse,
+    square root and inverse square root all follow from one eigendecomposition, and the remaining factor is applied with a Cholesky solve.
+    The diagonal R is only added to the diagonal, never built as a matrix. This is faster and numerically more stable than inv/sqrtm
+    for many observations (>1000), the main computation effort then comes from the eigendecomposition (O(N_y^3)).
+    For very large N_y use a filter that works in ensemble space (ETKF, ESTKF) which scales linearly with N_y.
     
     Dimensions: N_e: ensemble size, N_y: Number of observations: N_x: State vector size (Gridboxes x assimilated variables)
     
     Input:
     - Xf:  the prior ensemble (N_x x N_e) 
-    - R: Measurement Error (Variance of pseudoproxy timerseries) ($N_y$ x 1$) -> converted to Ny x Ny matrix
-    - HX^f: Model value projected into observation space/at proxy locations ($N_y$ x $N_e$)
+    - R: Measurement Error (Variance of pseudoproxy timerseries) ($N_y$ x 1$), diagonal of the error covariance matrix
+    - HX^f: Model value projected into observation space/at proxy locations ($N_y$ x $N_e$), or an ObsOperator (obs_operator.py)
     - Y: Observation vector ($N_y$ x 1)
+    - chunk_size, out: for priors that don't fit into memory (memory mapped Xf), see apply_weights in update.py
+    - dtype: precision of the prior and the final matrix multiplication (e.g. np.float32), see apply_weights in update.py
+    - stats: e.g. ('mean','var',0.05,0.95), return only these statistics of the analysis, computed blockwise, see apply_weights in update.py
+    - overwrite_prior: write the analysis block by block into Xf instead of a new array, see apply_weights in update.py
     Output:
-    - Analysis ensemble (N_x, N_e)
+    - Analysis ensemble (N_x, N_e), with stats a dict {statistic: array (N_x)}
     
     [1] https://github.com/njsteiger/PHYDA-v1/blob/master/M_update.m
     """
-    Ne=np.shape(Xf)[1]
+    HXf=observations(HXf, Xf)
+    wm, Wp = ENSRF_direct_weights(HXf, Y, R)
+    W=Wp+wm[:,None]
 
-    #Obs error matrix, assumption that it's diagonal
-    Rmat=np.diag(R)
-    Rsqr=np.diag(np.sqrt(R)) 
+    return apply_weights(Xf, W, chunk_size=chunk_size, out=out, dtype=dtype, stats=stats, overwrite_prior=overwrite_prior)
 
-    #Mean of prior ensemble for each gridbox   
-    mX = np.mean(Xf, axis=1)
-    #Perturbations from ensemble mean
-    Xfp=Xf-mX[:,None]
-    #Mean and perturbations for model values in observation space
-    mY = np.mean(HXf, axis=1)
-    HXp = HXf-mY[:,None]
+
+def ENSRF_direct_weights(HXf, Y, R):
+    """
+    The updates of mean and perturbations can both be written as multiplications of the prior perturbations
+    from the right (Xfp @ ...), so the direct solver can also be expressed by ensemble space weights:
+    xa_m = mX + Xfp @ wm, Xap = Xfp - Xfp @ M = Xfp @ (I-M)
+    Output:
+    - wm: mean weights (N_e)
+    - Wp: perturbation weights (N_e x N_e)
+    """
+    G, Wp = ENSRF_direct_gain(HXf, R)
     #innovation
-    d=Y-mY
+    d=Y-np.mean(HXf, axis=1)
+
+    return G @ d, Wp
+
+
+def ENSRF_direct_gain(HXf, R):
+    """
+    Mean weights of the direct solver are linear in the innovation d=Y-mean(HXf), see ETKF_gain.
+    Output:
+    - G: mean weight gain (N_e x N_y), wm = G @ d
+    - Wp: perturbation weights (N_e x N_e)
+    """
+    import scipy.linalg
+
+    Ny,Ne=np.shape(HXf)
+
+    with stage('observation space matrix',flops=2*Ny*Ny*Ne,nbytes=8*(Ny*Ny+Ny*Ne)):
+        #Mean and perturbations for model values in observation space
+        mY = np.mean(HXf, axis=1)
+        HXp = HXf-mY[:,None]
+
+        #compute matrix products directly
+        #BHT=(Xfp @ HXp.T)/(Ne-1) #avoid this, it's inefficient to compute it here
+        HPHTR=(HXp @ HXp.T)/(Ne-1)
 
-    #compute matrix products directly
-    #BHT=(Xfp @ HXp.T)/(Ne-1) #avoid this, it's inefficient to compute it here
-    HPHT=(HXp @ HXp.T)/(Ne-1)
+        #second Kalman gain factor, Obs error matrix is diagonal: only add R to the diagonal
+        HPHTR[np.diag_indices(Ny)]+=R
 
-    #second Kalman gain factor
-    HPHTR=HPHT+Rmat
-    #inverse of term
-    HPHTR_inv=np.linalg.inv(HPHTR)
-    #matrix square root of denominator
-    HPHTR_sqr=scipy.linalg.sqrtm(HPHTR)
+    with stage('eigendecomposition',flops=9*Ny**3,nbytes=8*(Ny*Ny+Ny)):
+        #HPHTR is symmetric positive definite: inverse and square root from one eigendecomposition
+        #HPHTR_inv=ev @ diag(1/eigs) @ ev.T, HPHTR_sqr=ev @ diag(sqrt(eigs)) @ ev.T
+        eigs, ev = np.linalg.eigh(HPHTR)
 
-    #Kalman gain for mean
-    xa_m=mX + (Xfp @ (HXp.T /(Ne-1) @ (HPHTR_inv @ d)))
+    with stage('cholesky solve',flops=2*Ny**3+Ny**3/3+2*Ny*Ny*Ne,nbytes=8*(2*Ny*Ny+Ny*Ne)):
+        #fac2=sqrt(HPHTR) + sqrt(R) is also positive definite, solve with Cholesky instead of inverting it
+        fac2=(ev*np.sqrt(eigs)) @ ev.T
+        fac2[np.diag_indices(Ny)]+=np.sqrt(R)
+        factor_HXp=scipy.linalg.cho_solve(scipy.linalg.cho_factor(fac2),HXp)
 
-    #Perturbation Kalman gain
-    #inverse of square root calculated via previous inverse: sqrt(A)^(-1)=sqrt(A) @ A^(-1)
-    HPHTR_sqr_inv=HPHTR_sqr @ HPHTR_inv
-    fac2=HPHTR_sqr + Rsqr
-    factor=np.linalg.inv(fac2)
+    with stage('weights',flops=6*Ny*Ny*Ne+4*Ny*Ne*Ne,nbytes=8*(3*Ny*Ne+2*Ne*Ne)):
+        HXpT_ev=HXp.T/(Ne-1) @ ev
+        #Kalman gain for mean (weights for Xfp)
+        G=(HXpT_ev/eigs) @ ev.T
 
-    #right to left multiplication!
-    pert = (Xfp @ (HXp.T/(Ne-1) @ (HPHTR_sqr_inv.T @ (factor @ HXp))))
-    Xap=Xfp-pert
+        #Perturbation Kalman gain, inverse square root from the eigendecomposition
+        #right to left multiplication!
+        M = (HXpT_ev/np.sqrt(eigs)) @ (ev.T @ factor_HXp)
+        Wp=np.identity(Ne)-M
     
-    return Xap+xa_m[:,None]
+    return G, Wp
@@ -1,8 +1,11 @@
 #localized version of the direct kalman solver
 import numpy as np
-import scipy
+from .loc_product import localized_product
+from .obs_operator import observations
+from .prior_store import as_prior, mean_anomalies
+from .profiling import stage
 
-def ENSRF_direct_loc(Xf, HXf, Y, R,PH_loc, HPH_loc):
+def ENSRF_direct_loc(Xf, HXf, Y, R,PH_loc, HPH_loc, dtype=None):
     """
     direct calculation of Ensemble Square Root Filter from Whitaker and Hamill
     applying localization matrices to PH^T and HPH^T as in Tierney 2020: 
@@ -11,66 +14,91 @@ def ENSRF_direct_loc(Xf, HXf, Y, R,PH_loc, HPH_loc):
     (https://en.wikipedia.org/wiki/Hadamard_product_(matrices)). 
     However, this is still better than using the serial EnSRF formulation (At least an order of magnitude faster).
     It is important to not compute the Kalman gains explicitely.
-    As commented in the docstring ENSRF_direct, avoiding inverting matrices could be done, but the speed up is insignificant
-    in comparison to the rest.
+    As in ENSRF_direct, the inverse and square root of HPHT+R come from one eigendecomposition and a Cholesky solve.
     
     I propose to compute PH_loc and HPH_loc once for all possible proxy locations, and here only select the 
     relevant columns (for PH_loc) and the relvant rows and columns for HPH_loc using fancy indexing:
     PH_loc -> PH_loc[:,[column_indices]]
     HPH_loc -> HPH_loc[[row_indices]][:,[column_indices]],
     given which proxies are available at one timestep.
+    LocalizationCache in loc_cache.py does this selection and keeps the result for repeating availability patterns.
 
     Input:
     - Xf:  the prior ensemble (N_x x N_e) 
-    - R: Measurement Error (Variance of pseudoproxy timerseries) (N_y) -> converted to Ny x Ny matrix
-    - HX^f: Model value projected into observation space/at proxy locations ($N_y$ x $N_e$)
+    - R: Measurement Error (Variance of pseudoproxy timerseries) (N_y), diagonal of the error covariance matrix
+    - HX^f: Model value projected into observation space/at proxy locations ($N_y$ x $N_e$), or an ObsOperator (obs_operator.py)
     - Y: Observation vector (N_y)
     - PH_loc: Matrix for localization of PH^T (N_x * N_y)
     - HPH_loc: Matrix for localization of HPH^T (N_y * N_y)
+    PH_loc and HPH_loc can also be scipy.sparse matrices (covariance_loc(...,sparse=True), or banded matrices). Then Xfp @ HXp^T is only evaluated
+    at the nonzero entries of PH_loc (localized_product in loc_product.py), the cost scales with the number of grid point - proxy pairs within the cutoff.
+    - dtype: precision of the prior and of the state space matrix multiplications (e.g. np.float32). The small matrices in observation/ensemble space stay in double precision.
     
     Output:
     - Analysis ensemble (N_x, N_e)
     """
-    
-    Ne=np.shape(Xf)[1]
+    import scipy.linalg
+    import scipy.sparse
 
-    #Obs error matrix, assumption that it's diagonal
-    Rmat=np.diag(R)
-    Rsqr=np.diag(np.sqrt(R)) 
+    HXf=observations(HXf, Xf)
+    
+    Xf=as_prior(Xf,dtype=dtype)
+    Nx,Ne=np.shape(Xf)
+    Ny=np.shape(HXf)[0]
+    itemsize=Xf.dtype.itemsize
 
-    #Mean of prior ensemble for each gridbox   
-    mX = np.mean(Xf, axis=1)
-    #Perturbations from ensemble mean
-    Xfp=Xf-mX[:,None]
-    #Mean and perturbations for model values in observation space
-    mY = np.mean(HXf, axis=1)
-    HXp = HXf-mY[:,None]
-    #innovation
-    d=Y-mY
+    with stage('mean/perturbations',flops=2*Nx*Ne,nbytes=itemsize*Nx*Ne):
+        #Mean of prior ensemble for each gridbox and perturbations from ensemble mean (stored in a PriorStore)
+        mX, Xfp = mean_anomalies(Xf, dtype)
+        #Mean and perturbations for model values in observation space
+        mY = np.mean(HXf, axis=1)
+        HXp = HXf-mY[:,None]
+        #innovation
+        d=Y-mY
+        #the state space products are done in the precision of the prior
+        HXpT=(HXp.T/(Ne-1)).astype(Xfp.dtype)
 
     #compute matrix products directly
     #entry wise product of covariance localization matrices
-    PHT= PH_loc * (Xfp @ HXp.T/(Ne-1))
-    HPHT= HPH_loc * (HXp @ HXp.T/(Ne-1))
+    if scipy.sparse.issparse(PH_loc):
+        #sparse localization (covariance_loc(...,sparse=True)), the product is only evaluated within the cutoff and PHT stays sparse
+        with stage('localized PH^T (sparse)',flops=2*PH_loc.nnz*Ne,nbytes=(itemsize+4)*PH_loc.nnz):
+            PHT= localized_product(PH_loc, Xfp, HXpT)
+    else:
+        with stage('localized PH^T',flops=2*Nx*Ny*Ne+Nx*Ny,nbytes=2*itemsize*Nx*Ny):
+            PHT= np.multiply(PH_loc, Xfp @ HXpT, dtype=Xfp.dtype)
+
+    with stage('observation space matrix',flops=2*Ny*Ny*Ne,nbytes=8*Ny*Ny):
+        if scipy.sparse.issparse(HPH_loc):
+            HPHTR= HPH_loc.multiply(HXp @ HXp.T/(Ne-1)).toarray()
+        else:
+            HPHTR= HPH_loc * (HXp @ HXp.T/(Ne-1))
     
-    #second Kalman gain factor
-    HPHTR=HPHT+Rmat
-    #inverse of factor
-    HPHTR_inv=np.linalg.inv(HPHTR)
-    #matrix square root of denominator
-    HPHTR_sqr=scipy.linalg.sqrtm(HPHTR)
+        #second Kalman gain factor, Obs error matrix is diagonal: only add R to the diagonal
+        HPHTR[np.diag_indices(Ny)]+=R
+
+    with stage('eigendecomposition',flops=9*Ny**3,nbytes=8*(Ny*Ny+Ny)):
+        #inverse and (inverse) square root from one eigendecomposition, see ENSRF_direct_gain
+        eigs, ev = np.linalg.eigh(HPHTR)
+
+    with stage('cholesky solve',flops=2*Ny**3+Ny**3/3+2*Ny*Ny*Ne+6*Ny*Ny*Ne,nbytes=8*(2*Ny*Ny+3*Ny*Ne)):
+        fac2=(ev*np.sqrt(eigs)) @ ev.T
+        fac2[np.diag_indices(Ny)]+=np.sqrt(R)
+        factor_HXp=scipy.linalg.cho_solve(scipy.linalg.cho_factor(fac2),HXp)
 
-    #Kalman gain for mean
-    xa_m=mX + PHT @ (HPHTR_inv @ d)
+        #observation space weights for the mean (HPHTR_inv @ d) and the perturbations (HPHTR_sqr_inv @ factor @ HXp)
+        wd=ev @ ((ev.T @ d)/eigs)
+        wp=ev @ ((ev.T @ factor_HXp)/np.sqrt(eigs)[:,None])
 
-    #Perturbation Kalman gain
-    #inverse of square root calculated via previous inverse: sqrt(A)^(-1)=sqrt(A) @ A^(-1)
-    HPHTR_sqr_inv=HPHTR_sqr @ HPHTR_inv
-    fac2=HPHTR_sqr + Rsqr
-    factor=np.linalg.inv(fac2)
+    nnz=PHT.nnz if scipy.sparse.issparse(PHT) else Nx*Ny
+    with stage('state update',flops=2*nnz*(Ne+1),nbytes=itemsize*2*Nx*Ne):
+        #Kalman gain for mean
+        xa_m=mX + PHT @ wd.astype(Xfp.dtype)
 
-    # right to left multiplication!
-    pert = PHT @ (HPHTR_sqr_inv.T @ (factor @ HXp))
-    Xap=Xfp-pert
+        #Perturbation Kalman gain
+        # right to left multiplication!
+        pert = PHT @ wp.astype(Xfp.dtype)
+        Xap=Xfp-pert
+        Xa=Xap+xa_m[:,None]
     
-    return Xap+xa_m[:,None]
+    return Xa
@@ -1,5 +1,10 @@
 import numpy as np
-def EnSRF_serial(Xf, HXf, Y, R):
+from .update import apply_weights, block_stats, check_stats
+from .obs_operator import ObsOperator, observations
+from .backend import kernel
+from .profiling import stage
+
+def EnSRF_serial(Xf, HXf, Y, R, augmented=False, chunk_size=None, out=None, dtype=None, stats=None):
     """
     Implementation adapted from pseudocode description in
     "State-of-the-art stochastic data assimialation methods" by Vetra-Carvalho et al. (2018),
@@ -7,21 +12,41 @@ def EnSRF_serial(Xf, HXf, Y, R):
     Errors: Line 1 must be inside of loop, in HPH^T the divisor Ne-1 is missing.
     This version uses the appended state vector approach, which also updates the precalculated observations from the model.
     
+    Without localization each serial update of the perturbations is a multiplication from the right with an Ne x Ne matrix
+    (Xfp <- Xfp @ (I - a2 * g hp^T), with g=hp/((Ne-1)F)) and the mean update is a linear combination of the perturbations.
+    Hence by default the observations are processed on the observations from the model only (N_y x N_e), the transforms are accumulated
+    and the state is updated once at the end. This gives the same result as updating the augmented state vector
+    (augmented=True), which needs N_y passes over the full state. If HXf is an ObsOperator, the augmented version doesn't append
+    HXf to the state, the current state is mapped to the next observation with the row of H instead.
+    
     
     Dimensions: N_e: ensemble size, N_y: Number of observations: N_x: State vector size (Gridboxes x assimilated variables)
     
     Input:
     - Xf:  the prior ensemble (N_x x N_y) 
     - R: Measurement Error (Variance of pseudoproxy timerseries) ($N_y$ x 1$) -> converted to Ny x Ny matrix
-    - HX^f: Model value projected into observation space/at proxy locations ($N_y$ x $N_e$)
+    - HX^f: Model value projected into observation space/at proxy locations ($N_y$ x $N_e$), or an ObsOperator (obs_operator.py)
     - Y: Observation vector ($N_y$ x 1)
+    - augmented: use the appended state vector approach (slow, for comparison)
+    - chunk_size, out: for priors that don't fit into memory (memory mapped Xf), see apply_weights in update.py
+    - dtype: precision of the prior and the final matrix multiplication (e.g. np.float32), see apply_weights in update.py
+    - stats: e.g. ('mean','var',0.05,0.95), return only these statistics of the analysis, computed blockwise, see apply_weights in update.py
 
     Output:
-    - Analysis ensemble (N_x, N_e)
+    - Analysis ensemble (N_x, N_e), with stats a dict {statistic: array (N_x)}
     """
+    if not augmented:
+        HXf=observations(HXf, Xf)
+        wm, Wp = EnSRF_serial_weights(HXf, Y, R)
+        W=Wp+wm[:,None]
+        return apply_weights(Xf, W, chunk_size=chunk_size, out=out, dtype=dtype, stats=stats)
 
-    # augmented state vector with Ye appended
-    Xfn = np.append(Xf, HXf, axis=0)
+    if isinstance(HXf,ObsOperator):
+        #the observations are computed from the updated state, no augmentation (state is copied as it is updated)
+        Xfn = np.array(Xf,dtype=dtype)
+    else:
+        # augmented state vector with Ye appended
+        Xfn = np.append(np.asarray(Xf,dtype=dtype), np.asarray(observations(HXf, Xf),dtype=dtype), axis=0)
     
     # number of state variables
     Nx= np.shape(Xf)[0]
@@ -29,39 +54,100 @@ def EnSRF_serial(Xf, HXf, Y, R):
     Ne=np.shape(Xf)[1]
     #Number of measurements
     Ny=np.shape(Y)[0]
-    for i in range(Ny):
-        #ensemble mean and perturbations
-        mX = np.mean(Xfn, axis=1)
-        Xfp=np.subtract(Xfn,mX[:,None])
+    with stage('serial updates (augmented state)',flops=8*Ny*(Nx+Ny)*Ne,nbytes=8*2*(Nx+Ny)*Ne):
+        for i in range(Ny):
+            #ensemble mean and perturbations
+            mX = np.mean(Xfn, axis=1)
+            Xfp=np.subtract(Xfn,mX[:,None])
         
-        #get obs from model
-        HX=Xfn[Nx+i,:]
-        #ensemble mean for obs
-        mY=np.mean(HX)
-        #remove mean
-        HXp=(HX-mY)[None]
-
-        HP=HXp @ Xfp.T /(Ne-1)
+            #get obs from model
+            if isinstance(HXf,ObsOperator):
+                cols,w=HXf.row(i)
+                HX=w @ Xfn[cols]
+            else:
+                HX=Xfn[Nx+i,:]
+            #ensemble mean for obs
+            mY=np.mean(HX)
+            #remove mean
+            HXp=(HX-mY)[None]
+
+            HP=HXp @ Xfp.T /(Ne-1)
         
-        #Variance at location (here divisor is missing in reference!)
-        HPHT=HXp @ HXp.T/(Ne-1)
+            #Variance at location (here divisor is missing in reference!)
+            HPHT=HXp @ HXp.T/(Ne-1)
 
-        ##Localize HP ?
+            #localized version: EnSRF_serial_loc (ensrf_serial_loc.py)
         
-        #compute scalar
-        sig=R[i]
-        F=HPHT + sig
-        K=(HP/F)
-
-        #compute factors for final calc
-        d=Y[i]-mY
-        a1=1+np.sqrt(sig/F)
-        a2=1/a1
+            #compute scalar
+            sig=R[i]
+            F=HPHT + sig
+            K=(HP/F)
+
+            #compute factors for final calc
+            d=Y[i]-mY
+            a1=1+np.sqrt(sig/F)
+            a2=1/a1
         
-        #final calcs
-        mXa=mX+np.squeeze((K*d))
-        Xfp=Xfp-a2*K.T @ HXp
-        Xfn=Xfp+mXa[:,None]
+            #final calcs
+            mXa=mX+np.squeeze((K*d))
+            Xfp=Xfp-a2*K.T @ HXp
+            Xfn=Xfp+mXa[:,None]
         
+    if stats is not None:
+        #the augmented state is in memory anyway, reduce it at the end
+        check_stats(stats)
+        return block_stats(Xfn[:Nx,:],stats)
     return Xfn[:Nx,:]
-    
+
+
+def EnSRF_serial_weights(HXf, Y, R):
+    """
+    Serial processing of the observations in ensemble space, only the observations from the model are updated.
+    The accumulated weights are given with respect to the prior perturbations: Xa = mX + Xfp @ (Wp + wm)
+    Output:
+    - wm: mean weights (N_e)
+    - Wp: perturbation weights (N_e x N_e)
+    """
+    # number of ensemble members
+    Ne=np.shape(HXf)[1]
+    #Number of measurements
+    Ny=np.shape(Y)[0]
+
+    #ensemble mean and perturbations of obs from model (updated in the loop)
+    mY=np.mean(HXf, axis=1)
+    HXp=HXf-mY[:,None]
+
+    #accumulated transform of perturbations and mean weights
+    Wp=np.identity(Ne)
+    wm=np.zeros(Ne)
+
+    kern=kernel('serial_updates')
+    if kern is not None:
+        with stage('serial updates',flops=Ny*(4*Ny*Ne+4*Ne*Ne),nbytes=8*(Ny*Ne+Ne*Ne)):
+            return kern(HXp, mY, Y, R)
+
+    with stage('serial updates',flops=Ny*(4*Ny*Ne+4*Ne*Ne),nbytes=8*(Ny*Ne+Ne*Ne)):
+        for i in range(Ny):
+            hp=HXp[i]
+            #Variance at location
+            HPHT=hp @ hp/(Ne-1)
+
+            #compute scalar
+            sig=R[i]
+            F=HPHT + sig
+            #Kalman gain in ensemble space (K = Xp @ g)
+            g=hp/((Ne-1)*F)
+
+            #compute factors for final calc
+            d=Y[i]-mY[i]
+            a1=1+np.sqrt(sig/F)
+            a2=1/a1
+
+            #mean update
+            mY=mY+(HXp @ g)*d
+            wm=wm+(Wp @ g)*d
+            #perturbation update
+            HXp=HXp-a2*np.outer(HXp @ g, hp)
+            Wp=Wp-a2*np.outer(Wp @ g, hp)
+
+    return wm, Wp
@@ -0,0 +1,83 @@
+import numpy as np
+from .obs_operator import observations
+from .prior_store import as_prior, mean_anomalies
+from .profiling import stage
+
+def EnSRF_serial_loc(Xf, HXf, Y, R, PH_loc, HPH_loc, dtype=None):
+    """
+    Serial Ensemble Square Root Filter with covariance localization (Whitaker and Hamill 2002), see EnSRF_serial in ensrf_serial.py.
+    The observations are assimilated one after another, the Kalman gain of each observation is localized with the Gaspari Cohn
+    weights of its column of PH_loc (grid points) and HPH_loc (observations from the model of the other proxies).
+    Gaspari Cohn is zero beyond 2*cov_len, so the nonzero entries of a column are the neighbour index of the observation: only the
+    means and perturbations of these grid points (and proxies) are updated. The cost of one observation is proportional to its local
+    footprint instead of N_x, which needs sparse localization matrices (covariance_loc(...,sparse=True)).
+
+    Dimensions: N_e: ensemble size, N_y: Number of observations: N_x: State vector size (Gridboxes x assimilated variables)
+
+    Input:
+    - Xf:  the prior ensemble (N_x x N_e)
+    - HX^f: Model value projected into observation space/at proxy locations (N_y x N_e), or an ObsOperator (obs_operator.py)
+    - Y: Observation vector (N_y)
+    - R: Measurement Error (Variance of pseudoproxy timerseries) (N_y)
+    - PH_loc: Matrix for localization of PH^T (N_x * N_y), scipy.sparse (dense arrays are converted)
+    - HPH_loc: Matrix for localization of HPH^T (N_y * N_y), scipy.sparse (dense arrays are converted)
+    - dtype: precision of the prior and of the state updates (e.g. np.float32)
+
+    Output:
+    - Analysis ensemble (N_x, N_e)
+    """
+    import scipy.sparse
+
+    HXf=np.asarray(observations(HXf, Xf),dtype=float)
+    Xf=as_prior(Xf,dtype=dtype)
+    Nx,Ne=np.shape(Xf)
+    Ny=np.shape(Y)[0]
+    itemsize=Xf.dtype.itemsize
+
+    with stage('mean/perturbations',flops=2*Nx*Ne,nbytes=itemsize*Nx*Ne):
+        #Mean of prior ensemble for each gridbox and perturbations from ensemble mean (updated in place, the read-only
+        #arrays of a PriorStore are copied)
+        mX, Xfp = mean_anomalies(Xf, dtype)
+        mX=np.require(mX,requirements='W')
+        Xfp=np.require(Xfp,requirements='W')
+        #Mean and perturbations for model values in observation space (updated in place)
+        mY = np.mean(HXf, axis=1)
+        HXp = HXf-mY[:,None]
+
+        #column i: neighbour index and localization weights of observation i
+        PH_loc=scipy.sparse.csc_matrix(PH_loc)
+        HPH_loc=scipy.sparse.csc_matrix(HPH_loc)
+
+    with stage('serial updates (localized)',flops=4*(PH_loc.nnz+HPH_loc.nnz)*Ne,nbytes=8*(PH_loc.nnz+HPH_loc.nnz)):
+        for i in range(Ny):
+            hp=HXp[i].copy()
+            #Variance at location
+            HPHT=hp @ hp/(Ne-1)
+
+            #compute scalar
+            sig=R[i]
+            F=HPHT + sig
+
+            #compute factors for final calc
+            d=Y[i]-mY[i]
+            a1=1+np.sqrt(sig/F)
+            a2=1/a1
+
+            #localized Kalman gain, only for the grid points within the cutoff
+            start,end=PH_loc.indptr[i],PH_loc.indptr[i+1]
+            rows=PH_loc.indices[start:end]
+            K=PH_loc.data[start:end]*(Xfp[rows] @ hp)/((Ne-1)*F)
+            mX[rows]+=(K*d).astype(Xfp.dtype)
+            Xfp[rows]-=(a2*np.outer(K,hp)).astype(Xfp.dtype)
+
+            #same for the observations from the model of the neighbouring proxies
+            start,end=HPH_loc.indptr[i],HPH_loc.indptr[i+1]
+            rows=HPH_loc.indices[start:end]
+            K=HPH_loc.data[start:end]*(HXp[rows] @ hp)/((Ne-1)*F)
+            mY[rows]+=K*d
+            HXp[rows]-=a2*np.outer(K,hp)
+
+    with stage('add perturbations',flops=Nx*Ne,nbytes=itemsize*Nx*Ne):
+        Xa=Xfp+mX[:,None]
+
+    return Xa
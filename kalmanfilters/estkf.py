@@ -1,6 +1,9 @@
 import numpy as np
+from .update import apply_weights
+from .obs_operator import observations
+from .profiling import stage
 
-def ESTKF(Xf, HXf, Y, R):
+def ESTKF(Xf, HXf, Y, R, chunk_size=None, out=None, dtype=None, stats=None, overwrite_prior=False):
     """
     Error-subspace transform Kalman Filter
     
@@ -15,29 +18,53 @@ def ESTKF(Xf, HXf, Y, R):
     
     Input:
     - Xf:  the prior ensemble (N_x x N_y) 
-    - R: Measurement Error (assumed uncorrelated) (N_y x 1) -> converted to Ny x Ny matrix
-    - HX^f: Model value projected into observation space/at proxy locations (N_y x N_e)
+    - R: Measurement Error (assumed uncorrelated) (N_y x 1), diagonal of the error covariance matrix
+    - HX^f: Model value projected into observation space/at proxy locations (N_y x N_e), or an ObsOperator (obs_operator.py)
     - Y: Observation vector (N_y x 1)
+    - chunk_size, out: for priors that don't fit into memory (memory mapped Xf), see apply_weights in update.py
+    - dtype: precision of the prior and the final matrix multiplication (e.g. np.float32), see apply_weights in update.py
+    - stats: e.g. ('mean','var',0.05,0.95), return only these statistics of the analysis, computed blockwise, see apply_weights in update.py
+    - overwrite_prior: write the analysis block by block into Xf instead of a new array, see apply_weights in update.py
 
     Output:
-    - Analysis ensemble (N_x, N_e)
+    - Analysis ensemble (N_x, N_e), with stats a dict {statistic: array (N_x)}
     """
+    HXf=observations(HXf, Xf)
+    wm, Wp = ESTKF_weights(HXf, Y, R)
     
-    # number of ensemble members
-    Ne=np.shape(Xf)[1]
-    
-    #Obs error matrix
-    Rmat=np.diag(R)
-    Rmat_inv=np.diag(1/R)
-    #Mean of prior ensemble for each state vector variable 
-    mX = np.mean(Xf, axis=1)
-    #Perturbations from ensemble mean
-    Xfp=Xf-mX[:,None]
-    
-    #Mean of model values in observation space
-    mY = np.mean(HXf, axis=1)
-    d=Y-mY
+    #total weight matrix (projection matrix transform already included)
+    Wa=Wp + wm[:,None]
+
+    #Analysis ensemble
+    Xa = apply_weights(Xf, Wa, chunk_size=chunk_size, out=out, dtype=dtype, stats=stats, overwrite_prior=overwrite_prior)
+
+    return Xa
+
+
+def ESTKF_weights(HXf, Y, R):
+    """
+    Ensemble space part of the ESTKF, only needs the observations from the model.
+    The projection matrix A is already applied to the weights.
+    Output:
+    - wm: mean weights (N_e)
+    - Wp: perturbation weights (N_e x N_e)
+    """
+    G, Wp = ESTKF_gain(HXf, R)
+    d=Y-np.mean(HXf, axis=1)
+
+    return G @ d, Wp
+
 
+def ESTKF_gain(HXf, R):
+    """
+    Mean weights of the ESTKF are linear in the innovation d=Y-mean(HXf), see ETKF_gain.
+    Output:
+    - G: mean weight gain (N_e x N_y), wm = G @ d
+    - Wp: perturbation weights (N_e x N_e)
+    """
+    # number of observations and ensemble members
+    Ny,Ne=np.shape(HXf)
+    
     """
     Create projection matrix:
     - create matrix of shape Ne x Ne-1 filled with off diagonal values
@@ -53,29 +80,27 @@ def ESTKF(Xf, HXf, Y, R):
     np.fill_diagonal(A,diag)
     A[-1,:]=sqr_ne
 
-    #error in pseudocode, replace L by A
-    HL=HXf @ A
-    B1=Rmat_inv @ HL
-    C1=(Ne-1)*np.identity(Ne-1)
-    C2=C1+HL.T @ B1
+    with stage('ensemble space matrix',flops=2*Ny*Ne*Ne+Ny*Ne+2*Ny*Ne*Ne,nbytes=8*(2*Ny*Ne+Ne*Ne)):
+        #error in pseudocode, replace L by A
+        HL=HXf @ A
+        #Obs error matrix is diagonal: R^-1 @ HL is a row scaling
+        B1=HL/R[:,None]
+        C1=(Ne-1)*np.identity(Ne-1)
+        C2=C1+HL.T @ B1
     
-    #EVD of C2, assumed symmetric
-    eigs,U=np.linalg.eigh(C2)
+    with stage('eigendecomposition',flops=9*Ne**3,nbytes=8*(Ne*Ne+Ne)):
+        #EVD of C2, assumed symmetric
+        eigs,U=np.linalg.eigh(C2)
     
-    d1=B1.T @ d
-    d2=U.T @ d1
-    d3=d2/eigs
-    T=U @ np.diag(1/np.sqrt(eigs)) @ U.T
+    with stage('weights',flops=8*Ne**3+4*Ne*Ne*Ny,nbytes=8*(4*Ne*Ne+2*Ne*Ny)):
+        T=(U/np.sqrt(eigs)) @ U.T
     
-    #mean weight
-    wm=U @ d3
-    #perturbation weight
-    Wp=T @ A.T*np.sqrt((Ne-1))
-    #total weight matrix + projection matrix transform
-    W=wm[:,None]+Wp
-    Wa = A @ W
+        #mean weight gain (wm=U @ (U.T @ B1.T @ d)/eigs)
+        G=U @ ((U.T @ B1.T)/eigs[:,None])
+        #perturbation weight
+        Wp=T @ A.T*np.sqrt((Ne-1))
+        #projection matrix transform
+        G=A @ G
+        Wp=A @ Wp
 
-    #Analysis ensemble
-    Xa = mX[:,None] + Xfp @ Wa
-
-    return Xa
+    return G, Wp
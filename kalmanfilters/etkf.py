@@ -1,6 +1,9 @@
 import numpy as np
+from .update import apply_weights
+from .obs_operator import observations
+from .profiling import stage
 
-def ETKF(Xf, HXf, Y, R):
+def ETKF(Xf, HXf, Y, R, chunk_size=None, out=None, dtype=None, stats=None, overwrite_prior=False):
     """
     Implementation adapted from pseudocode description in
     "State-of-the-art stochastic data assimialation methods" by Vetra-Carvalho et al. (2018),
@@ -11,50 +14,74 @@ def ETKF(Xf, HXf, Y, R):
     
     Input:
     - Xf:  the prior ensemble (N_x x N_y) 
-    - R: Measurement Error (Variance of pseudoproxy timerseries) ($N_y$ x 1$) -> converted to Ny x Ny matrix
-    - HX^f: Model value projected into observation space/at proxy locations ($N_y$ x $N_e$)
+    - R: Measurement Error (Variance of pseudoproxy timerseries) ($N_y$ x 1$), diagonal of the error covariance matrix
+    - HX^f: Model value projected into observation space/at proxy locations ($N_y$ x $N_e$), or an ObsOperator (obs_operator.py)
     - Y: Observation vector ($N_y$ x 1)
+    - chunk_size, out: for priors that don't fit into memory (memory mapped Xf), see apply_weights in update.py
+    - dtype: precision of the prior and the final matrix multiplication (e.g. np.float32), see apply_weights in update.py
+    - stats: e.g. ('mean','var',0.05,0.95), return only these statistics of the analysis, computed blockwise, see apply_weights in update.py
+    - overwrite_prior: write the analysis block by block into Xf instead of a new array, see apply_weights in update.py
 
     Output:
-    - Analysis ensemble (N_x, N_e)
+    - Analysis ensemble (N_x, N_e), with stats a dict {statistic: array (N_x)}
     """
-    # number of ensemble members
-    Ne=np.shape(Xf)[1]
-
-    #Obs error matrix
-    #Rmat=np.diag(R)
-    Rmat_inv=np.diag(1/R)
-    #Mean of prior ensemble for each gridbox   
-    mX = np.mean(Xf, axis=1)
-    #Perturbations from ensemble mean
-    Xfp=Xf-mX[:,None]
-    #Mean and perturbations for model values in observation space
-    mY = np.mean(HXf, axis=1)
-    HXp = HXf-mY[:,None]
-
-    C=Rmat_inv @ HXp
-    A1=(Ne-1)*np.identity(Ne)
-    A2=A1 + (HXp.T @ C)
-
-    #eigenvalue decomposition of A2, A2 is symmetric
-    eigs, ev = np.linalg.eigh(A2) 
-
-    #compute perturbations
-    Wp1 = np.diag(np.sqrt(1/eigs)) @ ev .T
-    Wp = ev @ Wp1 * np.sqrt(Ne-1)
-
-    #differing from pseudocode
-    d=Y-mY
-    D1 = Rmat_inv @ d
-    D2 = HXp.T @ D1
-    wm=ev @ np.diag(1/eigs) @ ev.T @ D2  #/ np.sqrt(Ne-1) 
+    HXf=observations(HXf, Xf)
+    wm, Wp = ETKF_weights(HXf, Y, R)
 
     #adding pert and mean (!row-major formulation in Python!)
     W=Wp + wm[:,None]
 
     #final adding up (most costly operation)
-    Xa=mX[:,None] + Xfp @ W
+    Xa=apply_weights(Xf, W, chunk_size=chunk_size, out=out, dtype=dtype, stats=stats, overwrite_prior=overwrite_prior)
 
     return Xa
-    
-    
+
+
+def ETKF_weights(HXf, Y, R):
+    """
+    Ensemble space part of the ETKF, only needs the observations from the model.
+    Output:
+    - wm: mean weights (N_e)
+    - Wp: perturbation weights (N_e x N_e)
+    """
+    G, Wp = ETKF_gain(HXf, R)
+    #differing from pseudocode
+    d=Y-np.mean(HXf, axis=1)
+    wm=G @ d
+
+    return wm, Wp
+
+
+def ETKF_gain(HXf, R):
+    """
+    The ETKF weights only depend on the observations Y through the mean weights, which are linear in the innovation d=Y-mean(HXf).
+    Output:
+    - G: mean weight gain (N_e x N_y), wm = G @ d
+    - Wp: perturbation weights (N_e x N_e)
+    """
+    # number of observations and ensemble members
+    Ny,Ne=np.shape(HXf)
+
+    with stage('ensemble space matrix',flops=Ny*Ne+2*Ny*Ne*Ne,nbytes=8*(2*Ny*Ne+Ne*Ne)):
+        #Mean and perturbations for model values in observation space
+        mY = np.mean(HXf, axis=1)
+        HXp = HXf-mY[:,None]
+
+        #Obs error matrix is diagonal: R^-1 @ HXp is a row scaling
+        C=HXp/R[:,None]
+        A1=(Ne-1)*np.identity(Ne)
+        A2=A1 + (HXp.T @ C)
+
+    with stage('eigendecomposition',flops=9*Ne**3,nbytes=8*(Ne*Ne+Ne)):
+        #eigenvalue decomposition of A2, A2 is symmetric
+        eigs, ev = np.linalg.eigh(A2) 
+
+    with stage('weights',flops=4*Ne**3+4*Ne*Ne*Ny,nbytes=8*(2*Ne*Ne+2*Ne*Ny)):
+        #compute perturbations
+        Wp1 = np.sqrt(1/eigs)[:,None] * ev .T
+        Wp = ev @ Wp1 * np.sqrt(Ne-1)
+
+        #mean weights: wm=ev @ np.diag(1/eigs) @ ev.T @ HXp.T @ R^-1 @ d
+        G=ev @ ((ev.T @ C.T)/eigs[:,None])
+
+    return G, Wp
@@ -0,0 +1,157 @@
+import numpy as np
+from .obs_operator import observations
+from .prior_store import as_prior, mean_anomalies
+from .profiling import stage
+
+def ETKF_batch(Xf, HXf, Y, R, mask=None, dtype=None):
+    """
+    Batched version of the ETKF (etkf.py) for offline Data Assimilation, where the same prior is used for many timesteps
+    and only the observations (and the set of available proxies) change.
+    The weight matrices of all timesteps are computed at once (vectorized eigh on a stack of Ne x Ne matrices),
+    and applied to the prior perturbations in one single matrix multiplication Xfp @ [W_1, ..., W_T].
+    Like this the expensive pass over the large prior is only done once instead of T times.
+
+    Unavailable observations are handled by setting their inverse error variance to zero, then they don't contribute
+    to the ensemble space matrix nor to the mean weights. The result is the same as calling ETKF with the available observations only.
+
+    Dimensions: N_e: ensemble size, N_y: Number of observations: N_x: State vector size (Gridboxes x assimilated variables), T: Number of timesteps
+
+    Input:
+    - Xf:  the prior ensemble (N_x x N_e)
+    - HX^f: Model value projected into observation space/at proxy locations for all possible proxies (N_y x N_e), or an ObsOperator (obs_operator.py)
+    - Y: Observation vectors (T x N_y), unavailable observations can be NaN
+    - R: Measurement Error (Variance of pseudoproxy timerseries) (N_y) or (T x N_y)
+    - mask: Availability of observations (boolean, T x N_y). If None, all non-NaN entries of Y are used.
+    - dtype: precision of the prior and the final matrix multiplication (e.g. np.float32)
+
+    Output:
+    - Analysis ensembles (T x N_x x N_e)
+    """
+    HXf=observations(HXf, Xf)
+    Y=np.atleast_2d(Y)
+    # number of ensemble members
+    Ne=np.shape(Xf)[1]
+    if mask is None:
+        mask=~np.isnan(Y)
+
+    #inverse obs error, zero for unavailable observations (broadcasts R to T x N_y)
+    Rinv=np.where(mask,1/np.broadcast_to(R,Y.shape),0.)
+    #Mean and perturbations for model values in observation space
+    mY = np.mean(HXf, axis=1)
+    HXp = HXf-mY[:,None]
+    #innovation, set to zero where no observation is available
+    d=np.where(mask,Y-mY,0.)
+
+    T,Ny=np.shape(Y)
+    with stage('ensemble space matrices',flops=2*T*Ny*Ne*Ne,nbytes=8*T*(Ny*Ne+Ne*Ne)):
+        #stack of ensemble space matrices (T x Ne x Ne)
+        C=Rinv[:,:,None]*HXp
+        A1=(Ne-1)*np.identity(Ne)
+        A2=A1 + HXp.T @ C
+
+    with stage('eigendecomposition',flops=9*T*Ne**3,nbytes=8*T*Ne*Ne):
+        #vectorized eigenvalue decomposition, all A2 are symmetric
+        eigs, ev = np.linalg.eigh(A2)
+        evT=np.swapaxes(ev,1,2)
+
+    #compute perturbations
+    Wp=(ev/np.sqrt(eigs)[:,None,:]) @ evT * np.sqrt(Ne-1)
+
+    #mean weights
+    D2=(Rinv*d) @ HXp
+    wm=ev @ ((evT @ D2[:,:,None])/eigs[:,:,None])
+
+    W=Wp + wm
+
+    return apply_batch(Xf, W, dtype=dtype)
+
+
+def ESTKF_batch(Xf, HXf, Y, R, mask=None, dtype=None):
+    """
+    Batched version of the ESTKF (estkf.py), see ETKF_batch for the handling of timesteps and unavailable observations.
+
+    Dimensions: N_e: ensemble size, N_y: Number of observations: N_x: State vector size (Gridboxes x assimilated variables), T: Number of timesteps
+
+    Input:
+    - Xf:  the prior ensemble (N_x x N_e)
+    - HX^f: Model value projected into observation space/at proxy locations for all possible proxies (N_y x N_e), or an ObsOperator (obs_operator.py)
+    - Y: Observation vectors (T x N_y), unavailable observations can be NaN
+    - R: Measurement Error (assumed uncorrelated) (N_y) or (T x N_y)
+    - mask: Availability of observations (boolean, T x N_y). If None, all non-NaN entries of Y are used.
+    - dtype: precision of the prior and the final matrix multiplication (e.g. np.float32)
+
+    Output:
+    - Analysis ensembles (T x N_x x N_e)
+    """
+    HXf=observations(HXf, Xf)
+    Y=np.atleast_2d(Y)
+    # number of ensemble members
+    Ne=np.shape(Xf)[1]
+    if mask is None:
+        mask=~np.isnan(Y)
+
+    #inverse obs error, zero for unavailable observations
+    Rinv=np.where(mask,1/np.broadcast_to(R,Y.shape),0.)
+    #Mean of model values in observation space
+    mY = np.mean(HXf, axis=1)
+    d=np.where(mask,Y-mY,0.)
+
+    #projection matrix, same as in ESTKF
+    sqr_ne=-1/np.sqrt(Ne)
+    off_diag=-1/(Ne*(-sqr_ne+1))
+    diag=1+off_diag
+
+    A=np.ones((Ne,Ne-1))*off_diag
+    np.fill_diagonal(A,diag)
+    A[-1,:]=sqr_ne
+
+    T,Ny=np.shape(Y)
+    with stage('ensemble space matrices',flops=2*Ny*Ne*Ne+2*T*Ny*Ne*Ne,nbytes=8*T*(Ny*Ne+Ne*Ne)):
+        HL=HXf @ A
+        #stack of matrices (T x Ne-1 x Ne-1)
+        B1=Rinv[:,:,None]*HL
+        C1=(Ne-1)*np.identity(Ne-1)
+        C2=C1+HL.T @ B1
+
+    with stage('eigendecomposition',flops=9*T*Ne**3,nbytes=8*T*Ne*Ne):
+        #vectorized EVD, all C2 are symmetric
+        eigs,U=np.linalg.eigh(C2)
+        UT=np.swapaxes(U,1,2)
+
+    d1=(Rinv*d) @ HL
+    d2=UT @ d1[:,:,None]
+    d3=d2/eigs[:,:,None]
+    T=(U/np.sqrt(eigs)[:,None,:]) @ UT
+
+    #mean weight
+    wm=U @ d3
+    #perturbation weight
+    Wp=T @ A.T*np.sqrt((Ne-1))
+    #total weight matrix + projection matrix transform
+    W=wm+Wp
+    Wa = A @ W
+
+    return apply_batch(Xf, Wa, dtype=dtype)
+
+
+def apply_batch(Xf, W, dtype=None):
+    """
+    Apply a stack of weight matrices W (T x N_e x N_e) to the prior ensemble Xf (N_x x N_e) with one matrix multiplication.
+    Returns the analysis ensembles (T x N_x x N_e)
+    """
+    T,Ne,_=np.shape(W)
+    Xf=as_prior(Xf,dtype=dtype)
+    Nx=np.shape(Xf)[0]
+    itemsize=Xf.dtype.itemsize
+    with stage('mean/perturbations',flops=2*Nx*Ne,nbytes=itemsize*Nx*Ne):
+        #Mean of prior ensemble for each gridbox and perturbations from ensemble mean (stored in a PriorStore)
+        mX, Xfp = mean_anomalies(Xf, dtype)
+        #all weight matrices side by side (N_e x T*N_e)
+        Wall=np.swapaxes(W,0,1).reshape(Ne,T*Ne).astype(Xfp.dtype)
+
+    with stage('state update',flops=2*Nx*Ne*T*Ne,nbytes=itemsize*Nx*T*Ne):
+        #final adding up (most costly operation), only done once
+        Xa=Xfp @ Wall
+        Xa+=mX[:,None]
+
+    return np.swapaxes(Xa.reshape(-1,T,Ne),0,1)
@@ -1,6 +1,9 @@
 import numpy as np
+from .update import apply_weights
+from .obs_operator import observations
+from .profiling import stage
 
-def ETKF_livings(Xf, HXf, Y, R):
+def ETKF_livings(Xf, HXf, Y, R, chunk_size=None, out=None, dtype=None, stats=None, overwrite_prior=False):
     """
     Adaption of the ETKF proposed by David Livings (2005)
     
@@ -11,56 +14,64 @@ def ETKF_livings(Xf, HXf, Y, R):
     
     Input:
     - Xf:  the prior ensemble (N_x x N_y) 
-    - R: Measurement Error (Variance of pseudoproxy timerseries) ($N_y$ x 1$) -> converted to Ny x Ny matrix
-    - HX^f: Model value projected into observation space/at proxy locations ($N_y$ x $N_e$)
+    - R: Measurement Error (Variance of pseudoproxy timerseries) ($N_y$ x 1$), diagonal of the error covariance matrix
+    - HX^f: Model value projected into observation space/at proxy locations ($N_y$ x $N_e$), or an ObsOperator (obs_operator.py)
     - Y: Observation vector ($N_y$ x 1)
+    - chunk_size, out: for priors that don't fit into memory (memory mapped Xf), see apply_weights in update.py
+    - dtype: precision of the prior and the final matrix multiplication (e.g. np.float32), see apply_weights in update.py
+    - stats: e.g. ('mean','var',0.05,0.95), return only these statistics of the analysis, computed blockwise, see apply_weights in update.py
+    - overwrite_prior: write the analysis block by block into Xf instead of a new array, see apply_weights in update.py
 
     Output:
-    - Analysis ensemble (N_x, N_e)
+    - Analysis ensemble (N_x, N_e), with stats a dict {statistic: array (N_x)}
+    """
+    HXf=observations(HXf, Xf)
+    wm, Wp = ETKF_livings_weights(HXf, Y, R)
+
+    #adding pert and mean (!row-major formulation in Python!)
+    W=Wp + wm[:,None]
+
+    #final adding up (most costly operation)
+    Xa=apply_weights(Xf, W, chunk_size=chunk_size, out=out, dtype=dtype, stats=stats, overwrite_prior=overwrite_prior)
+    
+    return Xa
+
+
+def ETKF_livings_weights(HXf, Y, R):
+    """
+    Ensemble space part of the ETKF (Livings), only needs the observations from the model.
+    Output:
+    - wm: mean weights (N_e)
+    - Wp: perturbation weights (N_e x N_e)
     """
     # number of ensemble members
-    Ne=np.shape(Xf)[1]
+    Ne=np.shape(HXf)[1]
     Ny=np.shape(Y)[0]
 
-    #Obs error matrix
-    Rmat=np.diag(R)
-    Rmat_inv=np.diag(1/R)
-    #Mean of prior ensemble for each gridbox   
-    mX = np.mean(Xf, axis=1)
-    #Perturbations from ensemble mean
-    Xfp=Xf-mX[:,None]
-    #Mean and perturbations for model values in observation space
-    mY = np.mean(HXf, axis=1)
-    HXp = HXf-mY[:,None]
-    
-    #Scaling of perturbations proposed by Livings (2005), numerical stability
-    S_hat=np.diag(1/np.sqrt(R)) @ HXp/np.sqrt(Ne-1)
+    with stage('scaled perturbations',flops=2*Ny*Ne,nbytes=8*2*Ny*Ne):
+        #Mean and perturbations for model values in observation space
+        mY = np.mean(HXf, axis=1)
+        HXp = HXf-mY[:,None]
     
-    #svd of S_hat transposed
-    U,s,Vh=np.linalg.svd(S_hat.T)
+        #Scaling of perturbations proposed by Livings (2005), numerical stability
+        #(R is diagonal, the scaling with R^-1/2 is a row scaling)
+        S_hat=HXp/np.sqrt(R)[:,None]/np.sqrt(Ne-1)
     
-    C=Rmat_inv @ HXp
-    #recreate singular value matrix
-    Sig=np.zeros((Ne,Ny))
-    np.fill_diagonal(Sig,s)
+    with stage('svd',flops=6*Ny*Ne*Ne+9*Ne**3,nbytes=8*(Ne*Ne+Ny*Ne+Ne)):
+        #thin svd of S_hat transposed, the N_y x N_y right singular vectors are not needed
+        U,s,Vh=np.linalg.svd(S_hat.T,full_matrices=False)
     
-    #perturbation weight
-    mat=np.diag(1/np.sqrt(1+np.square(s)))
-    Wp1=mat @ U.T
-    Wp=U @ Wp1
+    with stage('weights',flops=4*Ne**3+2*Ne*Ny,nbytes=8*(3*Ne*Ne+Ny)):
+        #perturbation weight, directions without singular value (N_y<N_e) are not changed
+        mat=1/np.sqrt(1+np.square(s))-1
+        Wp=np.identity(Ne)+(U*mat) @ U.T
     
-    #innovation
-    d=Y-mY
-    #mean weight
-    D = np.diag(1/np.sqrt(R)) @ d
-    D2= Vh @ D
-    D3 = np.diag(1/(1+np.square(s))) @ Sig @ D2
-    wm= U @ D3 / np.sqrt(Ne-1)
+        #innovation
+        d=Y-mY
+        #mean weight
+        D = d/np.sqrt(R)
+        D2= Vh @ D
+        D3 = s/(1+np.square(s)) * D2
+        wm= U @ D3 / np.sqrt(Ne-1)
 
-    #adding pert and mean (!row-major formulation in Python!)
-    W=Wp + wm[:,None]
-
-    #final adding up (most costly operation)
-    Xa=mX[:,None] + Xfp @ W
-    
-    return Xa
+    return wm, Wp
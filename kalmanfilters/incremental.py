@@ -0,0 +1,87 @@
+import numpy as np
+
+from .update import apply_weights
+from .obs_operator import observations
+from .profiling import stage
+
+class IncrementalETKF:
+    """
+    ETKF for observations that arrive in batches for the same analysis time.
+    The ensemble space matrix of the ETKF A2=(N_e-1)I + HXp^T R^-1 HXp and the mean term HXp^T R^-1 d are sums over the
+    (uncorrelated) observations, so a new batch of observations is folded in by adding its contribution (O(N_y,batch N_e^2)).
+    The observations of earlier batches are not needed anymore. The weights are only computed from the N_e x N_e system when the
+    analysis is requested, and the result is the same as ETKF with all observations at once.
+
+    Usage:
+        inc=IncrementalETKF(Xf)
+        inc.add(HXf_1,Y_1,R_1)
+        inc.add(HXf_2,Y_2,R_2)
+        Xa=inc.analysis()
+
+    Input:
+    - Xf: the prior ensemble (N_x x N_e), can be memory mapped or a PriorStore (see apply_weights in update.py)
+    """
+    def __init__(self, Xf):
+        self.Xf=Xf
+        self.Ne=np.shape(Xf)[1]
+        self.reset()
+
+    def reset(self):
+        """
+        Removes all observations
+        """
+        #ensemble space matrix and mean term HXp^T R^-1 d
+        self.A2=(self.Ne-1)*np.identity(self.Ne)
+        self.b=np.zeros(self.Ne)
+        self.nobs=0
+
+    def add(self, HXf, Y, R):
+        """
+        Folds in a batch of observations.
+        Input:
+        - HXf: Model values at the proxy locations of the batch (N_y,batch x N_e), or an ObsOperator for the batch (obs_operator.py)
+        - Y: Observations of the batch (N_y,batch)
+        - R: Measurement Error of the batch (N_y,batch)
+        """
+        HXf=np.atleast_2d(observations(HXf, self.Xf))
+        Ny=np.shape(HXf)[0]
+        with stage('ensemble space matrix',flops=Ny*(2*self.Ne**2+3*self.Ne),nbytes=8*2*Ny*self.Ne):
+            #Mean and perturbations for model values in observation space
+            mY = np.mean(HXf, axis=1)
+            HXp = HXf-mY[:,None]
+            #Obs error matrix is diagonal: R^-1 @ HXp is a row scaling
+            C=HXp/np.asarray(R,dtype=float).reshape(-1)[:,None]
+
+            self.A2+=HXp.T @ C
+            self.b+=C.T @ (np.reshape(Y,-1)-mY)
+        self.nobs+=Ny
+
+    def weights(self):
+        """
+        ETKF weights for all observations added so far (see ETKF_gain in etkf.py).
+        Output:
+        - wm: mean weights (N_e)
+        - Wp: perturbation weights (N_e x N_e)
+        """
+        Ne=self.Ne
+        with stage('eigendecomposition',flops=9*Ne**3,nbytes=8*(Ne*Ne+Ne)):
+            eigs, ev = np.linalg.eigh(self.A2)
+
+        with stage('weights',flops=2*Ne**3+4*Ne*Ne,nbytes=8*2*Ne*Ne):
+            Wp = (ev*np.sqrt((Ne-1)/eigs)) @ ev.T
+            wm = ev @ ((ev.T @ self.b)/eigs)
+
+        return wm, Wp
+
+    def analysis(self, chunk_size=None, out=None, dtype=None, stats=None):
+        """
+        Analysis ensemble (N_x, N_e) for all observations added so far.
+        chunk_size, out, dtype, stats: see apply_weights in update.py
+        """
+        wm, Wp = self.weights()
+        W=Wp + wm[:,None]
+        return apply_weights(self.Xf, W, chunk_size=chunk_size, out=out, dtype=dtype, stats=stats)
+
+    def __repr__(self):
+        return 'IncrementalETKF(N_e={}, observations={})'.format(self.Ne,self.nobs)
+
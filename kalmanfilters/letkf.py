@@ -0,0 +1,160 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .cov_loc import neighbours, gaspari_cohn
+from .shared import to_shared, empty_shared, attach
+from .obs_operator import observations
+from .profiling import stage
+
+def LETKF(Xf, HXf, Y, R, grid_lat, grid_lon, proxy_lat, proxy_lon, cov_len, tile_size=256, n_procs=1, dtype=None):
+    """
+    Local Ensemble Transform Kalman Filter (Hunt et al. 2007, Physica D).
+    Every grid point gets its own ETKF analysis (see etkf.py) in ensemble space, using only the observations within
+    2*cov_len. The observations are localized by multiplying the inverse observation errors with the Gaspari Cohn weights
+    (R-localization), the same function that is used in cov_loc.py.
+
+    The local analyses are independent. The grid is split into tiles of tile_size grid points, for each tile the Ne x Ne
+    matrices of all its grid points are decomposed at once (vectorized eigh). With n_procs>1 the tiles are distributed over
+    a process pool, the prior and the analysis are shared with the workers through shared memory (no pickled copies).
+    The workers are spawned, not forked (a fork after the threads of the numba backend or of BLAS were started can hang),
+    so call LETKF with n_procs>1 from a script with an if __name__=='__main__': guard.
+
+    Dimensions: N_e: ensemble size, N_y: Number of observations: N_x: State vector size (Gridboxes)
+
+    Input:
+    - Xf:  the prior ensemble (N_x x N_e)
+    - HX^f: Model value projected into observation space/at proxy locations (N_y x N_e), or an ObsOperator (obs_operator.py)
+    - Y: Observation vector (N_y)
+    - R: Measurement Error (Variance of pseudoproxy timerseries) (N_y)
+    - grid_lat, grid_lon: latitudes and longitudes of the grid points in the same order as the rows of Xf (N_x)
+    - proxy_lat, proxy_lon: latitudes and longitudes of the proxies (N_y)
+    - cov_len: Radius for Gaspari Cohn function [float, in km]
+    - tile_size: Number of grid points analysed together, the tile needs ~3*tile_size*N_e^2 doubles (smaller tiles for large N_e)
+    - n_procs: Number of processes
+    - dtype: precision of the prior and of the multiplication with the local weights (e.g. np.float32), the local
+      analyses in ensemble space are done in double precision
+
+    Output:
+    - Analysis ensemble (N_x, N_e)
+    """
+    import scipy.sparse
+
+    HXf=observations(HXf, Xf)
+
+    Xf=np.asarray(Xf,dtype=dtype)
+    Nx,Ne=np.shape(Xf)
+    Ny=np.shape(Y)[0]
+
+    with stage('neighbour search',nbytes=8*3*(Nx+Ny)):
+        #localization weights of the observations for each grid point (sparse, only pairs within 2*cov_len)
+        rows,cols,dists=neighbours(grid_lat,grid_lon,proxy_lat,proxy_lon,2*cov_len)
+        loc=scipy.sparse.csr_matrix((gaspari_cohn(dists,cov_len),(rows,cols)),shape=(Nx,Ny))
+
+    #Mean and perturbations for model values in observation space
+    mY = np.mean(HXf, axis=1)
+    HXp = HXf-mY[:,None]
+    #innovation
+    d=Y-mY
+
+    tiles=[(i,min(i+tile_size,Nx)) for i in range(0,Nx,tile_size)]
+
+    #eigh ~9 Ne^3, weights ~10 Ne^3 per grid point
+    nt=min(tile_size,Nx)
+    with stage('local analyses',flops=2*loc.nnz*Ne*Ne+Nx*(19*Ne**3+2*Ne*Ne),nbytes=8*(3*nt*Ne*Ne+nt*Ny+Ny*Ne)):
+        if n_procs==1:
+            Xa=np.empty((Nx,Ne),dtype=Xf.dtype)
+            for start,stop in tiles:
+                Xa[start:stop]=local_analysis(Xf[start:stop],loc[start:stop],HXp,d,R)
+        else:
+            Xa=parallel_analysis(Xf,tiles,n_procs,loc,HXp,d,R)
+
+    return Xa
+
+
+def parallel_analysis(Xf, tiles, n_procs, loc, HXp, d, R):
+    """
+    Distributes the tiles over a process pool, prior and analysis are shared with the workers through shared memory.
+    """
+    Nx,Ne=np.shape(Xf)
+    shm_f,spec_f=to_shared(Xf)
+    shm_a,spec_a,Xa=empty_shared((Nx,Ne),dtype=Xf.dtype)
+    try:
+        with ProcessPoolExecutor(n_procs,mp_context=multiprocessing.get_context('spawn'),initializer=init_worker,
+                                 initargs=(spec_f,spec_a,loc,HXp,d,R)) as pool:
+            list(pool.map(tile_worker,tiles))
+        Xa=Xa.copy()
+    finally:
+        shm_f.close()
+        shm_f.unlink()
+        shm_a.close()
+        shm_a.unlink()
+
+    return Xa
+
+
+def local_analysis(Xf, loc, HXp, d, R):
+    """
+    ETKF analyses of a tile of grid points.
+    Input:
+    - Xf: prior of the tile (N_t x N_e)
+    - loc: localization weights of the observations for the grid points of the tile (N_t x N_y, scipy.sparse)
+    - HXp: perturbations of the observations from the model (N_y x N_e)
+    - d: innovation (N_y)
+    - R: observation error variance (N_y)
+    Output:
+    - Analysis of the tile (N_t x N_e)
+    """
+    Ne=np.shape(HXp)[1]
+    #only observations that are close to any grid point of the tile
+    obs=np.unique(loc.indices)
+    if len(obs)==0:
+        return np.array(Xf)
+
+    #localized inverse observation errors (N_t x N_obs)
+    Rinv=loc[:,obs].toarray()/R[obs]
+    Hp=HXp[obs]
+
+    #ensemble space matrix of every grid point, Hp^T diag(Rinv) Hp with its observations within the cutoff
+    #(one product per grid point, the outer products of all observations of the tile would be N_obs x N_e^2)
+    A2=np.empty((len(Rinv),Ne,Ne))
+    for p in range(len(Rinv)):
+        near=np.flatnonzero(Rinv[p])
+        A2[p]=(Hp[near].T*Rinv[p,near]) @ Hp[near]
+    A2+=(Ne-1)*np.identity(Ne)
+
+    #vectorized eigenvalue decomposition, A2 are symmetric
+    eigs,ev=np.linalg.eigh(A2)
+    del A2
+    evT=np.swapaxes(ev,1,2)
+
+    #perturbation and mean weights, as in ETKF (in place, at most three N_t x N_e x N_e arrays exist)
+    D2=(Rinv*d[obs]) @ Hp
+    wm=ev @ ((evT @ D2[:,:,None])/eigs[:,:,None])
+    W=(ev/np.sqrt(eigs)[:,None,:]) @ evT
+    W*=np.sqrt(Ne-1)
+    W+=wm
+
+    #Mean of prior ensemble for each gridbox
+    mX=np.mean(Xf,axis=1)
+    Xfp=Xf-mX[:,None]
+    return mX[:,None] + np.einsum('pe,pef->pf',Xfp,W.astype(Xf.dtype))
+
+
+#state of the worker processes, set by init_worker
+worker_state={}
+
+def init_worker(spec_f, spec_a, loc, HXp, d, R):
+    worker_state['Xf']=attach(spec_f)
+    worker_state['Xa']=attach(spec_a)
+    worker_state['args']=(loc,HXp,d,R)
+
+
+def tile_worker(tile):
+    start,stop=tile
+    Xf=worker_state['Xf'][1]
+    Xa=worker_state['Xa'][1]
+    loc,HXp,d,R=worker_state['args']
+    Xa[start:stop]=local_analysis(Xf[start:stop],loc[start:stop],HXp,d,R)
+    return tile
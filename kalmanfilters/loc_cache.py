@@ -0,0 +1,75 @@
+from collections import OrderedDict
+
+import numpy as np
+
+class LocalizationCache:
+    """
+    Hands out the localization matrices for the proxies available at one timestep.
+    PH_loc and HPH_loc from covariance_loc are computed once for all proxies. In the DA loop only the columns of PH_loc/
+    the rows and columns of HPH_loc of the available proxies are needed (see ENSRF_direct_loc). Selecting them with fancy
+    indexing copies an N_x * N_y_t block at every timestep, although in paleo DA the same availability pattern often repeats over
+    many years. Here the selected blocks are kept in a size-bounded LRU cache keyed on the availability mask.
+
+    Usage:
+        loc=LocalizationCache(*covariance_loc(model_data,proxy_lat,proxy_lon,cov_len),maxsize=16)
+        for t in years:
+            PH_t,HPH_t=loc.get(mask[t])
+            Xa=ENSRF_direct_loc(Xf,HXf[mask[t]],Y[t,mask[t]],R[mask[t]],PH_t,HPH_t)
+
+    Input:
+    - PH_loc: Matrix for localization of PH^T (N_x * N_y), dense or scipy.sparse
+    - HPH_loc: Matrix for localization of HPH^T (N_y * N_y), dense or scipy.sparse
+    - maxsize: maximum number of availability patterns kept in memory
+    """
+    def __init__(self, PH_loc, HPH_loc, maxsize=32):
+        self.PH_loc=PH_loc
+        self.HPH_loc=HPH_loc
+        self.maxsize=maxsize
+        self.Ny=np.shape(HPH_loc)[0]
+        self.hits=0
+        self.misses=0
+        self._cache=OrderedDict()
+
+    def get(self, mask=None, indices=None):
+        """
+        Localization matrices for the available proxies.
+        - mask: boolean availability mask (N_y). Other dtypes are rejected, an integer 0/1 mask would otherwise be taken as indices.
+        - indices: indices of the available proxies (instead of mask)
+        Output: PH_loc (N_x * N_y_t), HPH_loc (N_y_t * N_y_t)
+        """
+        if (mask is None)==(indices is None):
+            raise ValueError('give either mask or indices')
+        if indices is not None:
+            mask=np.zeros(self.Ny,dtype=bool)
+            mask[np.asarray(indices,dtype=int)]=True
+        mask=np.asarray(mask)
+        if mask.dtype!=bool or mask.shape!=(self.Ny,):
+            raise ValueError('mask must be a boolean array of length N_y={} (use indices= for proxy indices), got {} {}'.format(
+                             self.Ny,mask.dtype,mask.shape))
+        key=np.packbits(mask).tobytes()
+
+        if key in self._cache:
+            self.hits+=1
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        self.misses+=1
+        cols=np.flatnonzero(mask)
+        PH_t=self.PH_loc[:,cols]
+        HPH_t=self.HPH_loc[cols][:,cols]
+        self._cache[key]=(PH_t,HPH_t)
+        if len(self._cache)>self.maxsize:
+            #remove least recently used pattern
+            self._cache.popitem(last=False)
+        return PH_t, HPH_t
+
+    def clear(self):
+        self._cache.clear()
+        self.hits=0
+        self.misses=0
+
+    def __len__(self):
+        return len(self._cache)
+
+    def __repr__(self):
+        return 'LocalizationCache(patterns={}, maxsize={}, hits={}, misses={})'.format(len(self),self.maxsize,self.hits,self.misses)
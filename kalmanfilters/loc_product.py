@@ -0,0 +1,41 @@
+import numpy as np
+
+#number of nonzero entries of the localization matrix processed at once (the gathered rows should stay in cache)
+NNZ_CHUNK_SIZE=4096
+
+def localized_product(PH_loc, Xfp, HXpT, chunk_size=NNZ_CHUNK_SIZE):
+    """
+    Localized PH^T = PH_loc o (Xfp @ HXpT) for sparse localization matrices.
+    The dense product Xfp @ HXpT costs 2 N_x N_y N_e flops, although Gaspari Cohn is zero for most grid point - proxy pairs.
+    Here the product is only evaluated at the nonzero entries of PH_loc (sampled product): for each stored pair (i,j) the
+    dot product of row i of Xfp with column j of HXpT. The cost is 2 N_e flops per pair within the cutoff, and the result has
+    the sparsity pattern of PH_loc. The pairs are processed in chunks of chunk_size, such that the gathered rows stay small.
+
+    Input:
+    - PH_loc: Matrix for localization of PH^T (N_x * N_y), any scipy.sparse format (banded matrices e.g. as scipy.sparse.dia_matrix)
+    - Xfp: prior perturbations (N_x x N_e)
+    - HXpT: transposed perturbations in observation space, already divided by N_e-1 (N_e x N_y)
+    - chunk_size: number of nonzero entries processed at once
+    Output:
+    - localized PH^T (N_x * N_y) as scipy.sparse.csr_matrix in the dtype of Xfp
+    """
+    import scipy.sparse
+
+    PH_loc=scipy.sparse.csr_matrix(PH_loc)
+    Nx,Ny=PH_loc.shape
+    dtype=Xfp.dtype
+
+    #row index of every stored entry
+    rows=np.repeat(np.arange(Nx),np.diff(PH_loc.indptr))
+    cols=PH_loc.indices
+    #rows of HXp are gathered, keep them contiguous
+    HXp=np.ascontiguousarray(HXpT.T,dtype=dtype)
+
+    data=np.empty(PH_loc.nnz,dtype=dtype)
+    for i in range(0,PH_loc.nnz,chunk_size):
+        r=rows[i:i+chunk_size]
+        c=cols[i:i+chunk_size]
+        data[i:i+chunk_size]=np.einsum('ij,ij->i',Xfp[r],HXp[c])
+    data*=PH_loc.data
+
+    return scipy.sparse.csr_matrix((data,PH_loc.indices,PH_loc.indptr),shape=(Nx,Ny))
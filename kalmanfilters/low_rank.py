@@ -0,0 +1,217 @@
+import numpy as np
+
+from .prior_store import PriorStore
+from .profiling import stage
+
+#rows of the prior read at once when the decomposition is computed and when the analysis is reconstructed
+LOW_RANK_CHUNK_SIZE=4096
+
+class LowRankPrior:
+    """
+    Compressed prior: ensemble mean and truncated SVD of the perturbations, Xf ~ mX + U diag(s) V^T.
+    Climate fields are much smoother than their grid, the perturbations have far fewer relevant directions (EOFs) than N_e.
+    With rank k the prior is stored in N_x*(k+1) numbers instead of N_x*N_e, and the final multiplication of the transform
+    filters is done in the reduced space: Xa = mX + Xfp @ W ~ mX + U @ (diag(s) V^T W), so the full N_x x N_e anomaly matrix
+    is never read.
+
+    The decomposition is computed from the N_e x N_e Gram matrix Xfp^T Xfp (eigenvalues s^2, eigenvectors V), accumulated over
+    blocks of rows, and U = Xfp V / s in a second pass, so a memory mapped prior or a PriorStore is streamed twice.
+    The rank is given directly or as the fraction of the ensemble variance to keep. The truncation error
+    (relative Frobenius norm of the discarded perturbations, also for every possible rank in error_by_rank) tells what is lost.
+
+    The transform filters (ETKF, ESTKF, ENSRF_direct, ETKF_livings, EnSRF, SEnKF) accept a LowRankPrior in place of Xf and return
+    the analysis as LowRankEnsemble, which is only reconstructed on the grid on demand, blockwise. With out= the analysis is
+    reconstructed block by block into out, with stats= the statistics are computed blockwise (see apply_weights in update.py).
+    HXf should be computed from the full prior.
+
+    Usage:
+        prior=LowRankPrior(Xf,variance=0.99)
+        print(prior.rank, prior.error)
+        Xa=ETKF(prior,HXf,Y,R)
+        mean=Xa.mean()
+        Xa.to_array(out=np.lib.format.open_memmap('Xa.npy',mode='w+',shape=Xa.shape))
+
+    Input:
+    - Xf: the prior ensemble (N_x x N_e), numpy array, memory mapped array or PriorStore
+    - rank: number of singular vectors kept
+    - variance: fraction of the ensemble variance kept (e.g. 0.99), the smallest rank that reaches it is used.
+      Without rank and variance all nonzero singular values are kept (at most N_e-1).
+    - dtype: precision of U (e.g. np.float32), the singular values and V stay in double precision
+    - chunk_size: rows of the prior read at once
+    """
+    def __init__(self, Xf, rank=None, variance=None, dtype=None, chunk_size=LOW_RANK_CHUNK_SIZE):
+        Nx,Ne=np.shape(Xf)
+        self.mean=np.empty(Nx)
+        G=np.zeros((Ne,Ne))
+
+        with stage('gram matrix',flops=2*Nx*Ne*Ne+2*Nx*Ne,nbytes=8*min(chunk_size,Nx)*Ne):
+            for i in range(0,Nx,chunk_size):
+                Xpb=self.anomalies(Xf,slice(i,i+chunk_size))
+                G+=Xpb.T @ Xpb
+
+        with stage('eigendecomposition',flops=9*Ne**3,nbytes=8*Ne*Ne):
+            eigs,V=np.linalg.eigh(G)
+            #descending order, the perturbations have at most rank N_e-1
+            eigs=np.maximum(eigs[::-1],0)
+            V=V[:,::-1]
+            total=np.sum(eigs)
+            nonzero=int(np.sum(eigs>eigs[0]*Ne*np.finfo(float).eps)) if total>0 else 0
+            #error_by_rank[k]: relative error of the perturbations with rank k
+            self.error_by_rank=np.sqrt(np.maximum(1-np.cumsum(np.concatenate([[0],eigs]))/total,0)) if total>0 else np.zeros(Ne+1)
+
+            k=nonzero
+            if variance is not None:
+                k=min(k,int(np.searchsorted(np.cumsum(eigs)/total,variance*(1-1e-12)))+1)
+            if rank is not None:
+                k=min(k,rank)
+
+        self.s=np.sqrt(eigs[:k])
+        self.V=V[:,:k]
+        self.U=np.empty((Nx,k),dtype=np.float64 if dtype is None else dtype)
+        with stage('singular vectors',flops=2*Nx*Ne*k+2*Nx*Ne,nbytes=8*min(chunk_size,Nx)*Ne):
+            VS=self.V/self.s[None,:]
+            for i in range(0,Nx,chunk_size):
+                self.U[i:i+chunk_size]=self.anomalies(Xf,slice(i,i+chunk_size),store_mean=False) @ VS
+
+    def anomalies(self, Xf, rows, store_mean=True):
+        """
+        Perturbations of a block of rows of the prior (mean stored in self.mean in the first pass)
+        """
+        if isinstance(Xf,PriorStore):
+            if store_mean:
+                self.mean[rows]=Xf.mean[rows]
+            return np.asarray(Xf.anomalies[rows],dtype=float)
+        Xb=np.asarray(Xf[rows],dtype=float)
+        if store_mean:
+            self.mean[rows]=np.mean(Xb,axis=1)
+        return Xb-self.mean[rows,None]
+
+    @property
+    def shape(self):
+        return (self.U.shape[0], self.V.shape[0])
+
+    @property
+    def dtype(self):
+        return self.U.dtype
+
+    @property
+    def rank(self):
+        return len(self.s)
+
+    @property
+    def error(self):
+        """
+        Relative Frobenius norm of the discarded perturbations, ||Xfp - U diag(s) V^T|| / ||Xfp||
+        """
+        return self.error_by_rank[self.rank]
+
+    @property
+    def explained_variance(self):
+        return 1-self.error**2
+
+    @property
+    def nbytes(self):
+        return self.mean.nbytes+self.U.nbytes+self.s.nbytes+self.V.nbytes
+
+    def reduced_weights(self, W):
+        """
+        Weights in the reduced space, diag(s) V^T W (rank x N_e)
+        """
+        return (self.s[:,None]*self.V.T) @ W
+
+    def apply(self, W):
+        """
+        Analysis Xa = mX + Xfp @ W in the reduced space, returned as LowRankEnsemble
+        """
+        with stage('state update (low rank)',flops=2*self.rank*self.shape[1]*np.shape(W)[1],nbytes=16*self.rank*np.shape(W)[1]):
+            return LowRankEnsemble(self.mean, self.U, self.reduced_weights(W))
+
+    def apply_rows(self, rows, W, dtype=None):
+        """
+        Rows of the analysis Xa = mX + Xfp @ W, reconstructed from the reduced space
+        """
+        Ub=np.asarray(self.U[rows],dtype=dtype)
+        B=self.reduced_weights(W)
+        Xab=Ub @ B.astype(reduced_dtype(Ub.dtype,B))
+        Xab+=self.mean[rows,None]
+        return Xab
+
+    def __getitem__(self, rows):
+        """
+        Reconstructed (truncated) prior ensemble of the selected rows
+        """
+        return self.apply_rows(rows, np.identity(self.shape[1]))
+
+    def __array__(self, dtype=None, copy=None):
+        return LowRankEnsemble(self.mean, self.U, self.reduced_weights(np.identity(self.shape[1]))).__array__(dtype)
+
+    def __repr__(self):
+        return 'LowRankPrior(N_x={}, N_e={}, rank={}, error={:.3g}, {:.1f} MB)'.format(self.shape[0],self.shape[1],self.rank,
+                                                                                    self.error,self.nbytes/1e6)
+
+
+class LowRankEnsemble:
+    """
+    Analysis ensemble in the reduced space of a LowRankPrior, Xa = mean + U @ B (B: rank x N_e).
+    Ensemble mean and variance are computed from the small matrices, the full ensemble is only reconstructed on demand:
+    Xa[rows], np.asarray(Xa) or blockwise into a (memory mapped) array with to_array.
+    """
+    def __init__(self, mean, U, B):
+        self.mean_prior=mean
+        self.U=U
+        self.B=B
+
+    @property
+    def shape(self):
+        return (self.U.shape[0], self.B.shape[1])
+
+    @property
+    def dtype(self):
+        return reduced_dtype(self.U.dtype,self.B)
+
+    def __getitem__(self, rows):
+        Xab=self.U[rows] @ self.B.astype(self.dtype)
+        Xab+=np.asarray(self.mean_prior[rows])[...,None]
+        return Xab
+
+    def __array__(self, dtype=None, copy=None):
+        Xa=self.to_array()
+        return Xa if dtype is None else Xa.astype(dtype,copy=False)
+
+    def to_array(self, chunk_size=LOW_RANK_CHUNK_SIZE, out=None):
+        """
+        Reconstructs the analysis (N_x x N_e) block by block into out (e.g. a memory mapped array), None: a new array
+        """
+        Nx,Ne=self.shape
+        if out is None:
+            out=np.empty(self.shape,dtype=self.dtype)
+        with stage('reconstruction',flops=2*Nx*self.U.shape[1]*Ne,nbytes=self.dtype.itemsize*min(chunk_size,Nx)*Ne):
+            for i in range(0,Nx,chunk_size):
+                out[i:i+chunk_size]=self[i:i+chunk_size]
+        if isinstance(out,np.memmap):
+            out.flush()
+        return out
+
+    def mean(self):
+        """
+        Ensemble mean (N_x)
+        """
+        return self.mean_prior + self.U @ np.mean(self.B,axis=1).astype(self.dtype)
+
+    def var(self):
+        """
+        Ensemble variance (N_x), with 1/(N_e-1) as the covariances in the filters
+        """
+        Bp=self.B-np.mean(self.B,axis=1)[:,None]
+        C=(Bp @ Bp.conj().T).real/(self.shape[1]-1)
+        return np.sum((self.U @ C)*self.U,axis=1)
+
+    def __repr__(self):
+        return 'LowRankEnsemble(N_x={}, N_e={}, rank={})'.format(self.shape[0],self.shape[1],self.U.shape[1])
+
+
+def reduced_dtype(dtype, B):
+    """
+    The reconstruction keeps the precision of U (e.g. float32), complex weights (EnSRF) give a complex analysis
+    """
+    return np.result_type(dtype,np.complex64) if np.iscomplexobj(B) else np.dtype(dtype)
@@ -0,0 +1,99 @@
+#fused kernels of the numba backend (see backend.py), each replaces a chain of temporary allocating numpy expressions.
+#Matrix products stay in BLAS (np.dot / @), only the elementwise work around them is fused
+import numpy as np
+from numba import njit, prange
+
+@njit(parallel=True, cache=True)
+def gc_kernel(dists, cov_len, out):
+    for i in prange(dists.shape[0]):
+        r=abs(dists[i])/cov_len
+        if r<=1.:
+            v=-0.25*r**5+0.5*r**4+0.625*r**3-5./3.*r**2+1.
+        elif r<=2.:
+            v=1./12.*r**5-0.5*r**4+0.625*r**3+5./3.*r**2-5.*r+4.-2./(3.*r)
+        else:
+            v=0.
+        out[i]=v if v>0. else 0.
+
+
+def gaspari_cohn(dists, cov_len):
+    """
+    Gaspari Cohn function in one pass over the distances (see gaspari_cohn in cov_loc.py)
+    """
+    dists=np.asarray(dists)
+    flat=np.ascontiguousarray(dists.reshape(-1))
+    out=np.empty_like(flat)
+    gc_kernel(flat,float(cov_len),out)
+    return out.reshape(dists.shape)
+
+
+@njit(parallel=True, cache=True)
+def mean_correction_kernel(Xb, c, out):
+    n,Ne=Xb.shape
+    for i in prange(n):
+        m=0.
+        for k in range(Ne):
+            m+=Xb[i,k]
+        m/=Ne
+        for j in range(out.shape[1]):
+            out[i,j]+=m*c[j]
+
+
+def update_block(Xb, W):
+    """
+    Xa = mX + Xfp @ W = Xb @ W + mX (1 - column sums of W) (see update_block in update.py): the product stays in BLAS, the
+    row means and the correction are computed in one fused pass, the perturbations Xfp are never stored.
+    In single precision Xb @ W would lose the perturbations against a large mean (e.g. temperatures ~280 K), float32
+    blocks are updated with the mean subtracted first.
+    """
+    Xb=np.asarray(Xb)
+    dtype=np.result_type(Xb.dtype,W.dtype)
+    if dtype.itemsize<8:
+        mXb=np.mean(Xb,axis=-1)
+        return mXb[...,None] + (Xb-mXb[...,None]) @ W
+    shape=Xb.shape
+    X2=np.ascontiguousarray(Xb.reshape(-1,shape[-1]),dtype=dtype)
+    W=np.ascontiguousarray(W,dtype=dtype)
+    out=X2 @ W
+    mean_correction_kernel(X2,1-np.sum(W,axis=0),out)
+    return out.reshape(shape[:-1]+(W.shape[1],))
+
+
+@njit(cache=True)
+def serial_kernel(HXp, mY, Y, R, Wp, wm):
+    Ny,Ne=HXp.shape
+    for i in range(Ny):
+        hp=HXp[i].copy()
+        F=np.dot(hp,hp)/(Ne-1)+R[i]
+        d=Y[i]-mY[i]
+        a2=1/(1+np.sqrt(R[i]/F))
+        g=hp/((Ne-1)*F)
+        #matrix-vector products in BLAS
+        hg=np.dot(HXp,g)
+        wg=np.dot(Wp,g)
+        #mean and in place rank one perturbation updates, without the outer product temporaries of the numpy version
+        for l in range(Ny):
+            mY[l]+=hg[l]*d
+            s=a2*hg[l]
+            for k in range(Ne):
+                HXp[l,k]-=s*hp[k]
+        for l in range(Ne):
+            wm[l]+=wg[l]*d
+            s=a2*wg[l]
+            for k in range(Ne):
+                Wp[l,k]-=s*hp[k]
+
+
+def serial_updates(HXp, mY, Y, R):
+    """
+    Serial EnSRF updates in ensemble space (see EnSRF_serial_weights in ensrf_serial.py), in place updates instead of np.outer temporaries.
+    Output: wm (N_e), Wp (N_e x N_e)
+    """
+    Ne=HXp.shape[1]
+    HXp=np.array(HXp,dtype=np.float64)
+    mY=np.array(mY,dtype=np.float64)
+    Wp=np.identity(Ne)
+    wm=np.zeros(Ne)
+    serial_kernel(HXp,mY,np.asarray(Y,dtype=np.float64),np.asarray(R,dtype=np.float64),Wp,wm)
+    return wm, Wp
+
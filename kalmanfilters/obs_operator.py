@@ -0,0 +1,121 @@
+import numpy as np
+
+from .cov_loc import unit_sphere, EARTH_RADIUS
+from .prior_store import PriorStore
+from .low_rank import LowRankPrior
+from .profiling import stage
+
+class ObsOperator:
+    """
+    Linear observation operator H (N_y x N_x) from the stacked grid to the proxy locations, stored as sparse CSR matrix.
+    The weights are computed once: for every proxy the k nearest grid points are searched with a kd-tree (on the unit sphere,
+    as in cov_loc.py) and weighted by inverse great circle distance (a proxy on a grid point gets only this grid point).
+    The observations from the model are then one sparse product HXf = H @ Xf.
+
+    All filters accept an ObsOperator in place of HXf and compute HXf from the prior themselves. EnSRF_serial(..., augmented=True)
+    uses the rows of H to map the updated state to the next observation instead of appending HXf to the state.
+
+    Usage:
+        H=ObsOperator(grid_lat,grid_lon,proxy_lat,proxy_lon,k=4)
+        Xa=ETKF(Xf,H,Y,R)
+        HXf=H(Xf)
+
+    Input:
+    - grid_lat, grid_lon: coordinates of the stacked grid points (N_x), same ordering as the prior
+    - proxy_lat, proxy_lon: coordinates of the proxies (N_y)
+    - k: number of grid points used per proxy (k=1: nearest grid point)
+    - power: exponent of the inverse distance weights
+    """
+    def __init__(self, grid_lat, grid_lon, proxy_lat, proxy_lon, k=4, power=1):
+        import scipy.sparse
+        from scipy.spatial import cKDTree
+
+        Nx=len(grid_lat)
+        Ny=len(proxy_lat)
+        k=min(k,Nx)
+        with stage('observation operator',nbytes=16*Ny*k):
+            tree=cKDTree(unit_sphere(grid_lat,grid_lon))
+            chord,idx=tree.query(unit_sphere(proxy_lat,proxy_lon),k=k)
+            chord=np.reshape(chord,(Ny,k))
+            idx=np.reshape(idx,(Ny,k))
+            #convert chord to great circle distance
+            dists=2*EARTH_RADIUS*np.arcsin(np.clip(chord/2,0,1))
+
+            exact=dists<=1e-9
+            with np.errstate(divide='ignore'):
+                w=np.where(exact,1.,1/dists**power)
+            #proxies on a grid point only take this grid point
+            on_grid=exact.any(axis=1)
+            w[on_grid]=exact[on_grid]
+            w/=w.sum(axis=1)[:,None]
+
+            H=scipy.sparse.csr_matrix((w.reshape(-1),(np.repeat(np.arange(Ny),k),idx.reshape(-1))),shape=(Ny,Nx))
+            H.eliminate_zeros()
+        self.H=H
+
+    @classmethod
+    def from_matrix(cls, H):
+        """
+        Observation operator from any linear operator given as (sparse or dense) N_y x N_x matrix, e.g. regional means
+        """
+        import scipy.sparse
+
+        op=cls.__new__(cls)
+        op.H=scipy.sparse.csr_matrix(H)
+        return op
+
+    @classmethod
+    def from_dataarray(cls, model_data, proxy_lat, proxy_lon, k=4, power=1):
+        """
+        Grid coordinates taken from an xarray DataArray with lat/lon dimensions, ordered as stack(z=('lat','lon')) (see covariance_loc)
+        """
+        grid_lat,grid_lon=np.meshgrid(model_data['lat'].values,model_data['lon'].values,indexing='ij')
+        return cls(grid_lat.reshape(-1),grid_lon.reshape(-1),proxy_lat,proxy_lon,k=k,power=power)
+
+    @property
+    def shape(self):
+        return self.H.shape
+
+    def __call__(self, Xf):
+        """
+        Observations from the model HXf (N_y x N_e) for the prior Xf (N_x x N_e), which can be memory mapped, a PriorStore or a
+        LowRankPrior (observations of the truncated prior)
+        """
+        Ny,Nx=self.H.shape
+        with stage('observation operator',flops=2*self.H.nnz*np.shape(Xf)[1],nbytes=8*Ny*np.shape(Xf)[1]):
+            if isinstance(Xf,PriorStore):
+                #H is linear
+                return (self.H @ Xf.mean)[:,None] + np.asarray(self.H @ Xf.anomalies,dtype=float)
+            if isinstance(Xf,LowRankPrior):
+                return (self.H @ Xf.mean)[:,None] + np.asarray(self.H @ Xf.U,dtype=float) @ Xf.reduced_weights(np.identity(Xf.shape[1]))
+            return np.asarray(self.H @ Xf,dtype=float)
+
+    def select(self, mask):
+        """
+        Observation operator for the available proxies (boolean mask or indices)
+        """
+        return ObsOperator.from_matrix(self.H[np.flatnonzero(mask) if np.asarray(mask).dtype==bool else mask])
+
+    def row(self, i):
+        """
+        Grid point indices and weights of proxy i
+        """
+        start,end=self.H.indptr[i],self.H.indptr[i+1]
+        return self.H.indices[start:end], self.H.data[start:end]
+
+    def __repr__(self):
+        return 'ObsOperator(N_y={}, N_x={}, nnz={})'.format(self.H.shape[0],self.H.shape[1],self.H.nnz)
+
+
+def observations(HXf, Xf):
+    """
+    HXf for the filters: applies an ObsOperator to the prior, precomputed observations from the model are passed through.
+    HXf=None takes the observations stored with a PriorStore (prior_store.py).
+    """
+    if isinstance(HXf,ObsOperator):
+        return HXf(Xf)
+    if HXf is None:
+        if not isinstance(Xf,PriorStore) or Xf.HXf is None:
+            raise ValueError('HXf is None and the prior has no stored HXf')
+        return np.asarray(Xf.HXf)
+    return HXf
@@ -0,0 +1,111 @@
+from collections import OrderedDict
+
+import numpy as np
+
+from .etkf import ETKF_gain
+from .estkf import ESTKF_gain
+from .ensrf_direct import ENSRF_direct_gain
+from .obs_operator import observations
+from .prior_store import mean_anomalies
+from .profiling import stage
+
+GAINS={'ETKF':ETKF_gain, 'ESTKF':ESTKF_gain, 'ENSRF_direct':ENSRF_direct_gain}
+
+class OfflineDA:
+    """
+    Offline Data Assimilation with a prior that is the same for all timesteps (e.g. years).
+    Only the observations Y change every timestep, the observation errors R and the set of available proxies only sometimes.
+    The analysis is Xa = mX + Xfp @ Wp + Xfp @ (G @ d): the perturbation weights Wp and the mean weight gain G only depend on the
+    observation network (available proxies + R). Mean and perturbations of the prior are computed once, and for each observation
+    network the decomposition and the perturbation update Xfp @ Wp are cached. When only Y changes, the analysis only costs a
+    matrix-vector product for the mean.
+
+    The cached perturbation updates have the size of the prior, maxsize bounds the number of networks that are kept (LRU).
+
+    Usage:
+        da=OfflineDA(Xf,HXf,method='ETKF')
+        for t in years:
+            Xa=da.analysis(Y[t],R,mask[t])
+
+    Input:
+    - Xf:  the prior ensemble (N_x x N_e), or a PriorStore (prior_store.py)
+    - HX^f: Model value projected into observation space/at proxy locations for all possible proxies (N_y x N_e), or an ObsOperator (obs_operator.py)
+    - method: 'ETKF', 'ESTKF' or 'ENSRF_direct' (same analysis, different ensemble space computations)
+    - maxsize: maximum number of observation networks kept in memory
+    - dtype: precision of the prior and the cached perturbation updates (e.g. np.float32)
+    """
+    def __init__(self, Xf, HXf, method='ETKF', maxsize=4, dtype=None):
+        if method not in GAINS:
+            raise ValueError('method must be one of {}'.format(list(GAINS)))
+        self.gain=GAINS[method]
+        self.method=method
+        self.maxsize=maxsize
+        self.HXf=np.asarray(observations(HXf, Xf))
+        self.Ny=np.shape(self.HXf)[0]
+
+        #Mean of prior ensemble for each gridbox and perturbations from ensemble mean (the memory mapped arrays of a PriorStore)
+        self.mX, self.Xfp = mean_anomalies(Xf, dtype)
+        #Mean of model values in observation space
+        self.mY=np.mean(self.HXf, axis=1)
+
+        self.hits=0
+        self.misses=0
+        self._cache=OrderedDict()
+
+    def analysis(self, Y, R, mask=None):
+        """
+        Input:
+        - Y: Observation vector for all possible proxies (N_y), unavailable observations can be NaN
+        - R: Measurement Error for all possible proxies (N_y)
+        - mask: boolean availability of observations (N_y). If None, all non-NaN entries of Y are used.
+
+        Output:
+        - Analysis ensemble (N_x, N_e)
+        """
+        Y=np.asarray(Y)
+        R=np.broadcast_to(np.asarray(R,dtype=float),(self.Ny,))
+        if mask is None:
+            mask=~np.isnan(Y)
+        mask=np.asarray(mask,dtype=bool)
+
+        G, XWp = self.network(R, mask)
+
+        Nx,Ne=np.shape(self.Xfp)
+        with stage('mean update',flops=2*Nx*Ne+2*Ne*len(G.T),nbytes=self.Xfp.itemsize*Nx):
+            #mean update, only a matrix-vector product with the prior perturbations
+            d=Y[mask]-self.mY[mask]
+            xa_m=self.mX + self.Xfp @ (G @ d).astype(self.Xfp.dtype)
+
+        with stage('add perturbations',flops=Nx*Ne,nbytes=self.Xfp.itemsize*Nx*Ne):
+            Xa=XWp + xa_m[:,None]
+
+        return Xa
+
+    def network(self, R, mask):
+        """
+        Mean weight gain and perturbation update Xfp @ Wp for one observation network (cached).
+        """
+        key=(np.packbits(mask).tobytes(), R[mask].tobytes())
+        if key in self._cache:
+            self.hits+=1
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        self.misses+=1
+        G, Wp = self.gain(self.HXf[mask], R[mask])
+        Nx,Ne=np.shape(self.Xfp)
+        with stage('perturbation update',flops=2*Nx*Ne*Ne,nbytes=self.Xfp.itemsize*Nx*Ne):
+            XWp=self.Xfp @ Wp.astype(self.Xfp.dtype)
+        self._cache[key]=(G, XWp)
+        if len(self._cache)>self.maxsize:
+            #remove least recently used network
+            self._cache.popitem(last=False)
+        return G, XWp
+
+    def clear(self):
+        self._cache.clear()
+        self.hits=0
+        self.misses=0
+
+    def __repr__(self):
+        return 'OfflineDA(method={}, networks={}, maxsize={}, hits={}, misses={})'.format(self.method,len(self._cache),self.maxsize,self.hits,self.misses)
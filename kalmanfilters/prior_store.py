@@ -0,0 +1,168 @@
+import json
+import os
+
+import numpy as np
+
+from .profiling import stage
+
+#rows of the prior written (and by default streamed through the update) at once
+PRIOR_CHUNK_SIZE=4096
+
+#format version of meta.json
+VERSION=1
+
+class PriorStore:
+    """
+    Prior ensemble stored as ensemble mean and anomalies (perturbations from the mean) in a directory of uncompressed .npy files,
+    see write_prior_store:
+    - meta.json: N_x, N_e, N_y, dtype of the anomalies, chunk size and user attributes
+    - mean.npy: ensemble mean (N_x), double precision
+    - anomalies.npy: Xf - mean (N_x x N_e), double or single precision
+    - HXf.npy: observations from the model (N_y x N_e), optional
+
+    The arrays are opened as read-only memory maps (open_prior_store), so opening is instant whatever the size of the prior,
+    only the rows that are used are read from disk, and processes that open the same store share the pages through the page
+    cache. Pickling a PriorStore (e.g. for a process pool) only transfers the path, the worker maps the same files.
+
+    All filters accept a PriorStore in place of Xf and use the stored mean and anomalies instead of recomputing them: the transform
+    filters stream the anomalies through the update in the stored chunks (see apply_weights in update.py), the other filters read
+    them with mean_anomalies. With HXf=None the filters take the stored HXf.
+    np.asarray(store) and store[rows] reconstruct the ensemble (mean + anomalies).
+    """
+    def __init__(self, path, mmap_mode='r'):
+        self.path=os.fspath(path)
+        with open(os.path.join(self.path,'meta.json')) as f:
+            self.meta=json.load(f)
+        if self.meta.get('version',VERSION)>VERSION:
+            raise ValueError('prior store {} has version {}, this code reads version {}'.format(self.path,self.meta['version'],VERSION))
+        self.mean=np.load(os.path.join(self.path,'mean.npy'),mmap_mode=mmap_mode)
+        self.anomalies=np.load(os.path.join(self.path,'anomalies.npy'),mmap_mode=mmap_mode)
+        hxf_path=os.path.join(self.path,'HXf.npy')
+        self.HXf=np.load(hxf_path,mmap_mode=mmap_mode) if os.path.exists(hxf_path) else None
+
+    @property
+    def shape(self):
+        return self.anomalies.shape
+
+    @property
+    def dtype(self):
+        return self.anomalies.dtype
+
+    @property
+    def ndim(self):
+        return 2
+
+    @property
+    def chunk_size(self):
+        return self.meta['chunk_size']
+
+    @property
+    def attrs(self):
+        return self.meta.get('attrs',{})
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, rows):
+        """
+        Ensemble (mean + anomalies) of the selected rows
+        """
+        return np.asarray(self.mean[rows])[...,None] + self.anomalies[rows]
+
+    def __array__(self, dtype=None, copy=None):
+        with stage('reconstruct prior',flops=self.shape[0]*self.shape[1],nbytes=self.anomalies.itemsize*self.shape[0]*self.shape[1]):
+            Xf=self[:]
+        return Xf if dtype is None else Xf.astype(dtype,copy=False)
+
+    def __reduce__(self):
+        #workers reopen the memory maps instead of receiving a copy of the arrays
+        return (open_prior_store, (self.path,))
+
+    def __repr__(self):
+        return 'PriorStore({!r}, N_x={}, N_e={}, N_y={}, dtype={})'.format(self.path,self.shape[0],self.shape[1],
+                                                                          self.meta.get('Ny'),self.dtype)
+
+
+def open_prior_store(path):
+    """
+    Opens a prior store written by write_prior_store, the arrays are read-only memory maps (see PriorStore).
+    """
+    return PriorStore(path)
+
+
+def write_prior_store(path, Xf, HXf=None, dtype=None, chunk_size=PRIOR_CHUNK_SIZE, attrs=None):
+    """
+    Writes the prior as ensemble mean and anomalies (see PriorStore). The prior is read and written in blocks of chunk_size rows,
+    so a memory mapped prior (e.g. np.load('Xf.npy',mmap_mode='r')) is never loaded as a whole. The mean is computed and stored in
+    double precision, with dtype=np.float32 the anomalies are stored in single precision, which halves the size of the store and
+    the bandwidth of the update while the mean keeps full precision.
+
+    Usage:
+        write_prior_store('prior_store',np.load('testdata/Xf.npz',allow_pickle=True)['Xf'],HXf,dtype=np.float32)
+        store=open_prior_store('prior_store')
+        Xa=ETKF(store,None,Y,R)
+
+    Input:
+    - path: directory of the store (created, existing files are overwritten)
+    - Xf: the prior ensemble (N_x x N_e), numpy array or memory mapped array
+    - HX^f: Model value projected into observation space/at proxy locations (N_y x N_e), optional
+    - dtype: precision of the stored anomalies. None: dtype of Xf
+    - chunk_size: rows per block, stored in meta.json as the default block size of the update
+    - attrs: json serializable dict stored in meta.json (e.g. variable names, coordinates of the grid)
+
+    Output:
+    - the opened PriorStore
+    """
+    os.makedirs(path,exist_ok=True)
+    if os.path.exists(os.path.join(path,'meta.json')):
+        os.remove(os.path.join(path,'meta.json'))
+    Nx,Ne=np.shape(Xf)
+    dtype=np.dtype(Xf.dtype if dtype is None else dtype)
+
+    with stage('write prior store',flops=2*Nx*Ne,nbytes=2*min(chunk_size,Nx)*Ne*8):
+        mean=np.lib.format.open_memmap(os.path.join(path,'mean.npy'),mode='w+',dtype=np.float64,shape=(Nx,))
+        anomalies=np.lib.format.open_memmap(os.path.join(path,'anomalies.npy'),mode='w+',dtype=dtype,shape=(Nx,Ne))
+        for i in range(0,Nx,chunk_size):
+            Xb=np.asarray(Xf[i:i+chunk_size],dtype=np.float64)
+            mean[i:i+chunk_size]=np.mean(Xb,axis=1)
+            anomalies[i:i+chunk_size]=Xb-mean[i:i+chunk_size,None]
+        mean.flush()
+        anomalies.flush()
+        del mean, anomalies
+
+        hxf_path=os.path.join(path,'HXf.npy')
+        if HXf is not None:
+            np.save(hxf_path,np.asarray(HXf,dtype=float))
+        elif os.path.exists(hxf_path):
+            os.remove(hxf_path)
+
+    meta={'version':VERSION, 'Nx':Nx, 'Ne':Ne, 'Ny':None if HXf is None else np.shape(HXf)[0], 'dtype':dtype.name,
+          'chunk_size':chunk_size, 'attrs':attrs or {}}
+    #meta.json is written last, a store without it is incomplete
+    tmp=os.path.join(path,'meta.json.tmp')
+    with open(tmp,'w') as f:
+        json.dump(meta,f,indent=1)
+    os.replace(tmp,os.path.join(path,'meta.json'))
+
+    return open_prior_store(path)
+
+
+def as_prior(Xf, dtype=None):
+    """
+    Prior for the filters: a PriorStore is kept (memory mapped), everything else is converted with np.asarray.
+    """
+    if isinstance(Xf,PriorStore):
+        return Xf
+    return np.asarray(Xf,dtype=dtype)
+
+
+def mean_anomalies(Xf, dtype=None):
+    """
+    Ensemble mean (N_x) and anomalies (N_x x N_e) of the prior. The stored arrays of a PriorStore are returned without
+    recomputation (read-only memory maps unless dtype differs from the stored precision), otherwise they are computed.
+    """
+    if isinstance(Xf,PriorStore):
+        return np.asarray(Xf.mean,dtype=dtype), np.asarray(Xf.anomalies,dtype=dtype)
+    Xf=np.asarray(Xf,dtype=dtype)
+    mX=np.mean(Xf, axis=1)
+    return mX, Xf-mX[:,None]
@@ -0,0 +1,143 @@
+import contextvars
+import time
+import tracemalloc
+
+#stack of active profilers, the filters report their stages to the innermost one. Context variables are separate for every
+#thread, stages of other threads (e.g. the dask threads of assimilate_dataarray) don't report to this thread's profiler
+active=contextvars.ContextVar('profilers',default=())
+
+#stack of the open stages (of this thread)
+open_stages=contextvars.ContextVar('stages',default=())
+
+class Profile:
+    """
+    Records the stages of the filters (mean/perturbations, ensemble or observation space matrices, decompositions, state update ...)
+    while it is active. For each stage the wall time, an approximate number of floating point operations and the approximate number
+    of bytes of the arrays created in that stage (estimates from the array shapes) are recorded. With memory=True the peak memory
+    allocated during each stage is additionally measured with tracemalloc (slower).
+    Stages can be nested (e.g. a filter called inside the stage of a driver): the time of a stage excludes the time of the stages
+    inside it, so the times in the report add up to the wall time. The peak memory of a stage includes the stages inside it.
+    Only the stages of the thread that entered the profiler are recorded.
+    When no profiler is active the stages cost one context variable lookup.
+
+    Usage:
+        with Profile() as prof:
+            Xa=ENSRF_direct(Xf,HXf,Y,R)
+        print(prof.report())
+    """
+    def __init__(self, memory=False):
+        self.memory=memory
+        self.records=[]
+        self._tracing=False
+
+    def __enter__(self):
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracing=True
+        active.set(active.get()+(self,))
+        return self
+
+    def __exit__(self, *exc):
+        active.set(tuple(p for p in active.get() if p is not self))
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing=False
+        return False
+
+    def summary(self):
+        """
+        Records summed up per stage: {name: {'calls','time','flops','bytes'(,'peak_bytes')}}
+        """
+        out={}
+        for r in self.records:
+            s=out.setdefault(r['name'],{'calls':0,'time':0.,'flops':0,'bytes':0})
+            s['calls']+=1
+            s['time']+=r['time']
+            s['flops']+=r['flops']
+            s['bytes']+=r['bytes']
+            if 'peak_bytes' in r:
+                s['peak_bytes']=max(s.get('peak_bytes',0),r['peak_bytes'])
+        return out
+
+    def report(self):
+        """
+        Table of the stages sorted by time
+        """
+        summary=self.summary()
+        total=sum(s['time'] for s in summary.values()) or 1.
+        lines=['{:<32}{:>7}{:>11}{:>7}{:>11}{:>10}{:>10}'.format('stage','calls','time [s]','%','GFLOP','GFLOP/s','MB')]
+        for name,s in sorted(summary.items(),key=lambda x:-x[1]['time']):
+            mb=s.get('peak_bytes',s['bytes'])/1e6
+            rate=s['flops']/s['time']/1e9 if s['time']>0 else 0.
+            lines.append('{:<32}{:>7}{:>11.4f}{:>7.1f}{:>11.3f}{:>10.2f}{:>10.1f}'.format(
+                name,s['calls'],s['time'],100*s['time']/total,s['flops']/1e9,rate,mb))
+        return '\n'.join(lines)
+
+
+class Stage:
+    """
+    Times one stage of a filter and reports it to the innermost active profiler.
+    """
+    def __init__(self, profile, name, flops, nbytes):
+        self.profile=profile
+        self.name=name
+        self.flops=flops
+        self.nbytes=nbytes
+
+    def __enter__(self):
+        stages=open_stages.get()
+        self.parent=stages[-1] if stages else None
+        #time of the stages inside this one, and highest traced memory before their peak resets
+        self.nested_time=0.
+        self.peak=0
+        self.mem0=0
+        if tracemalloc.is_tracing():
+            current,peak=tracemalloc.get_traced_memory()
+            if self.parent is not None:
+                #the reset below would lose the peak of the enclosing stage so far
+                self.parent.peak=max(self.parent.peak,peak)
+            self.mem0=current
+            tracemalloc.reset_peak()
+        open_stages.set(stages+(self,))
+        self.t0=time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed=time.perf_counter()-self.t0
+        open_stages.set(tuple(s for s in open_stages.get() if s is not self))
+        record={'name':self.name,'time':elapsed-self.nested_time,'flops':int(self.flops),'bytes':int(self.nbytes)}
+        if self.parent is not None:
+            self.parent.nested_time+=elapsed
+        if self.profile.memory and tracemalloc.is_tracing():
+            self.peak=max(self.peak,tracemalloc.get_traced_memory()[1])
+            record['peak_bytes']=self.peak-self.mem0
+            if self.parent is not None:
+                self.parent.peak=max(self.parent.peak,self.peak)
+        self.profile.records.append(record)
+        return False
+
+
+class NoStage:
+    """
+    Used when no profiler is active.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NOSTAGE=NoStage()
+
+
+def stage(name, flops=0, nbytes=0):
+    """
+    Context manager around one stage of a filter.
+    - name: name of the stage
+    - flops: approximate number of floating point operations
+    - nbytes: approximate number of bytes of the arrays created
+    """
+    profiles=active.get()
+    if not profiles:
+        return NOSTAGE
+    return Stage(profiles[-1], name, flops, nbytes)
@@ -1,4 +1,9 @@
-def SEnKF(Xf, HXf, Y, R):
+import numpy as np
+from .update import apply_weights
+from .obs_operator import observations
+from .profiling import stage
+
+def SEnKF(Xf, HXf, Y, R, chunk_size=None, out=None, dtype=None, stats=None, overwrite_prior=False):
     """
     Stochastic Ensemble Kalman Filter
     Implementation adapted from pseudocode description in
@@ -7,45 +12,55 @@ def SEnKF(Xf, HXf, Y, R):
     Changes: The pseudocode is not consistent with the description in 5.1, where the obs-from-model are perturbed, but in the pseudocode it's the other way round.
     Hence the 8th line D= ... is confusing if we would generate Y as described in the text.
     Last line needs to have 1/(Ne-1) (+always better to do that on the smaller matrix)
+    The update Xa = Xf + Xfp @ E/(N_e-1) = mX + Xfp @ (I + E/(N_e-1)) is a transform with the weights I + E/(N_e-1),
+    it is applied like the weights of the deterministic filters (apply_weights in update.py).
     
     Input:
     - Xf:  the prior ensemble (N_x x N_e) 
-    - R: Measurement Error (Variance of pseudoproxy timerseries) (N_y x 1) -> converted to Ny x Ny matrix
-    - HX^f: Model value projected into observation space/at proxy locations (N_y x N_e)
+    - R: Measurement Error (Variance of pseudoproxy timerseries) (N_y x 1), diagonal of the error covariance matrix
+    - HX^f: Model value projected into observation space/at proxy locations (N_y x N_e), or an ObsOperator (obs_operator.py)
     - Y: Observation vector (N_y x 1)
+    - chunk_size, out: for priors that don't fit into memory (memory mapped Xf), see apply_weights in update.py
+    - dtype: precision of the prior and of the state space matrix multiplications (e.g. np.float32). The small matrices in observation/ensemble space stay in double precision.
+    - stats: e.g. ('mean','var',0.05,0.95), return only these statistics of the analysis, computed blockwise, see apply_weights in update.py
+    - overwrite_prior: write the analysis block by block into Xf instead of a new array, see apply_weights in update.py
 
     Output:
-    - Analysis ensemble (N_x, N_e)
+    - Analysis ensemble (N_x, N_e), with stats a dict {statistic: array (N_x)}
     
     
     """
+    import scipy.linalg
+
+    HXf=observations(HXf, Xf)
     # number of ensemble members
     Ne=np.shape(Xf)[1]
     Ny=np.shape(R)[0]
-    #Obs error matrix
-    Rmat=np.diag(R)
-    #Mean of prior ensemble for each gridbox   
-    mX = np.mean(Xf, axis=1)
-    #Perturbations from ensemble mean
-    Xfp=Xf-mX[:,None]
-    #Mean and perturbations for model values in observation space
-    mY = np.mean(HXf, axis=1)
-    HXp = HXf-mY[:,None]
 
-    HPH=HXp@HXp.T /(Ne-1)
+    with stage('mean/perturbations',flops=2*Ny*Ne,nbytes=8*Ny*Ne):
+        #Mean and perturbations for model values in observation space
+        mY = np.mean(HXf, axis=1)
+        HXp = HXf-mY[:,None]
+
+    with stage('observation space matrix',flops=2*Ny*Ny*Ne,nbytes=8*(Ny*Ny+2*Ny*Ne)):
+        A=HXp@HXp.T /(Ne-1)
 
-    A=HPH + Rmat
+        #Obs error matrix is diagonal, only add it to the diagonal
+        A[np.diag_indices(Ny)]+=R
 
-    rng = np.random.default_rng(seed=42)
-    Y_p=rng.standard_normal((Ny, Ne))*np.sqrt(R)[:,None]
+        rng = np.random.default_rng(seed=42)
+        Y_p=rng.standard_normal((Ny, Ne))*np.sqrt(R)[:,None]
 
-    D= Y[:,None]+Y_p - HXf
+        D= Y[:,None]+Y_p - HXf
     
-    #solve linear system for getting inverse
-    C=np.linalg.solve(A,D)
+    with stage('cholesky solve',flops=Ny**3/3+2*Ny*Ny*Ne+2*Ny*Ne*Ne,nbytes=8*(Ny*Ny+Ny*Ne+Ne*Ne)):
+        #solve linear system instead of inverting, A is symmetric positive definite
+        C=scipy.linalg.cho_solve(scipy.linalg.cho_factor(A),D)
     
-    E=HXp.T @ C
+        E=HXp.T @ C
     
-    Xa=Xf+Xfp@(E/(Ne-1))
+    #Xf + Xfp @ E/(N_e-1) with the perturbations of the prior
+    W=np.identity(Ne)+E/(Ne-1)
+    Xa=apply_weights(Xf, W, chunk_size=chunk_size, out=out, dtype=dtype, stats=stats, overwrite_prior=overwrite_prior)
     
     return Xa
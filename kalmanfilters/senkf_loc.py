@@ -1,4 +1,13 @@
-def SEnKF_loc(Xf, HXf, Y, R,PH_loc, HPH_loc):
+import numpy as np
+from .loc_product import localized_product
+from .obs_operator import observations
+from .prior_store import as_prior, mean_anomalies
+from .profiling import stage
+
+#right hand sides (ensemble members) solved together by the conjugate gradients
+CG_BLOCK_SIZE=32
+
+def SEnKF_loc(Xf, HXf, Y, R,PH_loc, HPH_loc, dtype=None, solver='cholesky'):
     """
     Stochastic Ensemble Kalman Filter that can do localisation. Changed the order of calculations
     Implementation adapted from pseudocode description in
@@ -9,35 +18,150 @@ def SEnKF_loc(Xf, HXf, Y, R,PH_loc, HPH_loc):
     Changes: The pseudocode is not consistent with the description in 5.1, where the obs-from-model are perturbed, but in the pseudocode it's the other way round.
     Hence the 8th line D= ... is confusing if we would generate Y as described in the text.
     Last line needs to have 1/(Ne-1)
+    
+    PH_loc/HPH_loc can be dense arrays or scipy.sparse matrices (covariance_loc(...,sparse=True), or banded matrices). For sparse PH_loc
+    Xfp @ HXp^T is only evaluated at its nonzero entries (localized_product in loc_product.py).
+    HXf can also be an ObsOperator (obs_operator.py).
+    dtype: precision of the prior and of the state space matrix multiplications (e.g. np.float32)
+    solver: 'cholesky' (default) forms the localized N_y x N_y system densely and solves it directly (O(N_y^3) flops, N_y^2 memory).
+    'cg' keeps the system sparse (entries only at the nonzero entries of a sparse HPH_loc) and solves it with preconditioned
+    conjugate gradients (see cg_solve), the cost is O(nnz(HPH_loc) N_e) per iteration. It only pays off for many observations with
+    a short localization radius (N_y ~ 10^4 with HPH_loc density ~0.01, see the timings in cg_solve) or when the N_y x N_y matrix
+    doesn't fit into memory, for dense HPH_loc or a few thousand observations the Cholesky solve is faster. The result agrees with 'cholesky' up to the solver tolerance.
     """
+    import scipy.linalg
+    import scipy.sparse
+
+    HXf=observations(HXf, Xf)
+    if solver not in ('cholesky','cg'):
+        raise ValueError("solver must be 'cholesky' or 'cg'")
+    R=np.asarray(R,dtype=float)
+    Xf=as_prior(Xf,dtype=dtype)
     # number of ensemble members
-    Ne=np.shape(Xf)[1]
+    Nx,Ne=np.shape(Xf)
     Ny=np.shape(R)[0]
-    #Obs error matrix
-    Rmat=np.diag(R)
-    #Mean of prior ensemble for each gridbox   
-    mX = np.mean(Xf, axis=1)
-    #Perturbations from ensemble mean
-    Xfp=Xf-mX[:,None]
-    #Mean and perturbations for model values in observation space
-    mY = np.mean(HXf, axis=1)
-    HXp = HXf-mY[:,None]
+    itemsize=Xf.dtype.itemsize
 
-    #Hadamard product for localisation
-    HPH=HPH_loc * (HXp@HXp.T /(Ne-1))
+    with stage('mean/perturbations',flops=2*Nx*Ne,nbytes=itemsize*Nx*Ne):
+        #Mean of prior ensemble for each gridbox and perturbations from ensemble mean (stored in a PriorStore)
+        mX, Xfp = mean_anomalies(Xf, dtype)
+        #Mean and perturbations for model values in observation space
+        mY = np.mean(HXf, axis=1)
+        HXp = HXf-mY[:,None]
 
-    A=HPH + Rmat
+        #perturbed observations
+        rng = np.random.default_rng(seed=42)
+        Y_p=rng.standard_normal((Ny, Ne))*np.sqrt(R)[:,None]
 
-    rng = np.random.default_rng(seed=42)
-    Y_p=rng.standard_normal((Ny, Ne))*np.sqrt(R)[:,None]
+        D= Y[:,None]+Y_p - HXf
 
-    D= Y[:,None]+Y_p - HXf
+    if solver=='cholesky':
+        with stage('observation space matrix',flops=2*Ny*Ny*Ne,nbytes=8*Ny*Ny):
+            #Hadamard product for localisation
+            if scipy.sparse.issparse(HPH_loc):
+                A=HPH_loc.multiply(HXp@HXp.T /(Ne-1)).toarray()
+            else:
+                A=HPH_loc * (HXp@HXp.T /(Ne-1))
+
+            #Obs error matrix is diagonal, only add it to the diagonal
+            A[np.diag_indices(Ny)]+=R
     
-    #solve linear system for getting inverse
-    C=np.linalg.solve(A,D)
+    if solver=='cg':
+        with stage('conjugate gradients') as st:
+            C,flops=cg_solve(HPH_loc,HXp,R,D)
+            #known at the end (number of iterations)
+            st.flops=flops
+            st.nbytes=12*(HPH_loc.nnz if scipy.sparse.issparse(HPH_loc) else Ny*Ny)+8*6*Ny*min(Ne,CG_BLOCK_SIZE)
+    else:
+        with stage('cholesky solve',flops=Ny**3/3+2*Ny*Ny*Ne,nbytes=8*(Ny*Ny+Ny*Ne)):
+            #solve linear system instead of inverting, A is symmetric positive definite
+            C=scipy.linalg.cho_solve(scipy.linalg.cho_factor(A),D)
     
-    Pb=PH_loc*(Xfp @ HXp.T/(Ne-1)) 
+    #state space products in the precision of the prior
+    HXpT=(HXp.T/(Ne-1)).astype(Xfp.dtype)
+    if scipy.sparse.issparse(PH_loc):
+        #product only evaluated at the nonzero entries of PH_loc, see ENSRF_direct_loc
+        with stage('localized PH^T (sparse)',flops=2*PH_loc.nnz*Ne,nbytes=(itemsize+4)*PH_loc.nnz):
+            Pb=localized_product(PH_loc, Xfp, HXpT)
+    else:
+        with stage('localized PH^T',flops=2*Nx*Ny*Ne+Nx*Ny,nbytes=2*itemsize*Nx*Ny):
+            Pb=np.multiply(PH_loc, Xfp @ HXpT, dtype=Xfp.dtype)
     
-    Xa=Xf + Pb @ C
+    nnz=Pb.nnz if scipy.sparse.issparse(Pb) else Nx*Ny
+    with stage('state update',flops=2*nnz*Ne,nbytes=itemsize*Nx*Ne):
+        #Xf + Pb @ C from the mean and perturbations
+        Xa=Pb @ C.astype(Xfp.dtype)
+        Xa+=Xfp
+        Xa+=mX[:,None]
     
     return Xa
+
+
+def cg_solve(HPH_loc, HXp, R, D, tol=1e-10, maxiter=None, block_size=CG_BLOCK_SIZE):
+    """
+    Solves (HPH_loc o (HXp @ HXp.T)/(N_e-1) + diag(R)) C = D with Jacobi-preconditioned conjugate gradients.
+    For sparse HPH_loc the system matrix is formed only at its nonzero entries (localized_product in loc_product.py,
+    2 nnz N_e flops, nnz memory) and stays sparse, one iteration is a sparse product with a block of right hand sides
+    (2 nnz block_size flops). The right hand sides are solved in blocks of block_size columns, so the temporaries are
+    N_y x block_size and converged blocks stop iterating. Dense HPH_loc gives a dense system matrix (no advantage over Cholesky).
+
+    Measured against the Cholesky solve of SEnKF_loc (N_e=50, 1 thread, system matrix + solve, ~130 iterations):
+    N_y=3000, HPH_loc density 0.037: cg 1.0 s (9 MB), cholesky 0.35 s (73 MB)
+    N_y=10000, HPH_loc density 0.010: cg 4.6 s (27 MB), cholesky 7.2 s (800 MB)
+
+    Input:
+    - HPH_loc: Matrix for localization of HPH^T (N_y x N_y), dense or scipy.sparse
+    - HXp: perturbations of the model values in observation space (N_y x N_e)
+    - R: Measurement Error (N_y)
+    - D: right hand sides (N_y x N_r)
+    - tol: relative residual at which a column counts as converged
+    - maxiter: maximum number of iterations per block (default 10*N_y)
+    - block_size: number of right hand sides solved together
+    Output:
+    - C: solution (N_y x N_r)
+    - flops: approximate number of floating point operations
+    """
+    import scipy.sparse
+
+    Ny,Ne=np.shape(HXp)
+    Nr=np.shape(D)[1]
+
+    #system matrix, sparse with the pattern of HPH_loc
+    if scipy.sparse.issparse(HPH_loc):
+        A=localized_product(HPH_loc, HXp, HXp.T/(Ne-1))
+        nnz=A.nnz
+    else:
+        A=HPH_loc * (HXp @ HXp.T/(Ne-1))
+        nnz=Ny*Ny
+    flops=2*nnz*Ne
+    #Jacobi preconditioner: diagonal of the system matrix
+    Minv=1/(np.asarray(A.diagonal()) + R)
+    A=A + (scipy.sparse.diags(R) if scipy.sparse.issparse(A) else np.diag(R))
+
+    C=np.zeros((Ny,Nr))
+    for j in range(0,Nr,block_size):
+        res=np.array(D[:,j:j+block_size],dtype=float)
+        Nb=res.shape[1]
+        Cb=C[:,j:j+block_size]
+        Z=Minv[:,None]*res
+        P=Z.copy()
+        rz=np.sum(res*Z,axis=0)
+        bnorm=np.linalg.norm(res,axis=0)
+        bnorm[bnorm==0]=1.
+
+        for it in range(maxiter or 10*Ny):
+            if np.all(np.linalg.norm(res,axis=0)<=tol*bnorm):
+                break
+            AP=A @ P
+            pAp=np.sum(P*AP,axis=0)
+            alpha=np.divide(rz,pAp,out=np.zeros(Nb),where=pAp>0)
+            Cb+=alpha*P
+            res-=alpha*AP
+            Z=Minv[:,None]*res
+            rz_new=np.sum(res*Z,axis=0)
+            beta=np.divide(rz_new,rz,out=np.zeros(Nb),where=rz>0)
+            P=Z+beta*P
+            rz=rz_new
+            flops+=2*nnz*Nb+12*Ny*Nb
+
+    return C, flops
@@ -0,0 +1,42 @@
+import sys
+from multiprocessing import shared_memory
+
+import numpy as np
+
+def to_shared(array):
+    """
+    Copy an array into a new shared memory block, such that worker processes can attach to it instead of receiving a pickled copy.
+    Output:
+    - shm: the SharedMemory object (call shm.close() and shm.unlink() when done)
+    - spec: (name, shape, dtype) to be passed to the workers, see attach
+    """
+    array=np.asarray(array)
+    shm=shared_memory.SharedMemory(create=True,size=max(array.nbytes,1))
+    shared=np.ndarray(array.shape,dtype=array.dtype,buffer=shm.buf)
+    shared[...]=array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def empty_shared(shape,dtype=float):
+    """
+    Allocate an uninitialized array in shared memory (e.g. for the output of worker processes).
+    Output: shm, spec, array
+    """
+    dtype=np.dtype(dtype)
+    shm=shared_memory.SharedMemory(create=True,size=max(int(np.prod(shape))*dtype.itemsize,1))
+    array=np.ndarray(shape,dtype=dtype,buffer=shm.buf)
+    return shm, (shm.name, tuple(shape), dtype.str), array
+
+
+def attach(spec):
+    """
+    Attach to a shared memory block created by to_shared/empty_shared.
+    Output: shm (keep a reference as long as the array is used), array
+    """
+    name,shape,dtype=spec
+    #only the creating process unlinks the block (worker processes share its resource tracker)
+    if sys.version_info >= (3, 13):
+        shm=shared_memory.SharedMemory(name=name,track=False)
+    else:
+        shm=shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape,dtype=dtype,buffer=shm.buf)
@@ -0,0 +1,162 @@
+import numpy as np
+
+from .cov_loc import unit_sphere, EARTH_RADIUS, gaspari_cohn, localization_matrices
+from .etkf import ETKF_weights
+from .ensrf_direct_loc import ENSRF_direct_loc
+from .update import apply_weights
+from .obs_operator import observations
+from .prior_store import mean_anomalies
+from .profiling import stage
+
+def sweep(Xf, HXf, Y, R, proxy_lat, proxy_lon, cov_lens, inflations=(1.,), holdout=None, grid_lat=None, grid_lon=None,
+          sparse=False, cache_dir=None, dtype=None):
+    """
+    Tuning of the localization radius cov_len and of a multiplicative covariance inflation factor (P -> inflation * P, the
+    perturbations are scaled by sqrt(inflation)) for the localized simultaneous EnSRF (ENSRF_direct_loc, same analysis mean as
+    SEnKF_loc). All settings are scored in observation space, the prior (N_x) is only used for the analysis of the best setting.
+
+    For every cov_len the proxy-proxy localization (Gaspari Cohn of the proxy distances, computed once for all radii) is applied
+    to HPH^T and the innovation covariance is whitened with R^-1/2:
+        R + inflation * (HPH_loc o HPH^T) = R^1/2 (I + inflation * M) R^1/2,   M = U diag(mu) U^T
+    One eigendecomposition of M per radius serves all inflation factors, which only rescale the eigenvalues (1 + inflation*mu).
+    Scores (lower is better):
+    - without holdout: negative log likelihood of the innovations d=Y-mean(HXf) per observation (up to a constant),
+      1/(2 N_y) * sum(e^2/(1+inflation*mu) + log(1+inflation*mu)) with e = U^T R^-1/2 d
+    - with holdout: the held-out proxies are not assimilated but predicted by the analysis mean (Kalman gain with the localized
+      covariances between held-out and assimilated proxies), score is the mean of (Y - prediction)^2/R over the held-out proxies
+    Also returned is the normalized innovation chi^2 = d^T (R + inflation * HPH_loc o HPH^T)^-1 d / N_y, which is close to 1
+    for a consistent prior spread.
+
+    cov_len None means no localization, the analysis is then computed with the ETKF weights (inflation is applied to the weights,
+    the prior is not copied).
+
+    Usage:
+        res=sweep(Xf,HXf,Y,R,proxy_lat,proxy_lon,cov_lens=[1000,2000,4000,None],inflations=[1,1.2,1.5],
+                  grid_lat=grid_lat,grid_lon=grid_lon,sparse=True)
+        Xa=res['analysis']
+
+    Input:
+    - Xf:  the prior ensemble (N_x x N_e), or None to only compute the scores
+    - HX^f: Model value projected into observation space/at proxy locations (N_y x N_e), or an ObsOperator (obs_operator.py)
+    - Y: Observation vector (N_y)
+    - R: Measurement Error (N_y), diagonal of the error covariance matrix
+    - proxy_lat, proxy_lon: proxy locations (N_y)
+    - cov_lens: radii for the Gaspari Cohn function [km] (None: no localization)
+    - inflations: multiplicative inflation factors of the prior covariance
+    - holdout: boolean mask or indices of proxies that are held out for the scores (None: score the innovation likelihood)
+    - grid_lat, grid_lon: coordinates of the stacked grid (N_x), for the localization matrices of the best cov_len
+    - sparse, cache_dir: localization matrices of the analysis as in localization_matrices (cov_loc.py)
+    - dtype: precision of the prior in the analysis (e.g. np.float32)
+
+    Output: dict
+    - 'cov_len', 'inflation': best setting
+    - 'score', 'nll', 'chi2': arrays (number of cov_lens x number of inflations), 'holdout': held-out score if holdout is given
+    - 'analysis': analysis ensemble (N_x x N_e) of the best setting, all proxies (also the held-out ones) are assimilated.
+      None if Xf is None.
+    """
+    HXf=np.asarray(observations(HXf, Xf),dtype=float)
+    Y=np.asarray(Y,dtype=float)
+    R=np.broadcast_to(np.asarray(R,dtype=float),Y.shape)
+    cov_lens=list(cov_lens)
+    inflations=np.asarray(inflations,dtype=float)
+    Ny,Ne=np.shape(HXf)
+
+    mask=np.zeros(Ny,dtype=bool)
+    if holdout is not None:
+        mask[holdout]=True
+    a=np.flatnonzero(~mask)
+    h=np.flatnonzero(mask)
+    Na,Nh=len(a),len(h)
+
+    with stage('sweep: observation space covariances',flops=2*Ny*Na*Ne+20*Ny*Na,nbytes=8*2*Ny*Na):
+        mY=np.mean(HXf,axis=1)
+        HXp=HXf-mY[:,None]
+        #HPH^T between all proxies and the assimilated proxies, localized below for every cov_len
+        HPHT=HXp @ HXp[a].T/(Ne-1)
+        #proxy distances are computed once for all radii
+        dists=proxy_distances(proxy_lat,proxy_lon,a)
+        r=1/np.sqrt(R[a])
+        d=r*(Y[a]-mY[a])
+
+    shape=(len(cov_lens),len(inflations))
+    nll=np.empty(shape)
+    chi2=np.empty(shape)
+    skill=np.full(shape,np.nan)
+    for i,cov_len in enumerate(cov_lens):
+        with stage('sweep: eigendecomposition',flops=9*Na**3+2*Na*Na*Nh+30*Ny*Na,nbytes=8*(3*Na*Na+Nh*Na)):
+            loc=HPHT if cov_len is None else HPHT*gaspari_cohn(dists.reshape(-1),cov_len).reshape(dists.shape)
+            #whitened localized HPH^T of the assimilated proxies
+            mu,U=np.linalg.eigh(r[:,None]*loc[a]*r[None,:])
+            #negative rounding errors of the positive semidefinite matrix
+            mu=np.maximum(mu,0)
+            e=U.T @ d
+            if Nh:
+                #localized covariances of the held-out with the assimilated proxies in the eigenbasis
+                G=(loc[h]*r[None,:]) @ U
+
+        with stage('sweep: scores',flops=6*len(inflations)*(Na+Nh*Na)):
+            #rescaled eigenvalues for all inflation factors (N_infl x N_a)
+            Q=1+inflations[:,None]*mu[None,:]
+            chi2[i]=np.sum(e**2/Q,axis=1)/Na
+            nll[i]=0.5*(chi2[i]+np.mean(np.log(Q),axis=1))
+            if Nh:
+                #analysis mean at the held-out proxies
+                pred=mY[h][None,:] + (inflations[:,None]*e[None,:]/Q) @ G.T
+                skill[i]=np.mean((Y[h][None,:]-pred)**2/R[h][None,:],axis=1)
+
+    score=skill if Nh else nll
+    best=np.unravel_index(np.nanargmin(score),shape)
+    cov_len=cov_lens[best[0]]
+    inflation=inflations[best[1]]
+    res={'cov_len':cov_len, 'inflation':inflation, 'score':score, 'nll':nll, 'chi2':chi2, 'analysis':None}
+    if Nh:
+        res['holdout']=skill
+
+    if Xf is not None:
+        res['analysis']=sweep_analysis(Xf, HXf, Y, R, proxy_lat, proxy_lon, cov_len, inflation, grid_lat, grid_lon,
+                                       sparse=sparse, cache_dir=cache_dir, dtype=dtype)
+    return res
+
+
+def sweep_analysis(Xf, HXf, Y, R, proxy_lat, proxy_lon, cov_len, inflation, grid_lat=None, grid_lon=None, sparse=False,
+                   cache_dir=None, dtype=None):
+    """
+    Analysis for one setting of the sweep: ENSRF_direct_loc with the inflated prior, or the ETKF for cov_len None.
+    """
+    s=np.sqrt(inflation)
+    if cov_len is None:
+        #Xa = mX + sqrt(inflation) Xfp @ W, with the weights of the inflated observations from the model
+        wm, Wp = ETKF_weights(inflate(HXf,inflation), Y, R)
+        return apply_weights(Xf, s*(Wp + wm[:,None]), dtype=dtype)
+
+    if grid_lat is None or grid_lon is None:
+        raise ValueError('the analysis with localization needs grid_lat and grid_lon')
+    PH_loc,HPH_loc=localization_matrices(grid_lat,grid_lon,proxy_lat,proxy_lon,cov_len,sparse=sparse,cache_dir=cache_dir)
+    return ENSRF_direct_loc(inflate(Xf,inflation,dtype), inflate(HXf,inflation), Y, R, PH_loc, HPH_loc, dtype=dtype)
+
+
+def inflate(Xf, inflation, dtype=None):
+    """
+    Ensemble with the perturbations scaled by sqrt(inflation), i.e. the covariance multiplied by inflation.
+    """
+    if inflation==1:
+        return Xf
+    mX, Xfp = mean_anomalies(Xf, dtype)
+    with stage('inflation',flops=2*Xfp.size,nbytes=Xfp.nbytes):
+        if Xfp.flags.writeable:
+            Xfp*=np.sqrt(inflation)
+        else:
+            #read-only anomalies of a PriorStore
+            Xfp=Xfp*np.sqrt(inflation)
+        Xfp+=mX[:,None]
+    return Xfp
+
+
+def proxy_distances(proxy_lat, proxy_lon, cols):
+    """
+    Great circle distances [km] between all proxies and the proxies cols (N_y x len(cols)), via the chord on the unit sphere
+    (see neighbours in cov_loc.py). The squared chord 2-2cos is accurate to ~0.1 km, enough for the Gaspari Cohn weights.
+    """
+    xyz=unit_sphere(proxy_lat,proxy_lon)
+    chord=np.sqrt(np.maximum(2-2*(xyz @ xyz[cols].T),0))
+    return 2*EARTH_RADIUS*np.arcsin(np.clip(chord/2,0,1))
@@ -0,0 +1,258 @@
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from .backend import get_backend, set_backend
+from .dispatch import assimilate, choose_method
+from .loc_cache import LocalizationCache
+from .obs_operator import observations
+from .prior_store import PriorStore
+from .shared import to_shared, attach
+from .update import block_stats, check_stats
+from .profiling import stage
+
+#filters that write the analysis (or its statistics) block by block into out
+STREAMED=('ETKF', 'ESTKF', 'ETKF_livings', 'EnSRF', 'ENSRF_direct', 'EnSRF_serial', 'SEnKF')
+
+#environment variables of the BLAS/OpenMP thread pools, set for the spawned workers
+THREAD_VARS=('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'BLIS_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS',
+             'NUMEXPR_NUM_THREADS', 'NUMBA_NUM_THREADS')
+
+#format version of checkpoint.json
+VERSION=1
+
+def time_loop(Xf, HXf, Y, R, out, method='auto', mask=None, stats=None, PH_loc=None, HPH_loc=None, n_procs=None,
+              blas_threads=1, resume=True, dtype=None, **kwargs):
+    """
+    Offline Data Assimilation over many timesteps (e.g. years) with the same prior, distributed over a process pool.
+    Every timestep is one call of a filter (see assimilate in dispatch.py) with the observations available at that time.
+
+    - The workers attach to the prior instead of receiving a copy: a numpy array is copied once into shared memory (shared.py),
+      a PriorStore (prior_store.py) is reopened by path in every worker (memory maps, the pages are shared through the page cache).
+      Priors larger than memory should be passed as PriorStore.
+    - The workers are spawned (not forked) with OMP_NUM_THREADS etc. set to blas_threads, and threadpoolctl (if installed) limits
+      their BLAS threads as well, such that n_procs x blas_threads threads don't oversubscribe the cores. The numba backend
+      is passed on to the workers with the same number of threads.
+    - The analyses are written by the workers into memory mapped .npy files in the directory out, at the index of their
+      timestep: out/Xa.npy (T x N_x x N_e), or with stats one file per statistic (T x N_x, e.g. out/mean.npy, out/q0.05.npy).
+      The transform filters (STREAMED) write block by block into the files (out= of apply_weights), so no analysis is
+      held in memory.
+    - The finished timesteps are recorded in out/checkpoint.json (written atomically after the output of a timestep is flushed).
+      With resume=True an interrupted run in the same directory only computes the missing timesteps.
+
+    Localization: PH_loc and HPH_loc for all proxies (see covariance_loc in cov_loc.py) are sent once to every worker, which selects
+    the columns of the available proxies with a LocalizationCache. Sparse matrices keep this cheap.
+
+    Usage:
+        store=write_prior_store('prior_store',Xf,HXf,dtype=np.float32)
+        res=time_loop(store,None,Y,R,'reconstruction',method='ETKF',stats=('mean','var'),n_procs=8,blas_threads=2)
+        mean=res['mean']
+    (call from a script with an if __name__=='__main__': guard, the workers are spawned)
+
+    Input:
+    - Xf:  the prior ensemble (N_x x N_e), numpy array or PriorStore
+    - HX^f: Model value projected into observation space/at proxy locations for all possible proxies (N_y x N_e), or an ObsOperator
+      (obs_operator.py), None for the stored HXf of a PriorStore
+    - Y: Observation vectors (T x N_y), unavailable observations can be NaN
+    - R: Measurement Error (N_y) or (T x N_y)
+    - out: directory of the output files (created)
+    - method: 'auto' or the name of a filter, see assimilate
+    - mask: Availability of observations (boolean, T x N_y). If None, all non-NaN entries of Y are used.
+    - stats: None or sequence of statistics (see block_stats in update.py), only the statistics are written
+    - PH_loc, HPH_loc: localization matrices for all proxies (N_x x N_y, N_y x N_y), dense or scipy.sparse
+    - n_procs: number of worker processes. None: number of cores / blas_threads. 1: all timesteps in this process
+    - blas_threads: BLAS threads per worker
+    - resume: continue a run in out (same configuration), False: start again
+    - dtype: precision of the prior and of the output (e.g. np.float32)
+    - kwargs: passed to the filter (e.g. chunk_size)
+
+    Output:
+    - Analysis ensembles (T x N_x x N_e, read-only memory map), with stats a dict {statistic: memory map (T x N_x)}
+    """
+    Y=np.atleast_2d(np.asarray(Y,dtype=float))
+    T,Ny=np.shape(Y)
+    R=np.broadcast_to(np.asarray(R,dtype=float),(T,Ny))
+    if mask is None:
+        mask=~np.isnan(Y)
+    mask=np.broadcast_to(np.asarray(mask,dtype=bool),(T,Ny))
+    HXf=np.asarray(observations(HXf, Xf),dtype=float)
+    if not isinstance(Xf,PriorStore):
+        Xf=np.asarray(Xf,dtype=dtype)
+    if stats is not None:
+        check_stats(stats)
+    if (PH_loc is None)!=(HPH_loc is None):
+        raise ValueError('localization needs PH_loc and HPH_loc')
+    if n_procs is None:
+        n_procs=max(os.cpu_count()//blas_threads,1)
+
+    Nx,Ne=np.shape(Xf)
+    config={'version':VERSION, 'T':T, 'Nx':Nx, 'Ne':Ne, 'Ny':Ny, 'method':method,
+            'stats':None if stats is None else list(stats), 'dtype':np.dtype(Xf.dtype if dtype is None else dtype).name}
+    done=open_outputs(out, config, resume)
+    todo=[t for t in range(T) if t not in done]
+
+    #only the time outside the stages of the filters (checkpoints, waiting for the workers), the filters report their own stages
+    with stage('time loop'):
+        if n_procs==1 or len(todo)<=1:
+            init_worker(Xf, HXf, Y, R, mask, out, method, stats, PH_loc, HPH_loc, None, None, dtype, kwargs)
+            try:
+                for t in todo:
+                    done.add(timestep_worker(t))
+                    write_checkpoint(out, config, done)
+            finally:
+                worker_state.clear()
+        else:
+            parallel_loop(Xf, HXf, Y, R, mask, out, method, stats, PH_loc, HPH_loc, n_procs, blas_threads, dtype, kwargs,
+                          todo, config, done)
+
+    return load_outputs(out, stats)
+
+
+def parallel_loop(Xf, HXf, Y, R, mask, out, method, stats, PH_loc, HPH_loc, n_procs, blas_threads, dtype, kwargs,
+                  todo, config, done):
+    """
+    Distributes the timesteps over a process pool, the prior is shared through shared memory (or the PriorStore).
+    """
+    shm=None
+    if not isinstance(Xf,PriorStore):
+        shm,Xf=to_shared(Xf)
+
+    #the workers are spawned, not forked (a fork after the threads of the numba backend or of BLAS were started can hang).
+    #Their thread pools are configured from the environment at import of numpy, threadpoolctl (if installed) limits them again
+    #in init_worker
+    environ={v:str(blas_threads) for v in THREAD_VARS}
+    previous={v:os.environ.get(v) for v in environ}
+    os.environ.update(environ)
+
+    try:
+        with ProcessPoolExecutor(n_procs,mp_context=multiprocessing.get_context('spawn'),initializer=init_worker,
+                                 initargs=(Xf, HXf, Y, R, mask, out, method, stats, PH_loc, HPH_loc, blas_threads,
+                                           get_backend(), dtype, kwargs)) as pool:
+            futures=[pool.submit(timestep_worker,t) for t in todo]
+            try:
+                for f in as_completed(futures):
+                    done.add(f.result())
+                    write_checkpoint(out, config, done)
+            except BaseException:
+                #finished timesteps are in the checkpoint, the queued ones are not started
+                pool.shutdown(wait=True,cancel_futures=True)
+                raise
+    finally:
+        for v,value in previous.items():
+            if value is None:
+                os.environ.pop(v,None)
+            else:
+                os.environ[v]=value
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+
+
+def output_names(stats):
+    """
+    File name (without .npy) of the analysis or of every statistic
+    """
+    if stats is None:
+        return {None:'Xa'}
+    return {s:s if isinstance(s,str) else 'q{}'.format(s) for s in stats}
+
+
+def open_outputs(out, config, resume):
+    """
+    Creates the output files in out, or with resume reopens those of an interrupted run with the same configuration.
+    Output: set of the finished timesteps
+    """
+    os.makedirs(out,exist_ok=True)
+    path=os.path.join(out,'checkpoint.json')
+    if resume and os.path.exists(path):
+        with open(path) as f:
+            checkpoint=json.load(f)
+        if checkpoint['config']!=json.loads(json.dumps(config)):
+            raise ValueError('{} contains a run with a different configuration {}, use another directory or resume=False'.format(
+                             out,checkpoint['config']))
+        return set(checkpoint['done'])
+
+    if os.path.exists(path):
+        os.remove(path)
+    T,Nx,Ne=config['T'],config['Nx'],config['Ne']
+    shape=(T,Nx,Ne) if config['stats'] is None else (T,Nx)
+    for name in output_names(config['stats']).values():
+        a=np.lib.format.open_memmap(os.path.join(out,name+'.npy'),mode='w+',dtype=config['dtype'],shape=shape)
+        del a
+    done=set()
+    write_checkpoint(out, config, done)
+    return done
+
+
+def write_checkpoint(out, config, done):
+    #written atomically, an interrupted write leaves the previous checkpoint
+    tmp=os.path.join(out,'checkpoint.json.tmp')
+    with open(tmp,'w') as f:
+        json.dump({'config':config, 'done':sorted(done)},f,indent=1)
+    os.replace(tmp,os.path.join(out,'checkpoint.json'))
+
+
+def load_outputs(out, stats, mmap_mode='r'):
+    """
+    The output files of time_loop as memory maps: analysis ensembles (T x N_x x N_e), or with stats a dict {statistic: (T x N_x)}
+    """
+    arrays={s:np.load(os.path.join(out,name+'.npy'),mmap_mode=mmap_mode) for s,name in output_names(stats).items()}
+    return arrays[None] if stats is None else arrays
+
+
+#state of the worker processes, set by init_worker
+worker_state={}
+
+def init_worker(Xf, HXf, Y, R, mask, out, method, stats, PH_loc, HPH_loc, blas_threads, backend, dtype, kwargs):
+    if blas_threads is not None:
+        try:
+            from threadpoolctl import threadpool_limits
+            #the limit holds as long as the object exists
+            worker_state['limits']=threadpool_limits(blas_threads)
+        except ImportError:
+            pass
+    if backend is not None:
+        set_backend(backend)
+        if backend=='numba' and blas_threads is not None:
+            import numba
+            numba.set_num_threads(min(blas_threads,numba.config.NUMBA_NUM_THREADS))
+
+    if isinstance(Xf,tuple):
+        #spec of the shared prior
+        worker_state['shm'],Xf=attach(Xf)
+    worker_state['Xf']=Xf
+    worker_state['args']=(HXf, Y, R, mask, method, stats, dtype, kwargs)
+    worker_state['out']=load_outputs(out, stats, mmap_mode='r+')
+    worker_state['loc']=None if PH_loc is None else LocalizationCache(PH_loc, HPH_loc)
+
+
+def timestep_worker(t):
+    """
+    Analysis of timestep t, written into the output files
+    """
+    Xf=worker_state['Xf']
+    HXf,Y,R,mask,method,stats,dtype,kwargs=worker_state['args']
+    out=worker_state['out']
+    m=mask[t]
+    loc=() if worker_state['loc'] is None else worker_state['loc'].get(m)
+
+    if method=='auto' and not loc:
+        method=choose_method(np.shape(Xf)[0], int(np.sum(m)), np.shape(Xf)[1])
+    if method in STREAMED:
+        #written block by block into the memory maps
+        target=out[t] if stats is None else {s:a[t] for s,a in out.items()}
+        assimilate(Xf, HXf[m], Y[t,m], R[t,m], method, *loc, out=target, dtype=dtype, stats=stats, **kwargs)
+    else:
+        Xa=assimilate(Xf, HXf[m], Y[t,m], R[t,m], method, *loc, dtype=dtype, **kwargs)
+        if stats is None:
+            out[t]=Xa
+        else:
+            for s,v in block_stats(Xa,stats).items():
+                out[s][t]=v
+
+    for a in (out.values() if stats is not None else (out,)):
+        a.flush()
+    return t
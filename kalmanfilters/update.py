@@ -0,0 +1,203 @@
+import numpy as np
+from .backend import kernel
+from .prior_store import PriorStore
+from .low_rank import LowRankPrior
+from .profiling import stage
+
+#rows per block when only summary statistics are computed
+STATS_CHUNK_SIZE=4096
+
+#rows per block when the analysis is written into out or into the prior
+OUT_CHUNK_SIZE=4096
+
+def apply_weights(Xf, W, chunk_size=None, out=None, dtype=None, stats=None, overwrite_prior=False):
+    """
+    Final step of the transform filters (ETKF, ETKF_livings, ESTKF, EnSRF, ENSRF_direct): Xa = mX + Xfp @ W
+    This is the most costly operation, all other steps only work on the small ensemble space matrices computed from HXf.
+
+    When the prior doesn't fit into memory (e.g. Xf is an np.memmap or a .npy file opened with np.load(..., mmap_mode='r')),
+    the prior is streamed through the update in blocks of chunk_size rows. As the ensemble mean is computed per row,
+    each block can be treated independently and only one block of the prior is in memory at a time.
+    The result can be written into a memory mapped array, e.g. out=np.lib.format.open_memmap('Xa.npy',mode='w+',shape=Xf.shape).
+    When out is given, the analysis is always written block by block (default OUT_CHUNK_SIZE rows), the only temporaries are
+    the mean, perturbations and product of one block, never arrays of the size of the prior. With overwrite_prior=True the prior
+    itself is the output buffer: every block is read before it is overwritten with its analysis, so the analysis needs no memory
+    beyond the prior (Xf must be a writeable array, e.g. a memory map opened with mode='r+').
+    For a LowRankPrior (low_rank.py) the weights are applied in the reduced space and the analysis is returned as LowRankEnsemble,
+    which is only reconstructed on the grid on demand (with out or stats the reconstruction is done here, block by block).
+    A PriorStore (prior_store.py) is always streamed (by default in its stored chunks) and its stored mean and anomalies are
+    used directly, Xa = mean + anomalies @ W.
+
+    The multiplication with the prior is memory-bound, with dtype=np.float32 the prior (blocks) and the weight matrix are converted
+    to single precision, which halves memory and bandwidth. The weights themselves should be computed in double precision.
+
+    When only summary statistics of the analysis are needed, stats=('mean','var',0.05,0.95) computes them block by block
+    (see block_stats), the analysis ensemble is never allocated. Peak memory is then one block of chunk_size rows
+    (default STATS_CHUNK_SIZE) and the output only has N_x entries per statistic.
+
+    Input:
+    - Xf: the prior ensemble (N_x x N_e), numpy array, memory mapped array, PriorStore or LowRankPrior
+    - W: weight matrix (N_e x N_e)
+    - chunk_size: number of rows of the prior processed at once. None: all rows at once (OUT_CHUNK_SIZE when out is given)
+    - out: array (N_x x N_e) in which the analysis is written. None: a new array is allocated
+      With stats: dict of arrays (N_x) for the statistics, e.g. memory mapped arrays
+    - dtype: precision of the prior and of the matrix multiplication (e.g. np.float32). None: keep dtype of Xf
+    - stats: None or sequence of statistics, see block_stats
+    - overwrite_prior: write the analysis into Xf (out=Xf)
+
+    Output:
+    - Analysis ensemble (N_x, N_e), or with stats a dict {statistic: array (N_x)}, LowRankEnsemble for a LowRankPrior
+    """
+    if overwrite_prior:
+        if stats is not None or out is not None:
+            raise ValueError('overwrite_prior excludes out and stats')
+        if not isinstance(Xf,np.ndarray) or not Xf.flags.writeable:
+            raise ValueError('overwrite_prior needs a writeable prior array')
+        if np.shape(W)[1]!=np.shape(Xf)[1]:
+            raise ValueError('overwrite_prior needs as many analysis as prior members')
+        out=Xf
+
+    if stats is not None:
+        return apply_weights_stats(Xf, W, stats, chunk_size=chunk_size, out=out, dtype=dtype)
+
+    if isinstance(Xf,LowRankPrior) and out is None:
+        return Xf.apply(W)
+
+    if dtype is not None:
+        W=W.astype(dtype)
+
+    Nx,Ne=np.shape(Xf)
+    itemsize=np.dtype(Xf.dtype if dtype is None else dtype).itemsize
+
+    if isinstance(Xf,PriorStore) and chunk_size is None:
+        chunk_size=Xf.chunk_size
+    if out is not None and chunk_size is None:
+        chunk_size=OUT_CHUNK_SIZE
+
+    kern=kernel('update_block')
+    if chunk_size is None and out is None and kern is not None:
+        #mean subtraction fused into the multiplication
+        with stage('state update',flops=2*Nx*Ne*(np.shape(W)[1]+1),nbytes=Nx*np.shape(W)[1]*itemsize):
+            return kern(np.asarray(Xf,dtype=dtype),W)
+
+    if chunk_size is None and out is None:
+        with stage('mean/perturbations',flops=2*Nx*Ne,nbytes=Nx*Ne*itemsize):
+            Xf=np.asarray(Xf,dtype=dtype)
+            #Mean of prior ensemble for each gridbox
+            mX = np.mean(Xf, axis=1)
+            #Perturbations from ensemble mean
+            Xfp=Xf-mX[:,None]
+        with stage('state update',flops=2*Nx*Ne*np.shape(W)[1],nbytes=Nx*np.shape(W)[1]*itemsize):
+            Xa=Xfp @ W
+            Xa+=mX[:,None]
+        return Xa
+
+    if out is None:
+        out=np.empty((Nx,np.shape(W)[1]),dtype=np.result_type(Xf.dtype if dtype is None else dtype,W.dtype))
+
+    #mean/perturbations and update blockwise
+    with stage('state update (chunked)',flops=2*Nx*Ne*(np.shape(W)[1]+1),nbytes=3*min(chunk_size,Nx)*Ne*itemsize):
+        for i in range(0,Nx,chunk_size):
+            #only this block is read from disk, the block is read completely before it is written (out can be Xf)
+            out[i:i+chunk_size]=update_rows(Xf,slice(i,i+chunk_size),W,dtype)
+
+    if isinstance(out,np.memmap):
+        out.flush()
+
+    return out
+
+
+def update_block(Xb, W):
+    """
+    Xa = mX + Xfp @ W for one block of the prior. The ensemble members are on the last axis, the leading dimensions
+    are arbitrary (rows of the stacked prior or e.g. lat x lon blocks), as every grid point is updated independently.
+    """
+    kern=kernel('update_block')
+    if kern is not None:
+        return kern(Xb,W)
+    mXb=np.mean(Xb,axis=-1)
+    return mXb[...,None] + (Xb-mXb[...,None]) @ W
+
+
+def update_rows(Xf, rows, W, dtype=None):
+    """
+    Xa = mX + Xfp @ W for the rows of the prior. The mean and anomalies of a PriorStore are read, not recomputed,
+    a LowRankPrior is reconstructed from the reduced space.
+    """
+    if isinstance(Xf,LowRankPrior):
+        return Xf.apply_rows(rows,W,dtype)
+    if isinstance(Xf,PriorStore):
+        Xab=np.asarray(Xf.anomalies[rows],dtype=dtype) @ W
+        Xab+=Xf.mean[rows,None]
+        return Xab
+    return update_block(np.asarray(Xf[rows],dtype=dtype),W)
+
+
+def apply_weights_stats(Xf, W, stats, chunk_size=None, out=None, dtype=None):
+    """
+    Summary statistics of Xa = mX + Xfp @ W computed block by block, see apply_weights.
+    """
+    check_stats(stats)
+    if dtype is not None:
+        W=W.astype(dtype)
+
+    Nx,Ne=np.shape(Xf)
+    Na=np.shape(W)[1]
+    itemsize=np.dtype(Xf.dtype if dtype is None else dtype).itemsize
+    if chunk_size is None:
+        chunk_size=STATS_CHUNK_SIZE
+    if out is None:
+        res_dtype=np.result_type(Xf.dtype if dtype is None else dtype,W.dtype)
+        out={s:np.empty(Nx,dtype=res_dtype) for s in stats}
+
+    with stage('state update (statistics)',flops=2*Nx*Ne*(Na+1)+10*Nx*Na,nbytes=3*min(chunk_size,Nx)*max(Ne,Na)*itemsize):
+        for i in range(0,Nx,chunk_size):
+            #only this block of the analysis exists
+            Xab=update_rows(Xf,slice(i,i+chunk_size),W,dtype)
+            for s,v in block_stats(Xab,stats).items():
+                out[s][i:i+chunk_size]=v
+
+    for v in out.values():
+        if isinstance(v,np.memmap):
+            v.flush()
+
+    return out
+
+
+def block_stats(Xa, stats):
+    """
+    Statistics over the ensemble dimension of (a block of) an analysis ensemble (N x N_e)
+    - 'mean': ensemble mean
+    - 'var', 'std': ensemble variance/standard deviation (with 1/(N_e-1) as the covariances in the filters)
+    - 'min', 'max': ensemble minimum/maximum
+    - float q in [0,1]: quantile q of the ensemble (linear interpolation, as np.quantile)
+
+    Output:
+    - dict {statistic: array (N)}
+    """
+    out={}
+    quantiles=[s for s in stats if not isinstance(s,str)]
+    if quantiles:
+        for q,v in zip(quantiles,np.quantile(Xa,quantiles,axis=1)):
+            out[q]=v
+    for s in stats:
+        if s=='mean':
+            out[s]=np.mean(Xa,axis=1)
+        elif s=='var':
+            out[s]=np.var(Xa,axis=1,ddof=1)
+        elif s=='std':
+            out[s]=np.std(Xa,axis=1,ddof=1)
+        elif s=='min':
+            out[s]=np.min(Xa,axis=1)
+        elif s=='max':
+            out[s]=np.max(Xa,axis=1)
+    return out
+
+
+def check_stats(stats):
+    for s in stats:
+        if isinstance(s,str):
+            if s not in ('mean','var','std','min','max'):
+                raise ValueError("unknown statistic '{}', use 'mean', 'var', 'std', 'min', 'max' or a quantile in [0,1]".format(s))
+        elif not 0<=s<=1:
+            raise ValueError('quantiles must be in [0,1], got {}'.format(s))
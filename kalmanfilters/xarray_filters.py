@@ -0,0 +1,73 @@
+import numpy as np
+
+from .etkf import ETKF_weights
+from .estkf import ESTKF_weights
+from .etkf_livings import ETKF_livings_weights
+from .ensrf import EnSRF_weights
+from .ensrf_direct import ENSRF_direct_weights
+from .ensrf_serial import EnSRF_serial_weights
+from .update import update_block
+
+WEIGHTS={'ETKF':ETKF_weights, 'ESTKF':ESTKF_weights, 'ETKF_livings':ETKF_livings_weights, 'EnSRF':EnSRF_weights,
+         'ENSRF_direct':ENSRF_direct_weights, 'EnSRF_serial':EnSRF_serial_weights}
+
+def assimilate_dataarray(prior, HXf, Y, R, method='ETKF', member_dim='member', chunks=None, dtype=None):
+    """
+    xarray/dask front end for the transform filters (ETKF, ESTKF, ETKF_livings, EnSRF, ENSRF_direct, EnSRF_serial).
+    The ensemble space weights only need the observations from the model and are computed eagerly with numpy.
+    The prior stays a lazily chunked (dask) DataArray: the update Xa = mX + Xfp @ W is mapped over its chunks (every grid point is
+    updated independently, see update_block in update.py), so the prior is never stacked, never loaded with .values and never
+    copied into one process. The result is a lazy DataArray with the dimensions and coordinates (lat/lon ...) of the prior.
+
+    With the local threaded scheduler (dask's default for arrays) the chunks are updated in parallel on all cores, the matrix
+    multiplications release the GIL. Limit the BLAS threads (e.g. OMP_NUM_THREADS=1) to avoid oversubscription.
+    Summary statistics are also lazy, e.g. Xa.mean(member_dim) or Xa.quantile(0.95,member_dim), and computing only them never
+    holds the whole analysis in memory.
+
+    Usage:
+        prior=xr.open_dataset('prior.nc',chunks={'lat':32})['tas']   #dims e.g. (member, lat, lon)
+        Xa=assimilate_dataarray(prior,HXf,Y,R,method='ETKF')
+        Xa.mean('member').to_netcdf('analysis_mean.nc')
+
+    Input:
+    - prior: xarray.DataArray with the ensemble members along member_dim and arbitrary other dimensions (e.g. lat, lon),
+      numpy or dask backed
+    - HX^f: Model value projected into observation space/at proxy locations (N_y x N_e), numpy array or DataArray with member_dim
+    - Y: Observation vector (N_y)
+    - R: Measurement Error (N_y), diagonal of the error covariance matrix
+    - method: name of the transform filter, one of WEIGHTS
+    - chunks: chunks of the prior along the other dimensions (e.g. {'lat':32}). None: keep the chunks of a dask backed prior,
+      numpy backed priors are chunked automatically. The member dimension is always a single chunk.
+    - dtype: precision of the prior and of the update (e.g. np.float32)
+
+    Output:
+    - Analysis ensemble as lazy xarray.DataArray (same dimensions and coordinates as the prior)
+    """
+    import xarray as xr
+
+    if method not in WEIGHTS:
+        raise ValueError('method must be one of {}'.format(list(WEIGHTS)))
+
+    if isinstance(HXf,xr.DataArray):
+        #proxies x members
+        HXf=HXf.transpose(...,member_dim).values
+    wm, Wp = WEIGHTS[method](np.asarray(HXf), np.asarray(Y), np.asarray(R))
+    #the imaginary parts of the EnSRF weights are negligible (see EnSRF_weights)
+    W=(Wp + wm[:,None]).real
+
+    if dtype is not None:
+        prior=prior.astype(dtype)
+        W=W.astype(dtype)
+    out_dtype=np.result_type(prior.dtype,W.dtype)
+
+    if chunks is None and prior.chunks is None:
+        chunks={d:'auto' for d in prior.dims if d!=member_dim}
+    #the member dimension must be in one chunk, as every grid point needs all members
+    prior=prior.chunk(dict(chunks or {},**{member_dim:-1}))
+
+    Xa=xr.apply_ufunc(update_block, prior, kwargs={'W':W},
+                      input_core_dims=[[member_dim]], output_core_dims=[[member_dim]],
+                      dask='parallelized', output_dtypes=[out_dtype])
+
+    #apply_ufunc moves the core dimension to the end, restore the order of the prior
+    return Xa.transpose(*prior.dims)
@@ -0,0 +1,22 @@
+"""
+Test data for the checks in this folder: the tracked observations (testdata/HXf.npy, Y.npy, R.npy) and a synthetic prior with
+the same ensemble size (testdata/Xf.npz, the prior of the notebook, is not part of the repository).
+"""
+import os
+import sys
+
+import numpy as np
+
+ROOT=os.path.join(os.path.dirname(os.path.abspath(__file__)),'..')
+sys.path.insert(0,ROOT)
+
+def load_testdata(Nx=20000, seed=0):
+    """
+    Output: Xf (N_x x N_e), HXf (N_y x N_e), Y (N_y), R (N_y)
+    """
+    HXf,Y,R=(np.load(os.path.join(ROOT,'testdata',name+'.npy'),allow_pickle=True).astype(float) for name in ('HXf','Y','R'))
+    Ne=np.shape(HXf)[1]
+    rng=np.random.default_rng(seed)
+    #temperature like field (~280 K), low rank + noise as a climate model prior
+    Xf=280+rng.standard_normal((Nx,20)) @ rng.standard_normal((20,Ne))+0.5*rng.standard_normal((Nx,Ne))
+    return Xf, HXf, Y, R
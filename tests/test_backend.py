@@ -0,0 +1,35 @@
+"""
+numba backend (numba_kernels.py) against the numpy backend, see the notebook. Skipped when numba is not installed.
+Run with pytest or as a script from the repository root.
+"""
+import importlib.util
+
+import numpy as np
+
+from data import load_testdata
+from kalmanfilters.backend import use_backend
+from kalmanfilters.cov_loc import gaspari_cohn
+from test_float32 import FILTERS
+
+def test_backend():
+    if importlib.util.find_spec('numba') is None:
+        print('numba is not installed, skipped')
+        return
+    Xf,HXf,Y,R=load_testdata()
+    dists=np.linspace(0,5000,10000)
+    gc=gaspari_cohn(dists,1000)
+    full={f.__name__:f(Xf,HXf,Y,R) for f in FILTERS}
+    full32={f.__name__:f(Xf,HXf,Y,R,dtype=np.float32) for f in FILTERS}
+
+    with use_backend('numba'):
+        assert np.allclose(gc,gaspari_cohn(dists,1000),rtol=0,atol=1e-12)
+        for f in FILTERS:
+            err=np.max(np.abs(full[f.__name__]-f(Xf,HXf,Y,R)))
+            err32=np.max(np.abs(full32[f.__name__]-f(Xf,HXf,Y,R,dtype=np.float32)))
+            print('{:<14} float64 {:.2e} float32 {:.2e}'.format(f.__name__,err,err32))
+            #rounding of the different order of operations, ~280 K values
+            assert err<1e-9 and err32<1e-3, f.__name__
+
+
+if __name__=='__main__':
+    test_backend()
@@ -0,0 +1,33 @@
+"""
+Single precision (dtype=np.float32) against double precision on the test data, see the notebook.
+Run with pytest or as a script from the repository root.
+"""
+import numpy as np
+
+from data import load_testdata
+from kalmanfilters.ensrf import EnSRF
+from kalmanfilters.ensrf_direct import ENSRF_direct
+from kalmanfilters.ensrf_serial import EnSRF_serial
+from kalmanfilters.estkf import ESTKF
+from kalmanfilters.etkf import ETKF
+from kalmanfilters.etkf_livings import ETKF_livings
+
+FILTERS=[ESTKF, EnSRF, EnSRF_serial, ENSRF_direct, ETKF, ETKF_livings]
+
+#temperatures are ~280K, float32 has ~7 significant digits
+ATOL=1e-3
+
+def test_float32():
+    Xf,HXf,Y,R=load_testdata()
+    for f in FILTERS:
+        Xa=f(Xf,HXf,Y,R)
+        Xa32=f(Xf,HXf,Y,R,dtype=np.float32)
+        assert Xa32.dtype==np.float32, f.__name__
+        mean_err=np.max(np.abs(np.mean(Xa,axis=1)-np.mean(Xa32,axis=1,dtype=np.float64)))
+        cov_err=np.max(np.abs(np.cov(Xa[:1000],ddof=1)-np.cov(Xa32[:1000].astype(np.float64),ddof=1)))
+        print('{:<14} mean {:.2e} covariance {:.2e}'.format(f.__name__,mean_err,cov_err))
+        assert mean_err<ATOL and cov_err<ATOL, f.__name__
+
+
+if __name__=='__main__':
+    test_float32()